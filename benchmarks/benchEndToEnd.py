@@ -0,0 +1,201 @@
+"""
+End-to-end latency benchmark. Runs xcelMeter.setup() and then the
+meter's own polling loop on xcelPoller for a number of cycles, against
+the simulated meter (in a separate process) and a local MQTT stand-in.
+Reports discovery time, latency from each poll's deadline to its publish
+reaching the broker, percentiles included, and CPU time per cycle.
+
+Usage: python benchEndToEnd.py --cycles 50 --latency 0.05
+"""
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import threading
+import tempfile
+import warnings
+import subprocess
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent / 'xcel_itron2mqtt'))
+
+from mqttStandIn import MqttStandIn
+
+# The bridge talks to the meter without verifying its cert, same as run.sh
+warnings.simplefilter('ignore')
+
+
+def generate_creds(cert_dir: Path) -> tuple:
+    """
+    Generates a throwaway EC key pair the same way scripts/generate_keys.sh
+    does. Used by both the simulated meter and the bridge.
+
+    Returns: tuple of cert and key paths
+    """
+    cert, key = cert_dir / '.cert.pem', cert_dir / '.key.pem'
+    subprocess.run(['openssl', 'req', '-x509', '-nodes', '-newkey', 'ec',
+                    '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                    '-keyout', str(key), '-out', str(cert), '-sha256', '-days', '1',
+                    '-subj', '/CN=MeterReaderHanClient'],
+                   check=True, capture_output=True)
+    return str(cert), str(key)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f'Nothing listening on port {port}')
+
+
+def start_simulator(creds: tuple, layout: str, latency: float, jitter: float) -> tuple:
+    """
+    Starts meterSimulator.py in its own process so its CPU time isn't
+    counted against the bridge
+
+    Returns: tuple of the process and its port
+    """
+    port = free_port()
+    process = subprocess.Popen([sys.executable, str(BENCH_DIR / 'meterSimulator.py'),
+                                '--port', str(port), '--cert', creds[0], '--key', creds[1],
+                                '--layout', layout, '--latency', str(latency),
+                                '--jitter', str(jitter), '--seed', '1'],
+                               stdout=subprocess.DEVNULL)
+    wait_for_port(port)
+    return process, port
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_benchmark(cycles: int, layout: str, latency: float, jitter: float, polling_rate: float) -> dict:
+    work_dir = Path(tempfile.mkdtemp(prefix='xcel_bench_'))
+    try:
+        creds = generate_creds(work_dir)
+        broker = MqttStandIn()
+        broker.start()
+        simulator, meter_port = start_simulator(creds, layout, latency, jitter)
+        try:
+            return measure(cycles, layout, latency, polling_rate, creds, broker, meter_port, work_dir)
+        finally:
+            simulator.terminate()
+            simulator.wait()
+            broker.stop()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def measure(cycles: int, layout: str, latency: float, polling_rate: float, creds: tuple,
+            broker: MqttStandIn, meter_port: int, work_dir: Path) -> dict:
+    # Always discover from scratch, publish every reading and poll every
+    # endpoint at the same rate, so each cycle has them all due at once
+    os.environ.update({
+        'MQTT_SERVER': '127.0.0.1',
+        'MQTT_PORT': str(broker.port),
+        'ENDPOINT_CACHE_DIR': str(work_dir / 'cache'),
+        'OUTBOX_PATH': str(work_dir / 'cache' / 'outbox.ring'),
+        'PUBLISH_ONLY_CHANGES': 'false',
+        'POLLING_RATE': str(polling_rate),
+        'HONOR_POLL_RATE': 'false',
+        'ADAPTIVE_POLLING': 'false',
+    })
+    from xcelMeter import xcelMeter
+
+    meter = xcelMeter('Xcel Itron 5', '127.0.0.1', meter_port, creds)
+    start = time.perf_counter()
+    meter.setup()
+    discovery_time = time.perf_counter() - start
+
+    topics = [endpoint._sensor_state_topics['value'] for endpoint in meter.endpoints]
+    broker.clear()
+    cpu_start = time.process_time()
+    # The poller makes every endpoint due one period after it was added,
+    # then every period from there
+    first_deadline = time.monotonic() + polling_rate
+    runner = threading.Thread(target=meter.run, name='bench_meter', daemon=True)
+    runner.start()
+    last_deadline = first_deadline + (cycles - 1) * polling_rate
+    time.sleep(max(0.0, last_deadline - time.monotonic()))
+    for topic in topics:
+        broker.wait_for(topic, last_deadline)
+    cpu_time = time.process_time() - cpu_start
+    meter.poller.stop()
+    runner.join(timeout=10)
+    transport = meter.transport_stats()
+    meter.stop()
+    meter.mqtt_client.loop_stop()
+    meter.mqtt_client.disconnect()
+
+    latencies = []
+    for message in list(broker.messages):
+        if message.topic not in topics or message.received < first_deadline:
+            continue
+        # Publishes belong to the latest deadline before them
+        cycle = int((message.received - first_deadline) // polling_rate)
+        if cycle < cycles:
+            latencies.append(message.received - (first_deadline + cycle * polling_rate))
+
+    return {
+        'layout': layout,
+        'meter_latency_s': latency,
+        'polling_rate_s': polling_rate,
+        'endpoints': len(meter.endpoints),
+        'cycles': cycles,
+        'polls': len(latencies),
+        'overruns': meter.poller.overruns,
+        'discovery_s': round(discovery_time, 4),
+        'poll_to_publish_ms': {
+            'p50': round(percentile(latencies, 50) * 1000, 2),
+            'p90': round(percentile(latencies, 90) * 1000, 2),
+            'p99': round(percentile(latencies, 99) * 1000, 2),
+            'max': round(max(latencies) * 1000, 2),
+        },
+        'cpu_ms_per_cycle': round(cpu_time / cycles * 1000, 3),
+        'transport': transport,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end bridge benchmark against a simulated meter')
+    parser.add_argument('--cycles', type=int, default=50)
+    parser.add_argument('--layout', choices=['default', '3_2_39'], default='default')
+    parser.add_argument('--latency', type=float, default=0.05, help='Simulated meter response latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--polling-rate', type=float, default=0.25,
+                        help='POLLING_RATE of the bridge, the seconds between cycles')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.cycles, args.layout, args.latency, args.jitter, args.polling_rate)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    latency = results['poll_to_publish_ms']
+    print(f"Layout {results['layout']}, {results['endpoints']} endpoints, {results['cycles']} cycles "
+          f"every {results['polling_rate_s']}s, {results['polls']} polls, {results['overruns']} overruns")
+    print(f"Discovery:          {results['discovery_s'] * 1000:.1f} ms")
+    print(f"Poll to publish:    p50 {latency['p50']} ms, p90 {latency['p90']} ms, "
+          f"p99 {latency['p99']} ms, max {latency['max']} ms")
+    print(f"CPU per cycle:      {results['cpu_ms_per_cycle']} ms")
+    print(f"Meter connection:   {results['transport']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+"""
+Microbenchmarks of the bridge's hot paths, run against the fixture XML
+of every supported firmware layout in fixtures/<layout>/. Each stage is
+timed as one pass over all of the layout's endpoints, the median of
+several rounds, and compared to a saved JSON baseline. A stage counts as
+slower when it is over the baseline by more than the threshold and by
+more than the noise floor. Slower stages are timed again, and the run
+only fails if they are still slower every time.
+
+Usage: python benchMicro.py --save-baseline     (on the base branch)
+       python benchMicro.py --threshold 0.25    (on the change)
+       python benchMicro.py --write-fixtures    (regenerate the XML)
+"""
+import os
+import sys
+import json
+import time
+import timeit
+import statistics
+import logging
+import argparse
+import platform
+import subprocess
+from pathlib import Path
+from urllib.parse import urlsplit
+
+BENCH_DIR = Path(__file__).resolve().parent
+FIXTURE_DIR = BENCH_DIR / 'fixtures'
+sys.path.insert(0, str(BENCH_DIR.parent / 'xcel_itron2mqtt'))
+
+from benchEndToEnd import free_port, wait_for_port
+from meterSimulator import LAYOUTS, MeterState, build_resources
+
+# Names the list tag sensors are published under
+LIST_SENSOR_NAMES = {'duration': 'Duration', 'start': 'Timestamp'}
+
+STAGES = ('parse_response', 'create_config', 'mqtt_send_config', 'process_send_mqtt',
+          'get_meter_endpoint_reading', 'get_meter_endpoint_type_details', 'meter_reading_to_yaml')
+
+
+def fixture_name(path: str) -> str:
+    return path.strip('/').replace('/', '_') + '.xml'
+
+
+def write_fixtures() -> None:
+    """
+    Dumps every resource the simulated meter serves for each layout,
+    with a fixed seed so the readings are the same every time
+    """
+    for layout in LAYOUTS:
+        layout_dir = FIXTURE_DIR / layout
+        layout_dir.mkdir(parents=True, exist_ok=True)
+        for path, body in build_resources(MeterState(layout, seed=1)).items():
+            (layout_dir / fixture_name(path)).write_text(body() if callable(body) else body, encoding='utf-8')
+        print(f'Wrote the {layout} fixtures to {layout_dir}')
+
+
+def load_fixtures(layout: str) -> dict:
+    """
+    Returns: dict, {<resource path>: <xml>}
+    """
+    return {'/' + file.stem.replace('_', '/'): file.read_text(encoding='utf-8')
+            for file in sorted((FIXTURE_DIR / layout).glob('*.xml'))}
+
+
+class FixtureResponse():
+    def __init__(self, text: str):
+        self.text = text
+        self.status_code = 200
+
+
+class FixtureSession():
+    """
+    Answers discovery's requests from the fixtures, so the discovery
+    transforms are timed without any transport in the way
+    """
+    def __init__(self, fixtures: dict):
+        self.fixtures = fixtures
+
+    def get(self, url: str, **kwargs) -> FixtureResponse:
+        return FixtureResponse(self.fixtures[urlsplit(url).path])
+
+
+def start_broker() -> tuple:
+    """
+    Starts mqttStandIn.py in its own process so the broker's work isn't
+    timed along with the bridge's
+
+    Returns: tuple of the process and its port
+    """
+    port = free_port()
+    process = subprocess.Popen([sys.executable, str(BENCH_DIR / 'mqttStandIn.py'), '--port', str(port)],
+                               stdout=subprocess.DEVNULL)
+    wait_for_port(port)
+    return process, port
+
+
+def time_stage(func, rounds: int) -> float:
+    """
+    Returns: float, median time of one call in microseconds
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return round(statistics.median(timer.repeat(repeat=rounds, number=number)) / number * 1e6, 3)
+
+
+def build_stages(layout: str, mqtt_client) -> dict:
+    """
+    Returns: dict, {<layout>/<stage>: function running one pass of it}
+    """
+    from xcelEndpoint import xcelEndpoint
+    from xcelDecoder import xcelDecoder
+    from xcelPublishFilter import xcelPublishFilter
+    from generateEndpointYaml import generateEndpointYaml
+
+    fixtures = load_fixtures(layout)
+    generator = generateEndpointYaml('Xcel Itron 5', 'fixture', 0, None, session=FixtureSession(fixtures))
+    # The same walk discovery does, reading types and readings come from the fixtures
+    meter_readings = generator.get_meter_endpoint_details('/upt/1/mr', len(LAYOUTS[layout]))
+    endpoints_list = generator.meter_reading_to_yaml(meter_readings)
+    reading_urls = [mr['MeterReading']['ReadingLink'] for mr in meter_readings]
+    reading_type_urls = list(dict.fromkeys(mr['MeterReading']['ReadingTypeLink'] for mr in meter_readings))
+
+    device_info = {'device': {'identifiers': ['bench'], 'name': 'Xcel Itron 5', 'model': 'Gen5 Riva Meter',
+                              'manufacturer': 'ITRON Inc.', 'sw_version': layout}}
+    endpoints = []
+    for point in endpoints_list:
+        for endpoint_name, v in point.items():
+            endpoints.append(xcelEndpoint(None, mqtt_client, v['url'], endpoint_name, v['tags'], device_info,
+                                          publish_filter=xcelPublishFilter(suppress_unchanged=False),
+                                          decoder=xcelDecoder.from_endpoint(v)))
+    responses = [(endpoint, fixtures[endpoint.url]) for endpoint in endpoints]
+    readings = [(endpoint, endpoint.decoder.decode(endpoint.parse_response(response, endpoint._extraction_plan)))
+                for endpoint, response in responses]
+    # Same walk over the tags as the endpoint's own config generation
+    sensors = []
+    for endpoint in endpoints:
+        for k, v in endpoint.tags.items():
+            if isinstance(v, list):
+                for item in v:
+                    name, details = next(iter(item.items()))
+                    sensors.append((endpoint, LIST_SENSOR_NAMES.get(name, f'{k}{name}'), details))
+            else:
+                sensors.append((endpoint, k, v))
+
+    stages = {
+        'parse_response': lambda: [endpoint.parse_response(response, endpoint._extraction_plan)
+                                   for endpoint, response in responses],
+        'create_config': lambda: [endpoint.create_config(sensor_name, details)
+                                  for endpoint, sensor_name, details in sensors],
+        'mqtt_send_config': lambda: [endpoint.mqtt_send_config() for endpoint in endpoints],
+        'process_send_mqtt': lambda: [endpoint.process_send_mqtt(reading) for endpoint, reading in readings],
+        'get_meter_endpoint_reading': lambda: [generator.get_meter_endpoint_reading(url) for url in reading_urls],
+        'get_meter_endpoint_type_details': lambda: [generator.get_meter_endpoint_type_details(url)
+                                                    for url in reading_type_urls],
+        'meter_reading_to_yaml': lambda: generator.meter_reading_to_yaml(meter_readings),
+    }
+
+    return {f'{layout}/{stage}': stages[stage] for stage in STAGES}
+
+
+def compare(results: dict, baseline: dict, threshold: float, noise_floor: float) -> list:
+    """
+    Returns: list of (stage, baseline us, result us) that regressed
+    """
+    regressions = []
+    for stage, result in results.items():
+        base = baseline.get(stage)
+        if base and result > base * (1 + threshold) and result - base > noise_floor:
+            regressions.append((stage, base, result))
+
+    return regressions
+
+
+def confirm(stages: dict, results: dict, regressions: list, baseline: dict, args) -> list:
+    """
+    Times the stages that regressed again, a stage only stays a
+    regression if it is slower on every rerun. The results keep the
+    fastest of the runs.
+
+    Returns: list of (stage, baseline us, result us) that regressed
+    """
+    for _ in range(args.confirm):
+        if not regressions:
+            break
+        rerun = {stage: time_stage(stages[stage], args.rounds) for stage, _, _ in regressions}
+        print(f"Timing {', '.join(rerun)} again", file=sys.stderr)
+        for stage, result in rerun.items():
+            results[stage] = min(results[stage], result)
+        regressions = compare(rerun, baseline, args.threshold, args.noise_floor)
+
+    return [(stage, base, results[stage]) for stage, base, _ in regressions]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the parse, publish and discovery stages')
+    parser.add_argument('--layout', choices=list(LAYOUTS), action='append',
+                        help='Layout to benchmark, can be repeated. Defaults to every layout')
+    parser.add_argument('--rounds', type=int, default=11, help='Timing rounds per stage, the median counts')
+    parser.add_argument('--baseline', default=str(BENCH_DIR / 'baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Fraction a stage may get slower than the baseline before failing')
+    parser.add_argument('--noise-floor', type=float, default=5.0,
+                        help='Microseconds a stage may get slower than the baseline regardless of the threshold')
+    parser.add_argument('--confirm', type=int, default=2,
+                        help='Number of times a regressed stage is timed again, it fails only if it is slower every time')
+    parser.add_argument('--write-fixtures', action='store_true', help='Regenerate the fixture XML and exit')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    if args.write_fixtures:
+        write_fixtures()
+        return
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, mode='r', encoding='utf-8') as file:
+            baseline = json.load(file).get('stages', {})
+
+    broker, port = start_broker()
+    # Local import, the meter module pulls in the whole bridge
+    from xcelMeter import xcelMeter
+    logging.disable(logging.WARNING)
+    try:
+        mqtt_client = xcelMeter.setup_mqtt('127.0.0.1', port)
+        deadline = time.monotonic() + 10.0
+        while not mqtt_client.is_connected() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        stages = {}
+        for layout in args.layout or list(LAYOUTS):
+            stages.update(build_stages(layout, mqtt_client))
+        results = {stage: time_stage(func, args.rounds) for stage, func in stages.items()}
+        regressions = compare(results, baseline, args.threshold, args.noise_floor)
+        regressions = confirm(stages, results, regressions, baseline, args)
+        mqtt_client.disconnect()
+        mqtt_client.loop_stop()
+    finally:
+        broker.terminate()
+        broker.wait()
+
+    if args.json:
+        print(json.dumps({'stages': results, 'regressions': [stage for stage, _, _ in regressions]}, indent=2))
+    else:
+        print(f"{'stage':<48} {'us/pass':>10} {'baseline':>10} {'change':>8}")
+        for stage, result in results.items():
+            base = baseline.get(stage)
+            change = f'{(result / base - 1) * 100:+.1f}%' if base else ''
+            print(f"{stage:<48} {result:>10.2f} {base if base else '':>10} {change:>8}")
+
+    if args.save_baseline:
+        with open(args.baseline, mode='w', encoding='utf-8') as file:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'stages': results}, file, indent=2)
+        print(f'Saved the baseline to {args.baseline}')
+    elif regressions:
+        for stage, base, result in regressions:
+            print(f'REGRESSION {stage}: {base:.2f} us -> {result:.2f} us, more than {args.threshold:.0%} '
+                  f'and {args.noise_floor:g} us slower on every run', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+Soak test. Runs the full xcelMeter.run() polling loop for a long time
+against the simulated meter and the MQTT stand-in, each in its own
+process, with the polling rate turned up so hours of running cover
+weeks of polls. tracemalloc snapshots, RSS, open file descriptors,
+sockets and threads of the bridge are sampled as it goes. The report
+lists the allocation sites that grew the most after warm-up, and the
+run fails if any resource kept growing past its allowance.
+
+Usage: python benchSoak.py --duration 3600 --polling-rate 0.05
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import subprocess
+import threading
+import tracemalloc
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent / 'xcel_itron2mqtt'))
+
+from benchEndToEnd import generate_creds, free_port, wait_for_port
+
+# Frames kept per allocation, enough to see which caller leaked
+TRACE_DEPTH = 10
+
+
+def count_fds() -> tuple:
+    """
+    Returns: tuple of (open file descriptors, sockets among them), or
+    (None, None) where /proc isn't available
+    """
+    try:
+        fds = os.listdir('/proc/self/fd')
+    except OSError:
+        return None, None
+    sockets = 0
+    for fd in fds:
+        try:
+            if os.readlink(f'/proc/self/fd/{fd}').startswith('socket:'):
+                sockets += 1
+        except OSError:
+            pass
+
+    return len(fds), sockets
+
+
+def rss_kb() -> int | None:
+    """
+    Returns: int, resident set size in KB, or None where /proc isn't available
+    """
+    try:
+        with open('/proc/self/statm', mode='r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        return None
+
+
+def take_sample(elapsed: float) -> dict:
+    fds, sockets = count_fds()
+    traced, _ = tracemalloc.get_traced_memory()
+    return {'elapsed_s': round(elapsed, 1), 'traced_kb': traced // 1024, 'rss_kb': rss_kb(),
+            'fds': fds, 'sockets': sockets, 'threads': threading.active_count()}
+
+
+def start_broker(port: int) -> subprocess.Popen:
+    process = subprocess.Popen([sys.executable, str(BENCH_DIR / 'mqttStandIn.py'), '--port', str(port)],
+                               stdout=subprocess.DEVNULL)
+    wait_for_port(port)
+    return process
+
+
+def start_simulator(creds: tuple, layout: str, subscriptions: bool) -> tuple:
+    """
+    Returns: tuple of the simulated meter's process and its port
+    """
+    port = free_port()
+    command = [sys.executable, str(BENCH_DIR / 'meterSimulator.py'), '--port', str(port),
+               '--cert', creds[0], '--key', creds[1], '--layout', layout, '--seed', '1']
+    if subscriptions:
+        command.append('--subscriptions')
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    wait_for_port(port)
+    return process, port
+
+
+def growth(samples: list, key: str) -> float | None:
+    """
+    Compares the lowest value of the second half of the samples to the
+    lowest of the first half. Request threads and sockets come and go,
+    only a leak keeps raising the floor.
+
+    Returns: growth of the floor, or None with fewer than two samples
+    """
+    values = [sample[key] for sample in samples if sample[key] is not None]
+    if len(values) < 2:
+        return None
+    half = len(values) // 2
+    return min(values[half:]) - min(values[:half])
+
+
+def run_soak(duration: float, polling_rate: float, sample_interval: float, warmup: float,
+             layout: str, subscriptions: bool, broker_bounce: float, top: int) -> dict:
+    """
+    Returns: dict of the samples, the growth of each resource between the
+    first and last sample and the allocation sites that grew the most
+    """
+    work_dir = Path(tempfile.mkdtemp(prefix='xcel_soak_'))
+    creds = generate_creds(work_dir)
+    broker_port = free_port()
+    broker = start_broker(broker_port)
+    simulator, meter_port = start_simulator(creds, layout, subscriptions)
+
+    os.environ.update({
+        'MQTT_SERVER': '127.0.0.1',
+        'MQTT_PORT': str(broker_port),
+        'ENDPOINT_CACHE_DIR': str(work_dir / 'cache'),
+        'OUTBOX_PATH': str(work_dir / 'cache' / 'outbox.ring'),
+        'POLLING_RATE': str(polling_rate),
+        # Every poll publishes, so the MQTT path sees the most traffic
+        'PUBLISH_ONLY_CHANGES': 'false',
+        'SUBSCRIPTIONS': 'true' if subscriptions else 'false',
+        'SUBSCRIPTION_POLLING_RATE': str(polling_rate * 10),
+        'NOTIFY_PORT': str(free_port()),
+        'NOTIFY_HOST': '127.0.0.1',
+    })
+    from xcelMeter import xcelMeter
+
+    tracemalloc.start(TRACE_DEPTH)
+    try:
+        meter = xcelMeter('Xcel Itron 5', '127.0.0.1', meter_port, creds)
+        meter.setup()
+        runner = threading.Thread(target=meter.run, name='soak_meter', daemon=True)
+        start = time.monotonic()
+        runner.start()
+
+        samples = []
+        baseline_snapshot = None
+        next_bounce = start + broker_bounce if broker_bounce else None
+        while time.monotonic() - start < duration:
+            time.sleep(min(sample_interval, max(0.0, duration - (time.monotonic() - start))))
+            now = time.monotonic()
+            if next_bounce is not None and now >= next_bounce:
+                # Broker outages exercise the outbox and paho's reconnects
+                broker.terminate()
+                broker.wait()
+                time.sleep(min(5.0, broker_bounce / 10))
+                broker = start_broker(broker_port)
+                next_bounce = now + broker_bounce
+            if now - start < warmup:
+                continue
+            if baseline_snapshot is None:
+                baseline_snapshot = tracemalloc.take_snapshot()
+            samples.append(take_sample(now - start))
+            print(json.dumps(samples[-1]), flush=True)
+        final_snapshot = tracemalloc.take_snapshot()
+
+        meter.poller.stop()
+        runner.join(timeout=10)
+        readings = meter.publish_stats()
+    finally:
+        tracemalloc.stop()
+        simulator.terminate()
+        simulator.wait()
+        broker.terminate()
+        broker.wait()
+
+    # Leave out what tracemalloc and this harness allocate themselves
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    sites = []
+    if baseline_snapshot is not None:
+        stats = final_snapshot.filter_traces(filters).compare_to(baseline_snapshot.filter_traces(filters), 'lineno')
+        for stat in stats[:top]:
+            frame = stat.traceback[0]
+            sites.append({'site': f'{frame.filename}:{frame.lineno}', 'size_diff_kb': round(stat.size_diff / 1024, 1),
+                          'count_diff': stat.count_diff})
+
+    return {
+        'layout': layout,
+        'duration_s': duration,
+        'polling_rate_s': polling_rate,
+        # How long the same number of polls takes at the default 5s polling rate
+        'equivalent_days': round(duration * 5.0 / polling_rate / 86400, 1),
+        'readings': readings,
+        'samples': samples,
+        'growth': {key: growth(samples, key) for key in ('traced_kb', 'rss_kb', 'fds', 'sockets', 'threads')},
+        'top_growth': sites,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Long running leak check of the bridge against local stand-ins')
+    parser.add_argument('--duration', type=float, default=3600.0, help='Seconds to run for')
+    parser.add_argument('--polling-rate', type=float, default=0.05, help='POLLING_RATE of the bridge, in seconds')
+    parser.add_argument('--sample-interval', type=float, default=60.0, help='Seconds between samples')
+    parser.add_argument('--warmup', type=float, default=120.0,
+                        help='Seconds before the first sample, caches and pools fill up in this time')
+    parser.add_argument('--layout', choices=['default', '3_2_39'], default='default')
+    parser.add_argument('--subscriptions', action='store_true', help='Also take readings through subscriptions')
+    parser.add_argument('--broker-bounce', type=float, default=0.0,
+                        help='Restart the MQTT broker every this many seconds, 0 never does')
+    parser.add_argument('--top', type=int, default=15, help='Allocation sites to report')
+    parser.add_argument('--max-memory-growth', type=int, default=2048,
+                        help='KB traced memory may grow by after warm-up')
+    parser.add_argument('--max-fd-growth', type=int, default=4,
+                        help='File descriptors, and sockets, may grow by after warm-up')
+    parser.add_argument('--max-thread-growth', type=int, default=0,
+                        help='Threads may grow by after warm-up')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+    # At compressed polling rates the poller warns about every skipped cycle
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=os.environ.get('LOGLEVEL', 'ERROR').upper())
+
+    results = run_soak(args.duration, args.polling_rate, args.sample_interval, args.warmup, args.layout,
+                       args.subscriptions, args.broker_bounce, args.top)
+    limits = {'traced_kb': args.max_memory_growth, 'fds': args.max_fd_growth,
+              'sockets': args.max_fd_growth, 'threads': args.max_thread_growth}
+    leaks = [key for key, limit in limits.items()
+             if results['growth'][key] is not None and results['growth'][key] > limit]
+    results['leaks'] = leaks
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"Layout {results['layout']}, {results['duration_s']}s at a {results['polling_rate_s']}s polling rate, "
+              f"about {results['equivalent_days']} days of polls")
+        print(f"Readings: {results['readings']}")
+        print('Growth after warm-up: ' + ', '.join(f'{key} {value:+}' for key, value in results['growth'].items()
+                                                  if value is not None))
+        print('Largest growth by allocation site:')
+        for site in results['top_growth']:
+            print(f"  {site['size_diff_kb']:>+10.1f} KB {site['count_diff']:>+8} blocks  {site['site']}")
+    if leaks:
+        print(f"Kept growing past the allowance: {', '.join(leaks)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
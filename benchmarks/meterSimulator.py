@@ -0,0 +1,442 @@
+"""
+Stand-in for an Itron Gen5 Riva meter. Serves the IEEE 2030.5 resources
+the bridge reads during discovery and polling over HTTPS, with
+configurable response latency and readings that evolve over time.
+With --subscriptions the readings can also be subscribed to, and are
+pushed to the subscribers every --notify-interval seconds.
+
+Usage: python meterSimulator.py --cert certs/.cert.pem --key certs/.key.pem
+"""
+import ssl
+import time
+import random
+import argparse
+import threading
+import http.client
+import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+NS = 'urn:ieee:std:2030.5:ns'
+
+# MeterReading layout of the supported firmware versions, modeled on
+# configs/endpoints_default.yaml and configs/endpoints_3_2_39.yaml
+# (mr id, description, ReadingType id, reading path, has touTier)
+LAYOUTS = {
+    'default': [
+        (1, 'Instantaneous Demand', 1, '/upt/1/mr/1/r', False),
+        (2, 'Current Summation Received', 2, '/upt/1/mr/2/rs/1/r/1', True),
+        (3, 'Current Summation Delivered', 2, '/upt/1/mr/3/rs/1/r/1', True),
+    ],
+    '3_2_39': [
+        (1, 'Instantaneous Demand', 1, '/upt/1/mr/1/r', False),
+        (2, 'Current Summation Received', 2, '/upt/1/mr/2/rs/1/r/1', False),
+        (3, 'Current Summation Delivered', 2, '/upt/1/mr/3/rs/1/r/1', False),
+    ],
+}
+
+# ReadingType id: (accumulationBehaviour, kind, uom, powerOfTenMultiplier)
+READING_TYPES = {
+    1: (12, 8, 38, 0),  # Instantaneous Demand in W
+    2: (9, 12, 72, 0),  # Summation in Wh
+}
+
+# Length of the interval readings kept in the ReadingSets, one set per day
+INTERVAL = 900
+DAY = 86400
+HISTORY_DAYS = 2
+
+SW_VERSIONS = {
+    'default': '2.7.21',
+    '3_2_39': '3.2.39',
+}
+
+
+class MeterState():
+    """
+    Readings of the simulated meter. Demand follows a slow random walk and
+    the summation registers integrate it, so consecutive polls see values
+    that move the way a real meter's do.
+    """
+    def __init__(self, layout: str = 'default', seed: int = None, poll_rate: int = 0):
+        self.layout = LAYOUTS[layout]
+        # Advertised pollRate, readings only change this often if set
+        self.poll_rate = poll_rate
+        # {mr_id: (time generated, reading content)}
+        self.contents = {}
+        self.sw_ver = SW_VERSIONS[layout]
+        self.lfdi = '0123456789ABCDEF0123456789ABCDEF01234567'
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._last_update = time.time()
+        self.demand = 1200.0
+        self.received = 1_000_000.0
+        self.delivered = 5_000_000.0
+
+    def update(self) -> None:
+        with self._lock:
+            now = time.time()
+            elapsed = now - self._last_update
+            self._last_update = now
+            self.demand = max(-3000.0, min(9000.0, self.demand + self._random.gauss(0, 50)))
+            energy = self.demand * elapsed / 3600
+            if energy >= 0:
+                self.delivered += energy
+            else:
+                self.received -= energy
+
+    def tou_tier(self) -> int:
+        # Peak pricing in the afternoon and evening
+        hour = time.localtime().tm_hour
+        return 2 if 15 <= hour < 21 else 1
+
+    def value_for(self, mr_id: int) -> int:
+        if mr_id == 1:
+            return int(self.demand)
+        if mr_id == 2:
+            return int(self.received)
+        return int(self.delivered)
+
+
+def reading_content(state: MeterState, mr_id: int, has_tou: bool) -> str:
+    cached = state.contents.get(mr_id)
+    if cached is not None and time.time() - cached[0] < state.poll_rate:
+        return cached[1]
+    state.update()
+    tou = f'<touTier>{state.tou_tier()}</touTier>' if has_tou else ''
+    content = (f'<qualityFlags>01</qualityFlags>'
+               f'<timePeriod><duration>1</duration><start>{int(time.time())}</start></timePeriod>'
+               f'{tou}<value>{state.value_for(mr_id)}</value>')
+    if state.poll_rate:
+        state.contents[mr_id] = (time.time(), content)
+    return content
+
+
+def poll_rate_attribute(state: MeterState) -> str:
+    return f' pollRate="{state.poll_rate}"' if state.poll_rate else ''
+
+
+def reading_xml(state: MeterState, href: str, mr_id: int, has_tou: bool, subscribable: bool = False) -> str:
+    return (f'<Reading xmlns="{NS}" href="{href}" subscribable="{1 if subscribable else 0}"'
+            f'{poll_rate_attribute(state)}>{reading_content(state, mr_id, has_tou)}</Reading>')
+
+
+def notification_xml(state: MeterState, href: str, mr_id: int, has_tou: bool, subscription: str) -> str:
+    return (f'<Notification xmlns="{NS}" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+            f'<subscribedResource>{href}</subscribedResource>'
+            f'<Resource xsi:type="Reading" href="{href}">{reading_content(state, mr_id, has_tou)}</Resource>'
+            f'<status>0</status><subscriptionURI>{subscription}</subscriptionURI></Notification>')
+
+
+def build_resources(state: MeterState, subscribable: bool = False) -> dict:
+    """
+    Maps every static resource path to its XML body, and every reading
+    path to a callable producing a fresh body
+
+    Returns: dict, {<path>: str | callable}
+    """
+    resources = {
+        '/sdev/sdi': (f'<DeviceInformation xmlns="{NS}" href="/sdev/sdi">'
+                      f'<lFDI>{state.lfdi}</lFDI><mfDate>1600000000</mfDate>'
+                      f'<mfHwVer>1.0</mfHwVer><mfID>37384</mfID><mfModel>Gen5 Riva</mfModel>'
+                      f'<mfSerNum>0</mfSerNum><primaryPower>0</primaryPower>'
+                      f'<secondaryPower>0</secondaryPower><swActTime>1600000000</swActTime>'
+                      f'<swVer>{state.sw_ver}</swVer></DeviceInformation>'),
+        '/dcap': (f'<DeviceCapability xmlns="{NS}" href="/dcap" pollRate="900">'
+                  f'<TimeLink href="/tm"/><SelfDeviceLink href="/sdev"/>'
+                  f'<UsagePointListLink all="1" href="/upt"/></DeviceCapability>'),
+        '/upt': (f'<UsagePointList xmlns="{NS}" all="1" href="/upt" results="1" subscribable="0">'
+                 f'<UsagePoint href="/upt/1"><roleFlags>13</roleFlags><serviceCategoryKind>0</serviceCategoryKind>'
+                 f'<status>1</status><MeterReadingListLink all="{len(state.layout)}" href="/upt/1/mr"/>'
+                 f'</UsagePoint></UsagePointList>'),
+    }
+    # Meter lists its MeterReadings in descending order
+    meter_readings = ''.join(
+        f'<MeterReading href="/upt/1/mr/{mr_id}"><description>{description}</description>'
+        f'<ReadingLink href="{reading}"/><ReadingSetListLink all="1" href="/upt/1/mr/{mr_id}/rs"/>'
+        f'<ReadingTypeLink href="/rt/{rt_id}"/></MeterReading>'
+        for mr_id, description, rt_id, reading, _ in reversed(state.layout))
+    resources['/upt/1/mr'] = (f'<MeterReadingList xmlns="{NS}" all="{len(state.layout)}" href="/upt/1/mr" '
+                              f'results="{len(state.layout)}" subscribable="0"{poll_rate_attribute(state)}>'
+                              f'{meter_readings}</MeterReadingList>')
+    for rt_id, (accumulation, kind, uom, power) in READING_TYPES.items():
+        resources[f'/rt/{rt_id}'] = (f'<ReadingType xmlns="{NS}" href="/rt/{rt_id}">'
+                                     f'<accumulationBehaviour>{accumulation}</accumulationBehaviour>'
+                                     f'<commodity>1</commodity><dataQualifier>12</dataQualifier>'
+                                     f'<flowDirection>1</flowDirection><kind>{kind}</kind><phase>0</phase>'
+                                     f'<powerOfTenMultiplier>{power}</powerOfTenMultiplier><uom>{uom}</uom>'
+                                     f'</ReadingType>')
+    for mr_id, _, _, reading, has_tou in state.layout:
+        resources[reading] = (lambda href=reading, mr_id=mr_id, has_tou=has_tou:
+                              reading_xml(state, href, mr_id, has_tou, subscribable))
+    if subscribable:
+        resources['/sdev'] = (f'<EndDevice xmlns="{NS}" href="/sdev" subscribable="0">'
+                              f'<sFDI>0</sFDI><SubscriptionListLink href="/sdev/sub"/>'
+                              f'<lFDI>{state.lfdi}</lFDI></EndDevice>')
+
+    return resources
+
+
+def interval_value(state: MeterState, mr_id: int, start: int, now: float) -> int:
+    """
+    Value of an interval reading, registers are walked back from their
+    current value at a nominal 1 kW
+    """
+    if mr_id == 1:
+        return int(state.demand)
+    return int(state.value_for(mr_id) - 1000 * (now - start - INTERVAL) / 3600)
+
+
+def build_lists(state: MeterState) -> dict:
+    """
+    Maps the ReadingSet and Reading list paths to callables taking the
+    s= and l= paging parameters
+
+    Returns: dict, {<path>: callable(first, limit)}
+    """
+    def reading_sets(mr_id: int, first: int, limit: int) -> str:
+        today = int(time.time()) // DAY * DAY
+        sets = [(index + 1, today - index * DAY) for index in range(HISTORY_DAYS)]
+        page = ''.join(f'<ReadingSet href="/upt/1/mr/{mr_id}/rs/{set_id}"><description>Day</description>'
+                       f'<timePeriod><duration>{DAY}</duration><start>{start}</start></timePeriod>'
+                       f'<ReadingListLink all="{DAY // INTERVAL}" href="/upt/1/mr/{mr_id}/rs/{set_id}/r"/>'
+                       f'</ReadingSet>' for set_id, start in sets[first:first + limit])
+        return (f'<ReadingSetList xmlns="{NS}" all="{len(sets)}" href="/upt/1/mr/{mr_id}/rs" '
+                f'results="{len(sets[first:first + limit])}" subscribable="0">{page}</ReadingSetList>')
+
+    def readings(mr_id: int, set_id: int, first: int, limit: int) -> str:
+        now = time.time()
+        set_start = int(now) // DAY * DAY - (set_id - 1) * DAY
+        # Finished intervals of the day, newest first
+        starts = [start for start in range(set_start + DAY - INTERVAL, set_start - 1, -INTERVAL)
+                  if start + INTERVAL <= now]
+        page = ''.join(f'<Reading href="/upt/1/mr/{mr_id}/rs/{set_id}/r/{first + index + 2}">'
+                       f'<timePeriod><duration>{INTERVAL}</duration><start>{start}</start></timePeriod>'
+                       f'<value>{interval_value(state, mr_id, start, now)}</value></Reading>'
+                       for index, start in enumerate(starts[first:first + limit]))
+        return (f'<ReadingList xmlns="{NS}" all="{len(starts)}" href="/upt/1/mr/{mr_id}/rs/{set_id}/r" '
+                f'results="{len(starts[first:first + limit])}" subscribable="0">{page}</ReadingList>')
+
+    lists = {}
+    for mr_id, *_ in state.layout:
+        lists[f'/upt/1/mr/{mr_id}/rs'] = lambda first, limit, mr_id=mr_id: reading_sets(mr_id, first, limit)
+        for set_id in range(1, HISTORY_DAYS + 1):
+            lists[f'/upt/1/mr/{mr_id}/rs/{set_id}/r'] = (lambda first, limit, mr_id=mr_id, set_id=set_id:
+                                                          readings(mr_id, set_id, first, limit))
+
+    return lists
+
+
+class MeterRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        url = urlsplit(self.path)
+        path = url.path
+        server.count('requests')
+        if server.latency:
+            time.sleep(max(0.0, server.latency + server.random.uniform(-server.jitter, server.jitter)))
+        body = server.resources.get(path)
+        if path in server.lists:
+            query = parse_qs(url.query)
+            body = server.lists[path](int(query.get('s', [0])[0]), int(query.get('l', [255])[0]))
+        if path == '/sdev/sub' and server.subscriptions_enabled:
+            body = server.subscription_list_xml()
+        if callable(body):
+            body = body()
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/sep+xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server.count('requests')
+        if urlsplit(self.path).path != '/sdev/sub' or not server.subscriptions_enabled:
+            self.send_empty(404)
+            return
+        root = ET.fromstring(data)
+        location = server.add_subscription(root.findtext(f'{{{NS}}}subscribedResource'),
+                                           root.findtext(f'{{{NS}}}notificationURI'))
+        if location is None:
+            self.send_empty(400)
+            return
+        self.send_empty(201, {'Location': location})
+
+    def do_DELETE(self):
+        self.server.count('requests')
+        self.send_empty(204 if self.server.remove_subscription(urlsplit(self.path).path) else 404)
+
+    def send_empty(self, status: int, headers: dict = None) -> None:
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class MeterSimulator(ThreadingHTTPServer):
+    """
+    HTTPS server answering like a meter. TLS handshakes run in the
+    request threads so a slow handshake doesn't hold up the others.
+    """
+    daemon_threads = True
+
+    def __init__(self, address: tuple, cert: str, key: str, layout: str = 'default',
+                 latency: float = 0.0, jitter: float = 0.0, seed: int = None, verbose: bool = False,
+                 subscriptions: bool = False, notify_interval: float = 1.0, poll_rate: int = 0):
+        super().__init__(address, MeterRequestHandler)
+        self.state = MeterState(layout, seed, poll_rate)
+        self.subscriptions_enabled = subscriptions
+        self.notify_interval = notify_interval
+        self.resources = build_resources(self.state, subscriptions)
+        self.lists = build_lists(self.state)
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.verbose = verbose
+        self.stats = {'connections': 0, 'handshakes': 0, 'resumed': 0, 'requests': 0, 'notifications': 0}
+        self._stats_lock = threading.Lock()
+
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ssl_context.load_cert_chain(cert, key)
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+        # Notifications go out with the meter's certificate
+        self.client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.client_context.load_cert_chain(cert, key)
+        self.client_context.check_hostname = False
+        self.client_context.verify_mode = ssl.CERT_NONE
+        # {subscription path: (subscribed resource, notification uri)}
+        self.subscriptions = {}
+        self._next_subscription = 1
+        self._subscriptions_lock = threading.Lock()
+        self._notifier = None
+        self._thread = None
+
+    def add_subscription(self, resource: str, notification_uri: str) -> str | None:
+        readings = {reading: (mr_id, has_tou) for mr_id, _, _, reading, has_tou in self.state.layout}
+        if resource not in readings or not notification_uri:
+            return None
+        with self._subscriptions_lock:
+            path = f'/sdev/sub/{self._next_subscription}'
+            self._next_subscription += 1
+            self.subscriptions[path] = (resource, notification_uri)
+        if self._notifier is None:
+            self._notifier = threading.Thread(target=self.notify_forever, name='meter_notifier', daemon=True)
+            self._notifier.start()
+        return path
+
+    def remove_subscription(self, path: str) -> bool:
+        with self._subscriptions_lock:
+            return self.subscriptions.pop(path, None) is not None
+
+    def subscription_list_xml(self) -> str:
+        with self._subscriptions_lock:
+            subscriptions = list(self.subscriptions.items())
+        entries = ''.join(f'<Subscription href="{path}"><subscribedResource>{resource}</subscribedResource>'
+                          f'<encoding>0</encoding><level>+S1</level><limit>1</limit>'
+                          f'<notificationURI>{uri}</notificationURI></Subscription>'
+                          for path, (resource, uri) in subscriptions)
+        return (f'<SubscriptionList xmlns="{NS}" all="{len(subscriptions)}" href="/sdev/sub" '
+                f'results="{len(subscriptions)}">{entries}</SubscriptionList>')
+
+    def notify_forever(self) -> None:
+        readings = {reading: (mr_id, has_tou) for mr_id, _, _, reading, has_tou in self.state.layout}
+        while True:
+            time.sleep(self.notify_interval)
+            with self._subscriptions_lock:
+                subscriptions = list(self.subscriptions.items())
+            for path, (resource, uri) in subscriptions:
+                url = urlsplit(uri)
+                body = notification_xml(self.state, resource, *readings[resource], path).encode('utf-8')
+                try:
+                    connection = http.client.HTTPSConnection(url.hostname, url.port, context=self.client_context,
+                                                             timeout=5)
+                    connection.request('POST', url.path, body, {'Content-Type': 'application/sep+xml'})
+                    connection.getresponse().read()
+                    connection.close()
+                    self.count('notifications')
+                except (OSError, http.client.HTTPException):
+                    pass
+
+    def count(self, name: str) -> None:
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def get_request(self):
+        sock, address = self.socket.accept()
+        self.count('connections')
+        return self.ssl_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False), address
+
+    def finish_request(self, request, client_address):
+        try:
+            request.do_handshake()
+        except (ssl.SSLError, OSError):
+            return
+        self.count('handshakes')
+        if request.session_reused:
+            self.count('resumed')
+        super().finish_request(request, client_address)
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.serve_forever, name='meter_simulator', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated IEEE 2030.5 meter for local testing')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--cert', default='certs/.cert.pem', help='Server certificate')
+    parser.add_argument('--key', default='certs/.key.pem', help='Server key')
+    parser.add_argument('--layout', choices=sorted(LAYOUTS), default='default',
+                        help='Firmware layout to emulate')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random +/- seconds added to the latency')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--subscriptions', action='store_true', help='Let the readings be subscribed to')
+    parser.add_argument('--notify-interval', type=float, default=1.0,
+                        help='Seconds between notifications to subscribers')
+    parser.add_argument('--poll-rate', type=int, default=0,
+                        help='pollRate advertised for the readings, which only change this often. 0 leaves it out')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    simulator = MeterSimulator((args.host, args.port), args.cert, args.key, args.layout,
+                               args.latency, args.jitter, args.seed, args.verbose,
+                               args.subscriptions, args.notify_interval, args.poll_rate)
+    print(f'Simulated meter listening on https://{args.host}:{simulator.port}', flush=True)
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.server_close()
+        print(simulator.stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+"""
+Minimal MQTT 3.1.1 broker for local testing. Handles just enough of the
+protocol for the bridge (CONNECT with a last will, PUBLISH at QoS 0/1,
+SUBSCRIBE, PING, DISCONNECT), keeps retained messages and records the
+arrival time of every publish so benchmarks can measure delivery latency.
+
+Usage: python mqttStandIn.py --port 1883
+"""
+import time
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+from collections import namedtuple
+
+Message = namedtuple('Message', ['received', 'topic', 'payload', 'retain'])
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels) or (level != '+' and level != topic_levels[i]):
+            return False
+
+    return len(filter_levels) == len(topic_levels)
+
+
+def encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | (0x80 if length else 0))
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value: str) -> bytes:
+    data = value.encode('utf-8')
+    return struct.pack('!H', len(data)) + data
+
+
+def publish_packet(topic: str, payload: bytes, retain: bool) -> bytes:
+    body = encode_string(topic) + payload
+    return bytes([(PUBLISH << 4) | (1 if retain else 0)]) + encode_length(len(body)) + body
+
+
+class MqttClientHandler(socketserver.BaseRequestHandler):
+
+    def read_exactly(self, count: int) -> bytes:
+        data = bytearray()
+        while len(data) < count:
+            chunk = self.request.recv(count - len(data))
+            if not chunk:
+                raise ConnectionError('Client went away')
+            data.extend(chunk)
+        return bytes(data)
+
+    def read_packet(self) -> tuple:
+        header = self.read_exactly(1)[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = self.read_exactly(1)[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header >> 4, header & 0x0F, self.read_exactly(length)
+
+    def send(self, data: bytes) -> None:
+        with self.send_lock:
+            self.request.sendall(data)
+
+    @staticmethod
+    def read_will(body: bytes) -> tuple | None:
+        """
+        Returns: tuple of the will's (topic, payload, retain), or None
+        """
+        offset = 2 + struct.unpack('!H', body[:2])[0] + 1
+        connect_flags = body[offset]
+        if not connect_flags & 0x04:
+            return None
+        # Skip the connect flags, keep alive and client id
+        offset += 3
+        offset += 2 + struct.unpack('!H', body[offset:offset + 2])[0]
+        values = []
+        for _ in range(2):
+            length = struct.unpack('!H', body[offset:offset + 2])[0]
+            values.append(body[offset + 2:offset + 2 + length])
+            offset += 2 + length
+        return values[0].decode('utf-8'), values[1], bool(connect_flags & 0x20)
+
+    def handle(self):
+        broker = self.server
+        self.send_lock = threading.Lock()
+        self.subscriptions = set()
+        will = None
+        broker.add_client(self)
+        try:
+            while True:
+                packet_type, flags, body = self.read_packet()
+                if packet_type == CONNECT:
+                    will = self.read_will(body)
+                    self.send(bytes([CONNACK << 4, 2, 0, 0]))
+                elif packet_type == PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    topic_length = struct.unpack('!H', body[:2])[0]
+                    topic = body[2:2 + topic_length].decode('utf-8')
+                    offset = 2 + topic_length
+                    if qos:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                        self.send(bytes([PUBACK << 4, 2]) + packet_id)
+                    broker.on_publish(topic, body[offset:], bool(flags & 0x01))
+                elif packet_type == SUBSCRIBE:
+                    packet_id, offset, granted = body[:2], 2, bytearray()
+                    filters = []
+                    while offset < len(body):
+                        length = struct.unpack('!H', body[offset:offset + 2])[0]
+                        filters.append(body[offset + 2:offset + 2 + length].decode('utf-8'))
+                        offset += 3 + length
+                        granted.append(0)
+                    self.subscriptions.update(filters)
+                    payload = packet_id + bytes(granted)
+                    self.send(bytes([SUBACK << 4]) + encode_length(len(payload)) + payload)
+                    for topic_filter in filters:
+                        for topic, payload in broker.retained_matching(topic_filter):
+                            self.send(publish_packet(topic, payload, True))
+                elif packet_type == UNSUBSCRIBE:
+                    offset = 2
+                    while offset < len(body):
+                        length = struct.unpack('!H', body[offset:offset + 2])[0]
+                        self.subscriptions.discard(body[offset + 2:offset + 2 + length].decode('utf-8'))
+                        offset += 2 + length
+                    self.send(bytes([UNSUBACK << 4, 2]) + body[:2])
+                elif packet_type == PINGREQ:
+                    self.send(bytes([PINGRESP << 4, 0]))
+                elif packet_type == DISCONNECT:
+                    # A clean disconnect discards the will
+                    will = None
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            broker.remove_client(self)
+            if will is not None:
+                broker.on_publish(*will)
+
+
+class MqttStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: tuple = ('127.0.0.1', 0), keep_messages: bool = True):
+        super().__init__(address, MqttClientHandler)
+        self.keep_messages = keep_messages
+        self.messages = []
+        self.retained = {}
+        self.published = 0
+        self._clients = set()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def add_client(self, client) -> None:
+        with self._condition:
+            self._clients.add(client)
+
+    def remove_client(self, client) -> None:
+        with self._condition:
+            self._clients.discard(client)
+
+    def on_publish(self, topic: str, payload: bytes, retain: bool) -> None:
+        with self._condition:
+            self.published += 1
+            if self.keep_messages:
+                self.messages.append(Message(time.monotonic(), topic, payload, retain))
+            if retain:
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+            subscribers = [c for c in self._clients
+                           if any(topic_matches(f, topic) for f in c.subscriptions)]
+            self._condition.notify_all()
+        for client in subscribers:
+            try:
+                client.send(publish_packet(topic, payload, False))
+            except OSError:
+                pass
+
+    def retained_matching(self, topic_filter: str) -> list:
+        with self._condition:
+            return [(t, p) for t, p in self.retained.items() if topic_matches(topic_filter, t)]
+
+    def wait_for(self, topic: str, after: float, timeout: float = 10.0) -> Message | None:
+        """
+        Waits for a publish to the topic that arrived after the given
+        monotonic time
+
+        Returns: Message or None on timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                for message in reversed(self.messages):
+                    if message.received < after:
+                        break
+                    if message.topic == topic:
+                        return message
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def clear(self) -> None:
+        with self._condition:
+            self.messages.clear()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.serve_forever, name='mqtt_stand_in', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        with self._condition:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Minimal MQTT broker for local testing')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print every publish')
+    args = parser.parse_args()
+
+    broker = MqttStandIn((args.host, args.port), keep_messages=args.verbose)
+    if args.verbose:
+        on_publish = broker.on_publish
+        def print_publish(topic, payload, retain):
+            print(f'{topic}: {payload.decode("utf-8", "replace")}', flush=True)
+            on_publish(topic, payload, retain)
+        broker.on_publish = print_publish
+    print(f'MQTT stand-in listening on {args.host}:{broker.port}', flush=True)
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.server_close()
+        print(f'{broker.published} messages published')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The bridge's modules import each other by their flat names
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'xcel_itron2mqtt'))
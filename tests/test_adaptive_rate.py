@@ -0,0 +1,44 @@
+import pytest
+from xcelAdaptiveRate import xcelAdaptiveRate
+
+
+def test_initial_period_is_clamped():
+    assert xcelAdaptiveRate(1, 5, 60).period == 5
+    assert xcelAdaptiveRate(100, 5, 60).period == 60
+
+
+def test_unchanging_reading_backs_off_to_max_period():
+    rate = xcelAdaptiveRate(5, 5, 60)
+    periods = [rate.update(False, 0.1) for _ in range(50)]
+    assert periods == sorted(periods)
+    assert periods[-1] == 60
+
+
+def test_changing_reading_speeds_up_to_min_period():
+    rate = xcelAdaptiveRate(60, 5, 60)
+    periods = [rate.update(True, 0.1) for _ in range(50)]
+    assert periods == sorted(periods, reverse=True)
+    assert periods[-1] == 5
+
+
+def test_each_step_is_bounded():
+    rate = xcelAdaptiveRate(20, 1, 1000, speed_up=0.5, slow_down=1.25)
+    period = rate.period
+    for changed in [True] * 5 + [False] * 10 + [True] * 5:
+        new_period = rate.update(changed, 0.01)
+        assert period * 0.5 <= new_period <= period * 1.25
+        period = new_period
+
+
+def test_converges_on_polls_per_change():
+    rate = xcelAdaptiveRate(10, 1, 1000, smoothing=0.05, polls_per_change=2.0)
+    # The reading changes every 4th poll, half as often as wanted
+    for i in range(400):
+        rate.update(i % 4 == 0, 0.01)
+    assert rate.change_rate == pytest.approx(0.25, abs=0.05)
+    assert 1 / (rate.change_rate * rate.polls_per_change) == pytest.approx(2.0, abs=0.5)
+
+
+def test_slow_meter_is_backed_off():
+    rate = xcelAdaptiveRate(5, 5, 60, latency_factor=4.0)
+    assert rate.update(True, 3.0) == 12
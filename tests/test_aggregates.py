@@ -0,0 +1,73 @@
+from datetime import datetime
+import yaml
+from xcelAggregates import xcelAggregates, ENERGY
+
+
+class FakeDecoder():
+    exponent = 0
+
+
+class FakeEndpoint():
+    def __init__(self, name: str):
+        self.name = name
+        self.decoder = FakeDecoder()
+
+
+class FakeRollupEndpoint():
+    """
+    Publishes like xcelEndpoint.process_send_mqtt does, failing on a
+    sensor that has no state topic
+    """
+    def __init__(self, tags: dict):
+        self.tags = tags
+        self._sensor_state_topics = {sensor: f'rollup/{sensor}/state' for sensor in tags}
+        self.published = []
+
+    def build_config(self, sensor_name: str, details: dict) -> tuple:
+        self._sensor_state_topics[sensor_name] = f'rollup/{sensor_name}/state'
+        return f'rollup/{sensor_name}/config', {'state_topic': self._sensor_state_topics[sensor_name]}
+
+    def send_configs(self, configs: dict) -> None:
+        pass
+
+    def process_send_mqtt(self, sensors: dict) -> None:
+        self.published.append({self._sensor_state_topics[sensor]: value for sensor, value in sensors.items()})
+
+
+def reading(hour: int, minute: int, value: float, tier: int = None) -> dict:
+    reading = {'value': value, 'timePeriodstart': int(datetime(2026, 1, 1, hour, minute).timestamp())}
+    if tier is not None:
+        reading['touTier'] = tier
+    return reading
+
+
+def setup(tmp_path, **kwargs):
+    aggregates = xcelAggregates(tmp_path / 'aggregates.yaml', **kwargs)
+    endpoint = FakeEndpoint('Current Summation Delivered')
+    rollup_endpoint = FakeRollupEndpoint(aggregates.get_tags(endpoint.name, ENERGY, 'Wh'))
+    aggregates.register(endpoint, rollup_endpoint, ENERGY)
+    return aggregates, endpoint, rollup_endpoint
+
+
+def test_tier_first_seen_between_publishes_is_set_up_before_the_rollover(tmp_path):
+    aggregates, endpoint, rollup_endpoint = setup(tmp_path, publish_interval=3600)
+    aggregates.observe(endpoint, reading(10, 0, 1000))
+    # A new tier shows up in a reading that doesn't get published
+    aggregates.observe(endpoint, reading(10, 30, 1100, tier=2))
+    assert len(rollup_endpoint.published) == 1
+    aggregates.observe(endpoint, reading(11, 0, 1200, tier=2))
+    closing, current = rollup_endpoint.published[1:]
+    assert closing['rollup/Hour/state'] == 100
+    assert closing['rollup/Tier2/state'] == 100
+    assert current['rollup/Hour/state'] == 100
+
+
+def test_state_is_written_at_most_every_flush_interval(tmp_path):
+    aggregates, endpoint, _ = setup(tmp_path, publish_interval=0, flush_interval=3600)
+    aggregates.observe(endpoint, reading(10, 0, 1000))
+    aggregates.observe(endpoint, reading(10, 5, 1050))
+    assert not (tmp_path / 'aggregates.yaml').exists()
+    # The end of a period is always written
+    aggregates.observe(endpoint, reading(11, 0, 1100))
+    state = yaml.safe_load((tmp_path / 'aggregates.yaml').read_text())
+    assert state[endpoint.name]['last_value'] == 1100
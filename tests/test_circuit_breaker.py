@@ -0,0 +1,111 @@
+import pytest
+import xcelCircuitBreaker
+from xcelCircuitBreaker import xcelCircuitBreaker as CircuitBreaker, xcelRetryBudget, CLOSED, OPEN, HALF_OPEN
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(xcelCircuitBreaker, 'monotonic', clock)
+    return clock
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+
+
+def test_opens_after_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10)
+    assert breaker.record_failure() == CLOSED
+    assert breaker.record_failure() == CLOSED
+    assert breaker.record_failure() == OPEN
+    assert not breaker.allow()
+    assert breaker.time_until_probe() == 10
+
+
+def test_success_resets_the_failure_count(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+    breaker.record_failure()
+    breaker.record_success()
+    assert breaker.record_failure() == CLOSED
+
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    open_breaker(breaker)
+    clock.now += 10
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    assert breaker.time_until_probe() == 10
+
+
+def test_successful_probe_closes(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    open_breaker(breaker)
+    clock.now += 10
+    breaker.allow()
+    assert breaker.record_success() == HALF_OPEN
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+    assert breaker.time_until_probe() == 0
+
+
+def test_failed_probe_reopens_for_longer(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, max_reset_timeout=15)
+    open_breaker(breaker)
+    clock.now += 10
+    breaker.allow()
+    assert breaker.record_failure() == OPEN
+    assert breaker.time_until_probe() == 15
+    clock.now += 15
+    breaker.allow()
+    breaker.record_failure()
+    # Capped at max_reset_timeout
+    assert breaker.time_until_probe() == 15
+    breaker.record_success()
+    assert breaker.reset_timeout == 10
+
+
+def test_lost_probe_is_given_up_on(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    open_breaker(breaker)
+    clock.now += 10
+    assert breaker.allow()
+    clock.now += 9
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+
+
+def test_retry_delay_backs_off(clock):
+    breaker = CircuitBreaker(retry_delay=1.0)
+    assert 0.5 <= breaker.retry_delay() <= 1.0
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert 2.0 <= breaker.retry_delay() <= 4.0
+
+
+def test_retry_budget(clock):
+    budget = xcelRetryBudget(ratio=0.5, min_rate=0.1, max_tokens=2)
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw()
+    clock.now += 10
+    assert budget.tokens == pytest.approx(1.0)
+    clock.now += 1000
+    assert budget.tokens == 2
@@ -0,0 +1,68 @@
+import xcelHistory as history_module
+from xcelHistory import xcelSensorHistory, xcelHistory
+
+
+def test_query_before_wrap():
+    history = xcelSensorHistory(4)
+    for t in (10, 20, 30):
+        assert history.append(t, t / 10)
+    timestamps, values = history.query()
+    assert list(timestamps) == [10, 20, 30]
+    assert list(values) == [1.0, 2.0, 3.0]
+
+
+def test_wrap_keeps_newest():
+    history = xcelSensorHistory(3)
+    for t in range(1, 8):
+        history.append(t, float(t))
+    assert len(history) == 3
+    assert list(history.query()[0]) == [5, 6, 7]
+
+
+def test_repeated_timestamp_is_skipped():
+    history = xcelSensorHistory(3)
+    assert history.append(10, 1.0)
+    assert not history.append(10, 2.0)
+    assert list(history.query()[1]) == [1.0]
+
+
+def test_query_range_across_wrap():
+    history = xcelSensorHistory(4)
+    for t in range(0, 100, 10):
+        history.append(t, float(t))
+    assert list(history.query()[0]) == [60, 70, 80, 90]
+    assert list(history.query(65, 80)[0]) == [70, 80]
+    assert list(history.query(start=85)[0]) == [90]
+    assert list(history.query(end=60)[0]) == [60]
+    assert list(history.query(100, 200)[0]) == []
+
+
+def test_older_sample_is_dropped():
+    history = xcelSensorHistory(4)
+    history.append(20, 2.0)
+    assert not history.append(10, 1.0)
+    assert history.append(30, 3.0)
+    assert list(history.query()[0]) == [20, 30]
+
+
+def test_out_of_range_timestamps_do_not_raise(monkeypatch):
+    monkeypatch.setattr(history_module, 'time', lambda: 1700000000.5)
+    history = xcelHistory(8)
+    history.record('meter', 'endpoint', {'Timestamp': -5, 'value': 1})
+    history.record('meter', 'endpoint', {'Timestamp': 'inf', 'value': 2})
+    history.record('meter', 'endpoint', {'Timestamp': 1e30, 'value': 3})
+    history.record('meter', 'endpoint', {'Timestamp': 2**33, 'value': 4})
+    # Falls back to the poll time, which is older than the last sample
+    history.record('meter', 'endpoint', {'Timestamp': None, 'value': 5})
+    [(_, _, _, timestamps, values)] = history.query(sensor='value')
+    # Timestamps that don't fit fall back to the poll time, the second one is a repeat
+    assert list(timestamps) == [-5, 1700000000, 2**33]
+    assert list(values) == [1.0, 2.0, 4.0]
+    [(_, _, _, timestamps, _)] = history.query(sensor='value', start=0, end=2**32)
+    assert list(timestamps) == [1700000000]
+
+
+def test_record_skips_timestamp_and_non_numeric():
+    history = xcelHistory(8)
+    history.record('meter', 'endpoint', {'Timestamp': 100, 'value': '5', 'name': 'text'})
+    assert history.series() == [('meter', 'endpoint', 'value')]
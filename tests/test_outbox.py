@@ -0,0 +1,149 @@
+import json
+import paho.mqtt.client as mqtt
+import pytest
+import xcelOutbox as outbox_module
+from xcelOutbox import xcelOutbox, HEADER, MAGIC
+
+
+class FakeClient():
+    def __init__(self, fail_after: int = None):
+        self.published = []
+        self.fail_after = fail_after
+
+    def is_connected(self) -> bool:
+        return True
+
+    def publish(self, topic, payload, retain=False):
+        if self.fail_after is not None and len(self.published) >= self.fail_after:
+            return (mqtt.MQTT_ERR_NO_CONN, None)
+        self.published.append((topic, payload, retain))
+        return (mqtt.MQTT_ERR_SUCCESS, len(self.published))
+
+
+def fill(outbox, count):
+    for i in range(count):
+        outbox.put(f'topic/{i}', str(i), retain=bool(i % 2), timestamp=float(i))
+
+
+def state_messages(client):
+    return [message for message in client.published if not message[0].endswith('/replayed')]
+
+
+def payloads(outbox):
+    return [payload for _, _, payload, _ in outbox.peek(outbox.capacity)]
+
+
+def test_put_and_peek_keep_order(tmp_path):
+    outbox = xcelOutbox(tmp_path / 'outbox.ring', capacity=4, slot_size=64)
+    fill(outbox, 3)
+    assert len(outbox) == 3
+    assert outbox.peek(2) == [(0.0, 'topic/0', '0', False), (1.0, 'topic/1', '1', True)]
+
+
+def test_drop_oldest_wraps(tmp_path):
+    outbox = xcelOutbox(tmp_path / 'outbox.ring', capacity=3, slot_size=64)
+    fill(outbox, 5)
+    assert payloads(outbox) == ['2', '3', '4']
+    assert outbox.dropped == 2
+
+
+def test_drop_newest_refuses(tmp_path):
+    outbox = xcelOutbox(tmp_path / 'outbox.ring', capacity=3, slot_size=64, overflow='drop_newest')
+    fill(outbox, 3)
+    assert not outbox.put('topic/3', '3')
+    assert payloads(outbox) == ['0', '1', '2']
+    assert outbox.dropped == 1
+
+
+def test_unknown_overflow_policy(tmp_path):
+    with pytest.raises(ValueError):
+        xcelOutbox(tmp_path / 'outbox.ring', overflow='drop_everything')
+
+
+def test_oversized_message_is_dropped(tmp_path):
+    outbox = xcelOutbox(tmp_path / 'outbox.ring', capacity=3, slot_size=32)
+    assert not outbox.put('topic', 'x' * 32)
+    assert len(outbox) == 0
+
+
+def test_replay_publishes_in_order_across_the_wrap(tmp_path):
+    outbox = xcelOutbox(tmp_path / 'outbox.ring', capacity=4, slot_size=64, replay_batch=3)
+    fill(outbox, 6)
+    client = FakeClient()
+    assert outbox.replay(client) == 4
+    assert state_messages(client) == [('topic/2', '2', False), ('topic/3', '3', True),
+                                 ('topic/4', '4', False), ('topic/5', '5', True)]
+    assert len(outbox) == 0
+
+
+def test_replay_keeps_what_was_not_sent(tmp_path):
+    outbox = xcelOutbox(tmp_path / 'outbox.ring', capacity=4, slot_size=64)
+    fill(outbox, 4)
+    # The first reading and its time, then the second reading
+    assert outbox.replay(FakeClient(fail_after=3)) == 2
+    assert payloads(outbox) == ['2', '3']
+
+
+def test_replay_publishes_reading_times(tmp_path):
+    outbox = xcelOutbox(tmp_path / 'outbox.ring', capacity=4, slot_size=64)
+    outbox.put('meter/power/state', '1200', timestamp=1700000000.0)
+    outbox.put('meter/config', '{}', retain=True, timestamp=1700000001.0)
+    outbox.put('meter/power/state', '1300', timestamp=1700000005.0)
+    client = FakeClient()
+    assert outbox.replay(client) == 3
+    assert [topic for topic, _, _ in client.published] == [
+        'meter/power/state', 'meter/power/state/replayed', 'meter/config',
+        'meter/power/state', 'meter/power/state/replayed']
+    assert json.loads(client.published[1][1]) == {'Timestamp': 1700000000, 'value': '1200'}
+    assert json.loads(client.published[4][1]) == {'Timestamp': 1700000005, 'value': '1300'}
+
+
+def test_queue_time_is_used_without_a_reading_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(outbox_module, 'time', lambda: 1700000042.0)
+    outbox = xcelOutbox(tmp_path / 'outbox.ring', capacity=4, slot_size=64)
+    outbox.put('meter/power/state', '1200')
+    assert outbox.peek(1)[0][0] == 1700000042.0
+
+
+def test_survives_reopen(tmp_path):
+    path = tmp_path / 'outbox.ring'
+    outbox = xcelOutbox(path, capacity=3, slot_size=64)
+    fill(outbox, 4)
+    outbox.discard(1)
+    outbox.close()
+    outbox = xcelOutbox(path, capacity=3, slot_size=64)
+    assert payloads(outbox) == ['2', '3']
+    assert outbox.dropped == 1
+
+
+def test_layout_change_discards_the_ring(tmp_path):
+    path = tmp_path / 'outbox.ring'
+    outbox = xcelOutbox(path, capacity=3, slot_size=64)
+    fill(outbox, 2)
+    outbox.close()
+    outbox = xcelOutbox(path, capacity=5, slot_size=64)
+    assert len(outbox) == 0
+    fill(outbox, 5)
+    assert payloads(outbox) == ['0', '1', '2', '3', '4']
+
+
+def test_corrupt_header_discards_the_ring(tmp_path):
+    path = tmp_path / 'outbox.ring'
+    outbox = xcelOutbox(path, capacity=3, slot_size=64)
+    fill(outbox, 2)
+    outbox.close()
+    with open(path, 'r+b') as file:
+        file.write(b'garbage!')
+    outbox = xcelOutbox(path, capacity=3, slot_size=64)
+    assert len(outbox) == 0
+    assert HEADER.unpack_from(path.read_bytes(), 0)[0] == MAGIC
+
+
+def test_truncated_file_discards_the_ring(tmp_path):
+    path = tmp_path / 'outbox.ring'
+    outbox = xcelOutbox(path, capacity=3, slot_size=64)
+    fill(outbox, 2)
+    outbox.close()
+    with open(path, 'r+b') as file:
+        file.truncate(100)
+    assert len(xcelOutbox(path, capacity=3, slot_size=64)) == 0
@@ -0,0 +1,42 @@
+from xcelPublishFilter import xcelPublishFilter
+
+
+def test_unchanged_value_is_suppressed_until_max_age():
+    publish_filter = xcelPublishFilter(max_age=60)
+    assert publish_filter.should_publish('value', 5, now=0)
+    assert not publish_filter.should_publish('value', 5, now=30)
+    assert publish_filter.should_publish('value', 5, now=60)
+    assert (publish_filter.published, publish_filter.suppressed) == (2, 1)
+
+
+def test_deadband_only_applies_to_value():
+    publish_filter = xcelPublishFilter(deadband=10)
+    publish_filter.should_publish('value', 100, now=0)
+    publish_filter.should_publish('touTier', 1, now=0)
+    assert not publish_filter.should_publish('value', 105, now=1)
+    assert publish_filter.should_publish('value', 111, now=2)
+    assert publish_filter.should_publish('touTier', 2, now=3)
+
+
+def test_document_is_decided_once():
+    publish_filter = xcelPublishFilter(max_age=60)
+    assert publish_filter.should_publish_all({'value': 5, 'touTier': 1}, now=0)
+    assert not publish_filter.should_publish_all({'value': 5, 'touTier': 1}, now=10)
+    # One sensor changed, the whole document goes out and counts once
+    assert publish_filter.should_publish_all({'value': 6, 'touTier': 1}, now=50)
+    assert (publish_filter.published, publish_filter.suppressed) == (2, 1)
+
+
+def test_document_refreshes_every_sensor():
+    publish_filter = xcelPublishFilter(max_age=60)
+    publish_filter.should_publish_all({'value': 5, 'touTier': 1}, now=0)
+    publish_filter.should_publish_all({'value': 6, 'touTier': 1}, now=50)
+    # touTier went out with the document at 50, so it isn't due for a heartbeat at 70
+    assert not publish_filter.should_publish_all({'value': 6, 'touTier': 1}, now=70)
+    assert publish_filter.should_publish_all({'value': 6, 'touTier': 1}, now=110)
+
+
+def test_everything_is_published_when_not_suppressing():
+    publish_filter = xcelPublishFilter(suppress_unchanged=False)
+    assert publish_filter.should_publish_all({'value': 5}, now=0)
+    assert publish_filter.should_publish_all({'value': 5}, now=1)
@@ -1,4 +1,5 @@
 import ssl
+import threading
 import requests
 from requests.packages.urllib3.util.ssl_ import create_urllib3_context
 from requests.adapters import HTTPAdapter
@@ -6,6 +7,32 @@ from requests.adapters import HTTPAdapter
 # Our target cipher is: ECDHE-ECDSA-AES128-CCM8
 CIPHERS = ('ECDHE')
 
+class ResumableSSLContext(ssl.SSLContext):
+    """
+    SSLContext that remembers the last TLS session it negotiated and
+    offers it on the next connection, so reconnecting to the meter can
+    skip the full ECDHE handshake.
+    """
+    def __init__(self, protocol):
+        self._tls_session = None
+        self._session_lock = threading.Lock()
+        self.handshakes = 0
+        self.resumed_handshakes = 0
+
+    def wrap_socket(self, sock, *args, session=None, **kwargs):
+        with self._session_lock:
+            if session is None:
+                session = self._tls_session
+        ssl_sock = super().wrap_socket(sock, *args, session=session, **kwargs)
+        with self._session_lock:
+            self.handshakes += 1
+            if ssl_sock.session_reused:
+                self.resumed_handshakes += 1
+            if ssl_sock.session is not None:
+                self._tls_session = ssl_sock.session
+
+        return ssl_sock
+
 # Create an adapter for our request to enable the non-standard cipher
 # From https://lukasa.co.uk/2017/02/Configuring_TLS_With_Requests/
 class CCM8Adapter(HTTPAdapter):
@@ -13,17 +40,49 @@ class CCM8Adapter(HTTPAdapter):
     A TransportAdapter that re-enables ECDHE support in Requests.
     Not really sure how much redundancy is actually required here
     """
+    def __init__(self, *args, **kwargs):
+        # Built once and shared by every pooled connection
+        self.ssl_context = self.create_ssl_context()
+        self._requests_lock = threading.Lock()
+        self.requests = 0
+        super(CCM8Adapter, self).__init__(*args, **kwargs)
+
     def init_poolmanager(self, *args, **kwargs):
-        kwargs['ssl_context'] = self.create_ssl_context()
+        kwargs['ssl_context'] = self.ssl_context
         return super(CCM8Adapter, self).init_poolmanager(*args, **kwargs)
 
     def proxy_manager_for(self, *args, **kwargs):
-        kwargs['ssl_context'] = self.create_ssl_context()
+        kwargs['ssl_context'] = self.ssl_context
         return super(CCM8Adapter, self).proxy_manager_for(*args, **kwargs)
 
+    def send(self, *args, **kwargs):
+        with self._requests_lock:
+            self.requests += 1
+        return super(CCM8Adapter, self).send(*args, **kwargs)
+
+    def get_stats(self) -> dict:
+        """
+        Connection counters for the adapter. Every request that didn't
+        need a handshake went over an already open connection.
+
+        Returns: dict
+        """
+        handshakes = self.ssl_context.handshakes
+        resumed = self.ssl_context.resumed_handshakes
+        return {
+            'requests': self.requests,
+            'full_handshakes': handshakes - resumed,
+            'resumed_handshakes': resumed,
+            'reused_connections': max(0, self.requests - handshakes),
+        }
+
     def create_ssl_context(self):
         ssl_version=ssl.PROTOCOL_TLSv1_2
-        context = create_urllib3_context(ssl_version=ssl_version)
+        # Start from urllib3's defaults but allow session tickets so
+        # reconnects can be resumed
+        defaults = create_urllib3_context(ssl_version=ssl_version)
+        context = ResumableSSLContext(ssl_version)
+        context.options = defaults.options & ~ssl.OP_NO_TICKET
         context.check_hostname = False
         context.verify_mode = ssl.CERT_REQUIRED
         context.set_ciphers(CIPHERS)
@@ -7,7 +7,9 @@ import requests
 import logging
 import xml.etree.ElementTree as ET
 from time import sleep
-from typing import Tuple
+from copy import deepcopy
+from typing import Tuple, Callable
+from concurrent.futures import ThreadPoolExecutor
 #from requests.packages.urllib3.util.ssl_ import create_urllib3_context
 #from requests.adapters import HTTPAdapter
 from tenacity import retry, stop_after_attempt, before_sleep_log, wait_exponential
@@ -23,14 +25,19 @@ logger = logging.getLogger(__name__)
 
 class generateEndpointYaml():
 
-    def __init__(self, name: str, ip_address: str, port: int, creds: Tuple[str, str]):
+    def __init__(self, name: str, ip_address: str, port: int, creds: Tuple[str, str],
+                    session: requests.Session = None):
         self.name = name
-        self.POLLING_RATE = 5.0
+        self.POLLING_RATE = float(os.getenv('POLLING_RATE', 5.0))
         # Base URL used to query the meter
         self.url = f'https://{ip_address}:{port}'
+        # Upper limit on discovery requests in flight at once, the meter is easily overwhelmed
+        self.discovery_workers = int(os.getenv('DISCOVERY_WORKERS', 4))
 
-        # Create a new requests session based on the passed in ip address and port #
-        self.requests_session = self.setup_session(creds, ip_address)
+        # Reuse the meter's session if we were given one so discovery doesn't
+        # need its own TLS handshake, otherwise create a new requests session
+        # based on the passed in ip address and port #
+        self.requests_session = session if session else self.setup_session(creds, ip_address)
 
         # Set to uninitialized
         self.initalized = False
@@ -115,16 +122,15 @@ class generateEndpointYaml():
         # Parse the response xml looking for the passed in element names
         root = ET.fromstring(x.text)
         #print(root.iterfind(f'.//{IEEE_PREFIX}MeterReading'))
-        meter_endpoint_info_dict = {}
         meter_reading_list = []
+        # A pollRate on the list applies to every MeterReading that doesn't set its own
+        list_poll_rate = xcelEndpoint.get_poll_rate(root)
 
-        #for meterReading in root.iter(f'.//{IEEE_PREFIX}MeterReading'):
+        meter_readings = []
         for meterReading in root.findall(f'.//{IEEE_PREFIX}MeterReading'):
             meter_endpoint_info_dict = { "MeterReading" : { } }
 
             for child in meterReading.iter():
-                #print('childMeterReading',child.tag,child.text, child.attrib)
-                #print(child.tag)
                 match child.tag.removeprefix(IEEE_PREFIX):
                     case 'description' :
                         meter_endpoint_info_dict['MeterReading']['Description'] = child.text
@@ -136,22 +142,51 @@ class generateEndpointYaml():
                         meter_endpoint_info_dict['MeterReading']['ReadingTypeLink'] = child.get('href')
 
             meter_endpoint_info_dict['MeterReading']['Description'] = meter_endpoint_info_dict['MeterReading']['Description'].replace('TOU','Time-Of-Use')
-
-            meter_endpoint_info_dict.update(self.get_meter_endpoint_type_details(meter_endpoint_info_dict['MeterReading']['ReadingTypeLink']))
-            
+            poll_rate = xcelEndpoint.get_poll_rate(meterReading) or list_poll_rate
+            if poll_rate:
+                meter_endpoint_info_dict['MeterReading']['pollRate'] = poll_rate
+            meter_readings.append(meter_endpoint_info_dict)
+
+        # Several MeterReadings share a ReadingType, only fetch each one once
+        reading_types = self.fetch_unique(self.get_meter_endpoint_type_details,
+                            [mr['MeterReading']['ReadingTypeLink'] for mr in meter_readings])
+        supported_readings = []
+        for meter_endpoint_info_dict in meter_readings:
+            meter_endpoint_info_dict.update(deepcopy(reading_types[meter_endpoint_info_dict['MeterReading']['ReadingTypeLink']]))
             if self.is_endpoint_reading_type_supported(meter_endpoint_info_dict):
-                meter_endpoint_info_dict.update(self.get_meter_endpoint_reading(meter_endpoint_info_dict['MeterReading']['ReadingLink']))
-            
-                meter_reading_list.append(
-                    meter_endpoint_info_dict
-                )                
-        
+                supported_readings.append(meter_endpoint_info_dict)
+
+        # Then the latest Reading of every supported MeterReading
+        readings = self.fetch_unique(self.get_meter_endpoint_reading,
+                            [mr['MeterReading']['ReadingLink'] for mr in supported_readings])
+        for meter_endpoint_info_dict in supported_readings:
+            meter_endpoint_info_dict.update(deepcopy(readings[meter_endpoint_info_dict['MeterReading']['ReadingLink']]))
+            meter_reading_list.append(
+                meter_endpoint_info_dict
+            )
+
         # Meter responds decending instead of acending
         # Lets fix that with reverse
         meter_reading_list.reverse()
 
         return meter_reading_list
     
+    def fetch_unique(self, fetch: Callable[[str], dict], hrefs: list) -> dict:
+        """
+        Calls fetch once for every distinct href, running up to
+        discovery_workers of them concurrently
+
+        Returns: dict, {<href>: <fetch result>}
+        """
+        unique_hrefs = list(dict.fromkeys(hrefs))
+        if not unique_hrefs:
+            return {}
+        workers = min(self.discovery_workers, len(unique_hrefs))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='xcel_discovery') as executor:
+            results = executor.map(fetch, unique_hrefs)
+
+            return dict(zip(unique_hrefs, results))
+
     def get_meter_endpoint_type_details(self, reading_type_info_url: str) -> dict:
         """
         Queries the endpoint Reading Type details endpoint at the ip address passed
@@ -202,6 +237,9 @@ class generateEndpointYaml():
         root = ET.fromstring(x.text)
         
         meter_endpoint_reading_dict = { "Reading" : { } }
+        poll_rate = xcelEndpoint.get_poll_rate(root)
+        if poll_rate:
+            meter_endpoint_reading_dict['Reading']['pollRate'] = poll_rate
         for meterReading in root.findall(f'.//{IEEE_PREFIX}*'):
             match meterReading.tag.removeprefix(IEEE_PREFIX):
                 case 'qualityFlags':
@@ -275,6 +313,17 @@ class generateEndpointYaml():
                         UomType(reading['ReadingType']['uomType']).name
                     meter_reading_yaml_dict[ reading['MeterReading']['Description'] ]['tags']['value']['state_class'] = 'total_increasing'
 
+                # ReadingType details needed to decode the readings at runtime
+                for endpoint in meter_reading_yaml_dict.values():
+                    endpoint['decode'] = self.reading_type_to_decode(reading['ReadingType'])
+                    # Interval data the backfill reads missed readings from
+                    if reading['MeterReading'].get('ReadingSetListLink'):
+                        endpoint['reading_sets'] = reading['MeterReading']['ReadingSetListLink']
+                    # Fastest the meter says the reading changes, the Reading's own pollRate wins
+                    poll_rate = reading['Reading'].get('pollRate') or reading['MeterReading'].get('pollRate')
+                    if poll_rate:
+                        endpoint['meter_poll_rate'] = poll_rate
+
                 meter_reading_yaml_list.append(
                         meter_reading_yaml_dict
                     )  
@@ -282,6 +331,21 @@ class generateEndpointYaml():
         # convert string into proper yaml list
         return yaml.safe_load(yaml.dump(meter_reading_yaml_list,sort_keys=False))
 
+    @staticmethod
+    def reading_type_to_decode(reading_type: dict) -> dict:
+        """
+        Keeps the parts of a ReadingType that describe how to read its
+        values, with the enums written out by name
+
+        Returns: dict
+        """
+        return {
+            'powerOfTenMultiplier': reading_type.get('powerOfTenMultiplier', 0),
+            'uom': UomType(reading_type['uomType']).name,
+            'kind': KindType(reading_type['kind']).name,
+            'accumulationBehaviour': AccumulationBehaviourType(reading_type['accumulationBehaviour']).name,
+        }
+
     def is_endpoint_reading_type_supported(self, reading_type: dict) -> bool:
         """
         Check if Meter Reading Type is supported
@@ -347,7 +411,7 @@ class generateEndpointYaml():
         session = requests.Session()
         session.cert = creds
         # Mount our adapter to the domain
-        session.mount('https://{ip_address}', CCM8Adapter())
+        session.mount(f'https://{ip_address}', CCM8Adapter())
 
         return session
 
@@ -1,20 +1,36 @@
 import os
+import yaml
+import socket
+import signal
 import logging
-from time import sleep
+import threading
+from time import sleep, monotonic
 from pathlib import Path
 from xcelMeter import xcelMeter
+from xcelMetrics import METRICS
+from xcelShards import xcelShardCoordinator, xcelSupervisor, shard_key
 from generateEndpointYaml import generateEndpointYaml
 from zeroconf import ServiceBrowser, ServiceListener, Zeroconf
 
 INTEGRATION_NAME = "Xcel Itron 5"
 
+# File the last address the meter was found at is kept in
+METER_ADDRESS_FILE = 'meter_address.yaml'
+
 LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO').upper()
 logging.basicConfig(format='%(levelname)s: %(message)s', level=LOGLEVEL)
 
 # mDNS listener to find the IP Address of the meter on the network
 class XcelListener(ServiceListener):
     def __init__(self):
+        # First meter that resolved to an address
         self.info = None
+        # Every meter that answered, {service name: service info}
+        self.services = {}
+        # Set as soon as a meter's address has been resolved
+        self.found = threading.Event()
+        # Set every time another meter's address is resolved
+        self.changed = threading.Event()
 
     def update_service(self, zc: Zeroconf, type_: str, name: str) -> None:
         pass
@@ -23,8 +39,17 @@ class XcelListener(ServiceListener):
         pass
 
     def add_service(self, zc: Zeroconf, type_: str, name: str) -> None:
-        self.info = zc.get_service_info(type_, name)
-        print(f"Service {name} added, service info: {self.info}")
+        info = zc.get_service_info(type_, name)
+        print(f"Service {name} added, service info: {info}")
+        if info is None:
+            return
+        self.services[name] = info
+        if info.parsed_addresses():
+            # The first meter that resolves is the one a single meter search uses
+            if self.info is None:
+                self.info = info
+                self.found.set()
+            self.changed.set()
 
 def look_for_creds() -> tuple:
     """
@@ -47,44 +72,342 @@ def look_for_creds() -> tuple:
     else:
         raise FileNotFoundError('Could not find cert and key credentials')
 
-def mDNS_search_for_meter() -> str | int:
+def get_mdns_timeout() -> float:
+    """
+    Seconds to wait for the meter to answer an mDNS search
+
+    Returns: float
+    """
+    return float(os.getenv('MDNS_TIMEOUT', 10.0))
+
+def get_mdns_settle_time() -> float:
+    """
+    Seconds without a new meter answering after which a search for
+    every meter is considered complete
+
+    Returns: float
+    """
+    return float(os.getenv('MDNS_SETTLE_TIME', 2.0))
+
+def mDNS_search_for_meter(timeout: float = None) -> str | int:
     """
     Creates a new zeroconf instance to probe the network for the meter
-    to extract its ip address and port. Closes the instance down when complete.
+    to extract its ip address and port. Returns as soon as the meter
+    answers and closes the instance down when complete.
 
     Returns: string, ip address of the meter
     """
+    timeout = get_mdns_timeout() if timeout is None else timeout
     zeroconf = Zeroconf()
     listener = XcelListener()
-    # Meter will respond on _smartenergy._tcp.local. port 5353
-    browser = ServiceBrowser(zeroconf, "_smartenergy._tcp.local.", listener)
-    # Have to wait to hear back from the asynchrounous listener/browser task
-    sleep(10)
     try:
-        addresses = listener.info.addresses
-    except:
-        raise TimeoutError('Waiting too long to get response from meter')
-    print(listener.info)
-    # Auto parses the network byte format into a legible address
-    ip_address = listener.info.parsed_addresses()[0]
-    port = listener.info.port
-    # Close out our mDNS discovery device
-    zeroconf.close()
-  
+        # Meter will respond on _smartenergy._tcp.local. port 5353
+        browser = ServiceBrowser(zeroconf, "_smartenergy._tcp.local.", listener)
+        # The listener signals us from zeroconf's thread once the meter resolves
+        if not listener.found.wait(timeout):
+            raise TimeoutError('Waiting too long to get response from meter')
+        print(listener.info)
+        # Auto parses the network byte format into a legible address
+        ip_address = listener.info.parsed_addresses()[0]
+        port = listener.info.port
+    finally:
+        # Close out our mDNS discovery device
+        zeroconf.close()
+
     return ip_address, port
 
+def load_meter_address() -> tuple | None:
+    """
+    Reads the address the meter was last found at
 
-if __name__ == '__main__':
-    if os.getenv('METER_IP') and os.getenv('METER_PORT'):
-        ip_address = os.getenv('METER_IP')
-        port_num = os.getenv('METER_PORT')
+    Returns: tuple of (ip address, port), or None if it isn't known
+    """
+    path = Path(xcelMeter.get_cache_dir()) / METER_ADDRESS_FILE
+    try:
+        with open(path, mode='r', encoding='utf-8') as file:
+            address = yaml.safe_load(file)
+        return address['ip'], int(address['port'])
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logging.warning(f'Ignoring unreadable meter address file {path}')
+        return None
+
+def store_meter_address(ip_address: str, port: int) -> None:
+    """
+    Remembers the meter's address so the next start can skip the mDNS search
+
+    Returns: None
+    """
+    path = Path(xcelMeter.get_cache_dir()) / METER_ADDRESS_FILE
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, mode='w', encoding='utf-8') as file:
+            yaml.safe_dump({'ip': ip_address, 'port': int(port)}, file)
+        os.replace(tmp_path, path)
+    except OSError:
+        logging.warning(f'Could not store the meter address in {path}')
+
+def is_meter_reachable(ip_address: str, port: int, timeout: float = 2.0) -> bool:
+    """
+    Checks whether anything accepts connections at the given address
+
+    Returns: bool
+    """
+    try:
+        with socket.create_connection((ip_address, int(port)), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+def confirm_meter_address(known_address: tuple | None) -> tuple | None:
+    """
+    Searches for the meter over mDNS and stores where it was found,
+    warning if it moved away from the address we already knew
+
+    Returns: tuple of (ip address, port), or None if it didn't answer
+    """
+    try:
+        address = mDNS_search_for_meter()
+    except TimeoutError:
+        logging.warning('Meter did not answer the mDNS search')
+        return None
+    if known_address is not None and tuple(address) != tuple(known_address):
+        logging.warning(f'Meter moved from {known_address[0]}:{known_address[1]} to {address[0]}:{address[1]}, '
+                        'the new address is used from the next start')
+    store_meter_address(*address)
+
+    return address
+
+def find_meter() -> tuple:
+    """
+    Works out the meter's address, trying the last known one first and
+    confirming it over mDNS in the background. Only waits on mDNS when
+    there is no known address or the meter is no longer there.
+
+    Returns: tuple of (ip address, port)
+    """
+    known_address = load_meter_address()
+    if known_address is not None and is_meter_reachable(*known_address):
+        logging.info(f'Using the last known meter address {known_address[0]}:{known_address[1]}')
+        threading.Thread(target=confirm_meter_address, args=(known_address,),
+                         name='xcel_mdns_confirm', daemon=True).start()
+        return known_address
+    address = confirm_meter_address(None)
+    if address is None:
+        raise TimeoutError('Waiting too long to get response from meter')
+
+    return address
+
+
+def mDNS_search_for_meters(timeout: float = None, settle_time: float = None) -> list:
+    """
+    Probes the network for every meter answering on _smartenergy._tcp.local.
+    Returns once no new meter has answered for the settle time, or at the
+    latest after the timeout, and closes the instance down when complete.
+
+    Returns: list of (service name, ip address, port) tuples
+    """
+    timeout = get_mdns_timeout() if timeout is None else timeout
+    settle_time = get_mdns_settle_time() if settle_time is None else settle_time
+    deadline = monotonic() + timeout
+    zeroconf = Zeroconf()
+    listener = XcelListener()
+    try:
+        browser = ServiceBrowser(zeroconf, "_smartenergy._tcp.local.", listener)
+        # We can't know when everyone has answered, so wait for the answers to stop coming
+        if listener.found.wait(timeout):
+            while True:
+                listener.changed.clear()
+                remaining = deadline - monotonic()
+                if remaining <= 0 or not listener.changed.wait(min(settle_time, remaining)):
+                    break
+        # Zeroconf's thread may still be adding services
+        services = list(listener.services.items())
+    finally:
+        # Close out our mDNS discovery device
+        zeroconf.close()
+    meters = [(name.split('.')[0], info.parsed_addresses()[0], info.port)
+              for name, info in services if info.parsed_addresses()]
+    if not meters:
+        raise TimeoutError('No meters responded to the mDNS search')
+
+    return meters
+
+def load_meter_list(default_creds: tuple) -> list:
+    """
+    Builds the list of meters to poll in multi-meter mode. Meters come from
+    the METERS_FILE yaml (a list of name, ip, port and optionally cert and
+    key per meter), the METERS variable (comma separated [name=]ip:port),
+    or failing both every meter found over mDNS.
+
+    Returns: list of (name, ip address, port, creds) tuples
+    """
+    meters = []
+    if os.getenv('METERS_FILE'):
+        with open(os.getenv('METERS_FILE'), mode='r', encoding='utf-8') as file:
+            for entry in yaml.safe_load(file):
+                creds = (entry['cert'], entry['key']) if entry.get('cert') and entry.get('key') else default_creds
+                name = entry.get('name', f"{INTEGRATION_NAME} {entry['ip']}")
+                meters.append((name, entry['ip'], entry.get('port', 8081), creds))
+    elif os.getenv('METERS'):
+        for entry in os.getenv('METERS').split(','):
+            name, _, address = entry.strip().rpartition('=')
+            ip_address, _, port_num = address.partition(':')
+            meters.append((name or f'{INTEGRATION_NAME} {ip_address}', ip_address, port_num or 8081, default_creds))
     else:
-        ip_address, port_num = mDNS_search_for_meter()
+        for service_name, ip_address, port_num in mDNS_search_for_meters():
+            meters.append((f'{INTEGRATION_NAME} {service_name}', ip_address, port_num, default_creds))
+
+    return meters
+
+def start_meter(meter: xcelMeter, retry_delay: float = 60.0) -> None:
+    """
+    Sets up the meter and hands its endpoints to the shared poller. Keeps
+    trying in the background if the meter is unreachable, without holding
+    up any of the others.
+
+    Returns: None
+    """
+    while not meter.initalized and not meter.stopped:
+        try:
+            meter.setup()
+        except Exception:
+            logging.exception(f'Could not set up {meter.name}, trying again in {retry_delay}s')
+            sleep(retry_delay)
+    if not meter.start():
+        # Handed over while it was being set up, undo what the setup did
+        meter.stop()
+
+def setup_shared(creds: tuple) -> dict:
+    """
+    Sets up what every meter polled from this process shares: the MQTT
+    client, outbox, history, capture log, notification listener and poller
+
+    Returns: dict of xcelMeter keyword arguments
+    """
+    mqtt_client = xcelMeter.setup_mqtt(os.getenv('MQTT_SERVER'), xcelMeter.get_mqtt_port())
+    listener = None
+    if os.getenv('SUBSCRIPTIONS', 'false').lower() in ('true', '1', 'yes'):
+        listener = xcelMeter.setup_notification_listener(creds)
+
+    return {'mqtt_client': mqtt_client,
+            'poller': xcelMeter.setup_poller(),
+            'outbox': xcelMeter.setup_outbox(mqtt_client),
+            'history': xcelMeter.setup_history(),
+            'recorder': xcelMeter.setup_recorder(),
+            'notification_listener': listener}
+
+def run_multi_meter(creds: tuple) -> None:
+    """
+    Polls every configured meter from this one process, sharing the MQTT
+    client and a bounded pool of polling workers between them
+
+    Returns: None
+    """
+    meter_list = load_meter_list(creds)
+    logging.info(f'Polling {len(meter_list)} meters')
+    shared = setup_shared(creds)
+    for name, ip_address, port_num, meter_creds in meter_list:
+        meter = xcelMeter(name, ip_address, port_num, meter_creds, node_prefix=f'{name}_', **shared)
+        threading.Thread(target=start_meter, args=(meter,), name=f'setup_{name}', daemon=True).start()
+    # The shared poller picks up each meter's endpoints as soon as it's ready
+    shared['poller'].run()
+
+def apply_worker_settings(index: int) -> None:
+    """
+    Gives a worker process its own outbox, capture log and ports, none
+    of which can be shared between processes
+
+    Returns: None
+    """
+    def per_worker(path: str) -> str:
+        root, ext = os.path.splitext(path)
+        return f'{root}_{index}{ext}'
+
+    os.environ['OUTBOX_PATH'] = per_worker(xcelMeter.get_outbox_path())
+    if os.getenv('RECORD_PATH'):
+        os.environ['RECORD_PATH'] = per_worker(os.getenv('RECORD_PATH'))
+    os.environ['NOTIFY_PORT'] = str(int(os.getenv('NOTIFY_PORT', 8082)) + index)
+    if os.getenv('METRICS_PORT'):
+        os.environ['METRICS_PORT'] = str(int(os.getenv('METRICS_PORT')) + index)
+
+def run_shard_worker(index: int, node: str, meter_list: list, creds: tuple) -> None:
+    """
+    Worker process of sharded mode. Polls the meters whose lease it
+    holds like multi-meter mode does, and starts or stops them as the
+    leases move between workers.
+
+    Returns: None
+    """
+    apply_worker_settings(index)
+    if os.getenv('METRICS_PORT'):
+        METRICS.start_server(int(os.getenv('METRICS_PORT')))
+    shared = setup_shared(creds)
+    meters = {shard_key(meter[0]): meter for meter in meter_list}
+    # {shard: xcelMeter}
+    running = {}
+
+    def acquire(shard: str) -> None:
+        name, ip_address, port_num, meter_creds = meters[shard]
+        meter = xcelMeter(name, ip_address, port_num, meter_creds, node_prefix=f'{name}_', **shared)
+        running[shard] = meter
+        threading.Thread(target=start_meter, args=(meter,), name=f'setup_{name}', daemon=True).start()
+
+    def release(shard: str) -> None:
+        meter = running.pop(shard, None)
+        if meter is not None:
+            meter.stop()
+
+    coordinator = xcelShardCoordinator(os.getenv('MQTT_SERVER'), xcelMeter.get_mqtt_port(),
+                                       f'{node}-{index}', list(meters), acquire, release,
+                                       lease_ttl=float(os.getenv('SHARD_LEASE_TTL', 30.0)),
+                                       topic=os.getenv('SHARD_TOPIC', 'xcel_itron2mqtt/shards'))
+    # The supervisor stops workers with SIGTERM, their meters are handed over on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: shared['poller'].stop(wait=False))
+    coordinator.start()
+    shared['poller'].run()
+    coordinator.stop()
+
+def run_sharded(creds: tuple, workers: int) -> None:
+    """
+    Splits the configured meters between worker processes on this node,
+    and with any other node polling the same meters through the same
+    MQTT broker. The supervisor restarts workers that die, their meters
+    are picked up by the others in the meantime.
+
+    Returns: None
+    """
+    meter_list = load_meter_list(creds)
+    node = os.getenv('SHARD_NODE') or socket.gethostname()
+    logging.info(f'Sharding {len(meter_list)} meters over {workers} workers on {node}')
+    supervisor = xcelSupervisor(run_shard_worker, workers, (node, meter_list, creds))
+    supervisor.run()
+
+
+if __name__ == '__main__':
     creds = look_for_creds()
-    
-    meter = xcelMeter(INTEGRATION_NAME, ip_address, port_num, creds)
-    meter.setup()
+    multi_meter = os.getenv('MULTI_METER', 'false').lower() in ('true', '1', 'yes')
+    shard_workers = int(os.getenv('SHARD_WORKERS', 0)) if multi_meter else 0
+    # Optional Prometheus metrics exporter, served by each worker when sharded
+    if os.getenv('METRICS_PORT') and not shard_workers:
+        METRICS.start_server(int(os.getenv('METRICS_PORT')))
+
+    if shard_workers:
+        run_sharded(creds, shard_workers)
+    elif multi_meter:
+        run_multi_meter(creds)
+    else:
+        if os.getenv('METER_IP') and os.getenv('METER_PORT'):
+            ip_address = os.getenv('METER_IP')
+            port_num = os.getenv('METER_PORT')
+        else:
+            ip_address, port_num = find_meter()
+
+        meter = xcelMeter(INTEGRATION_NAME, ip_address, port_num, creds)
+        meter.setup()
 
-    if meter.initalized:
-        # The run method controls all the looping, querying, and mqtt sending
-        meter.run()
\ No newline at end of file
+        if meter.initalized:
+            # The run method controls all the looping, querying, and mqtt sending
+            meter.run()
@@ -0,0 +1,58 @@
+class xcelAdaptiveRate():
+    """
+    Works out an endpoint's polling period from what its polls return.
+    The smoothed share of polls that saw a change tells how often the
+    reading changes, and the period is steered towards polls_per_change
+    polls for every change, by at most speed_up or slow_down per poll
+    and within [min_period, max_period]. It is also never allowed to
+    drop below latency_factor times the smoothed response time, so a
+    struggling meter gets backed off.
+    """
+    def __init__(self, initial_period: float, min_period: float, max_period: float,
+                    speed_up: float = 0.5, slow_down: float = 1.25,
+                    latency_factor: float = 4.0, smoothing: float = 0.2,
+                    polls_per_change: float = 2.0):
+        self.min_period = min_period
+        self.max_period = max(min_period, max_period)
+        self.speed_up = speed_up
+        self.slow_down = slow_down
+        self.polls_per_change = polls_per_change
+        self.latency_factor = latency_factor
+        self.smoothing = smoothing
+
+        # Exponentially weighted averages of the response time and of how
+        # often the reading changes
+        self.response_time = None
+        self.change_rate = None
+        self.period = self._clamp(initial_period)
+
+    def _clamp(self, period: float) -> float:
+        floor = self.min_period
+        if self.response_time is not None:
+            floor = max(floor, self.response_time * self.latency_factor)
+
+        return min(self.max_period, max(floor, period))
+
+    def _smooth(self, average: float | None, sample: float) -> float:
+        if average is None:
+            return sample
+        return average + self.smoothing * (sample - average)
+
+    def update(self, changed: bool, response_time: float) -> float:
+        """
+        Feeds the result of a poll into the estimate
+
+        Returns: float, the polling period to use from now on
+        """
+        self.response_time = self._smooth(self.response_time, response_time)
+        self.change_rate = self._smooth(self.change_rate, 1.0 if changed else 0.0)
+        # The reading changes about every 1 / change_rate polls, scale the
+        # period so that becomes polls_per_change polls
+        if self.change_rate > 0:
+            factor = 1.0 / (self.change_rate * self.polls_per_change)
+        else:
+            factor = self.slow_down
+        factor = min(self.slow_down, max(self.speed_up, factor))
+        self.period = self._clamp(self.period * factor)
+
+        return self.period
@@ -0,0 +1,364 @@
+import os
+import yaml
+import logging
+import threading
+from time import monotonic
+from datetime import datetime
+from pathlib import Path
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+ENERGY = 'energy'
+DEMAND = 'demand'
+
+# Energy kinds whose value is a running register, not a per interval delta
+REGISTER_ACCUMULATIONS = (None, 'Summation', 'Cumulative')
+
+class xcelRollingWindow():
+    """
+    Mean, min and max of the samples of the last window seconds. Min and
+    max are kept in monotonic queues, so every sample costs amortized O(1)
+    however many the window holds.
+    """
+    def __init__(self, window: float):
+        self.window = window
+        self._samples = deque()
+        self._sum = 0.0
+        # Candidates for the min and max, increasing and decreasing in value
+        self._min = deque()
+        self._max = deque()
+
+    def add(self, timestamp: float, value: float) -> None:
+        self._samples.append((timestamp, value))
+        self._sum += value
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((timestamp, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((timestamp, value))
+        # Drop what fell out of the window
+        cutoff = timestamp - self.window
+        while self._samples[0][0] <= cutoff:
+            self._sum -= self._samples.popleft()[1]
+        while self._min[0][0] <= cutoff:
+            self._min.popleft()
+        while self._max[0][0] <= cutoff:
+            self._max.popleft()
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    @property
+    def mean(self) -> float | None:
+        return self._sum / len(self._samples) if self._samples else None
+
+    @property
+    def min(self) -> float | None:
+        return self._min[0][1] if self._min else None
+
+    @property
+    def max(self) -> float | None:
+        return self._max[0][1] if self._max else None
+
+
+class xcelEnergyRollup():
+    """
+    Energy used in the last interval, the current hour and today, worked
+    out from a summation register. Periods follow the local time the
+    meter stamped the readings with and remember the register value they
+    started at, so a missed reading shifts nothing between periods.
+    Today's energy is also split by the touTier it was used in.
+    """
+    def __init__(self, digits: int = 0, state: dict = None):
+        self.digits = digits
+        self.last_value = None
+        self.interval = None
+        self.hour = None
+        self.hour_start = None
+        self.day = None
+        self.day_start = None
+        # {touTier: energy used in it today}
+        self.tiers = {}
+        if state:
+            self.load_state(state)
+
+    def load_state(self, state: dict) -> None:
+        self.last_value = state.get('last_value')
+        self.hour, self.hour_start = state.get('hour'), state.get('hour_start')
+        self.day, self.day_start = state.get('day'), state.get('day_start')
+        self.tiers = dict(state.get('tiers') or {})
+
+    def get_state(self) -> dict:
+        return {'last_value': self.last_value, 'hour': self.hour, 'hour_start': self.hour_start,
+                'day': self.day, 'day_start': self.day_start, 'tiers': dict(self.tiers)}
+
+    def rolls_over(self, now: datetime) -> bool:
+        """
+        Returns: bool, True if now is in a later hour than the last reading
+        """
+        return self.hour is not None and now.strftime('%Y-%m-%dT%H') != self.hour
+
+    def update(self, value: float, now: datetime, tier: int = None) -> None:
+        # A new period starts where the last reading of the previous one
+        # left off, so the energy in between isn't lost
+        start = value if self.last_value is None else self.last_value
+        hour = now.strftime('%Y-%m-%dT%H')
+        if hour != self.hour:
+            self.hour, self.hour_start = hour, start
+        day = now.date().isoformat()
+        if day != self.day:
+            self.day, self.day_start = day, start
+            self.tiers = dict.fromkeys(self.tiers, 0)
+        if self.last_value is not None:
+            delta = value - self.last_value
+            if delta < 0:
+                # Register was reset, carry the periods over to the new count
+                self.hour_start += delta
+                self.day_start += delta
+                delta = 0
+            self.interval = delta
+            if tier is not None:
+                self.tiers[tier] = self.tiers.get(tier, 0) + delta
+        self.last_value = value
+
+    def get_sensors(self) -> dict:
+        """
+        Returns: dict, {<sensor name>: <value>}
+        """
+        if self.last_value is None:
+            return {}
+        sensors = {'Hour': round(self.last_value - self.hour_start, self.digits),
+                   'Today': round(self.last_value - self.day_start, self.digits)}
+        if self.interval is not None:
+            sensors['Interval'] = round(self.interval, self.digits)
+        for tier, energy in self.tiers.items():
+            sensors[f'Tier{tier}'] = round(energy, self.digits)
+
+        return sensors
+
+
+class xcelDemandRollup():
+    """
+    Rolling mean, min and max demand over a window, and today's peak
+    """
+    def __init__(self, window: float, digits: int = 0, state: dict = None):
+        self.digits = digits
+        self.window = xcelRollingWindow(window)
+        self.day = None
+        self.peak = None
+        if state:
+            self.day, self.peak = state.get('day'), state.get('peak')
+
+    def get_state(self) -> dict:
+        return {'day': self.day, 'peak': self.peak}
+
+    def rolls_over(self, now: datetime) -> bool:
+        return self.day is not None and now.date().isoformat() != self.day
+
+    def update(self, value: float, now: datetime, tier: int = None) -> None:
+        self.window.add(now.timestamp(), value)
+        day = now.date().isoformat()
+        if day != self.day:
+            self.day, self.peak = day, value
+        else:
+            self.peak = max(self.peak, value)
+
+    def get_sensors(self) -> dict:
+        if not len(self.window):
+            return {}
+        return {'Mean': round(self.window.mean, self.digits + 1), 'Min': self.window.min,
+                'Max': self.window.max, 'Peak': self.peak}
+
+
+class xcelAggregates():
+    """
+    Rolls a meter's readings up into a few slow moving sensors, hourly and
+    daily energy from the summation registers and demand statistics from
+    Instantaneous Demand. Every endpoint's rollups are published through
+    a rollup endpoint of their own, at most every publish_interval
+    seconds and whenever a period ends. Progress is kept on disk, at most
+    every flush_interval seconds and whenever a period ends, so a restart
+    doesn't zero today's totals.
+    """
+    def __init__(self, state_path: str = None, window: float = 900.0,
+                    publish_interval: float = 60.0, flush_interval: float = 60.0):
+        self.state_path = Path(state_path) if state_path else None
+        self.window = window
+        self.publish_interval = publish_interval
+        self.flush_interval = flush_interval
+        # {source endpoint: (rollup endpoint, rollup)}
+        self._rollups = {}
+        # {source endpoint: monotonic time of the last publish}
+        self._published = {}
+        # {source endpoint: time of its latest reading}, periods never go back
+        self._reading_times = {}
+        self._lock = threading.Lock()
+        self._last_flush = monotonic()
+        self._state = self.load_state()
+
+    @staticmethod
+    def get_kind(endpoint: dict) -> str | None:
+        """
+        Works out what an endpoints.yaml entry measures, from its decode
+        key or failing that its value tag
+
+        Returns: str, ENERGY or DEMAND, or None if it can't be rolled up
+        """
+        decode = endpoint.get('decode') or {}
+        value_tag = endpoint.get('tags', {}).get('value')
+        device_class = value_tag.get('device_class') if isinstance(value_tag, dict) else None
+        kind = decode.get('kind')
+        if kind == 'Energy' or (kind is None and device_class == 'energy'):
+            if decode.get('accumulationBehaviour') in REGISTER_ACCUMULATIONS:
+                return ENERGY
+        elif kind in ('Demand', 'Power') or (kind is None and device_class == 'power'):
+            return DEMAND
+
+        return None
+
+    def get_tags(self, name: str, kind: str, unit: str) -> dict:
+        """
+        Sensor tags of an endpoint's rollups, in the endpoints.yaml format
+
+        Returns: dict
+        """
+        if kind == ENERGY:
+            tags = {
+                'Interval': {'entity_type': 'sensor', 'device_class': 'energy', 'unit_of_measurement': unit},
+                'Hour': {'entity_type': 'sensor', 'device_class': 'energy', 'unit_of_measurement': unit,
+                         'state_class': 'total_increasing'},
+                'Today': {'entity_type': 'sensor', 'device_class': 'energy', 'unit_of_measurement': unit,
+                          'state_class': 'total_increasing'},
+            }
+            # Tiers seen before are set up right away, new ones as they appear
+            for tier in (self._state.get(name) or {}).get('tiers') or {}:
+                tags[f'Tier{tier}'] = dict(tags['Today'])
+            return tags
+        return {sensor: {'entity_type': 'sensor', 'device_class': 'power', 'unit_of_measurement': unit,
+                         'state_class': 'measurement'}
+                for sensor in ('Mean', 'Min', 'Max', 'Peak')}
+
+    def register(self, endpoint, rollup_endpoint, kind: str) -> None:
+        """
+        Starts rolling up an endpoint's readings, published through
+        rollup_endpoint
+        """
+        digits = max(0, -endpoint.decoder.exponent)
+        state = self._state.get(endpoint.name)
+        if kind == ENERGY:
+            rollup = xcelEnergyRollup(digits, state)
+        else:
+            rollup = xcelDemandRollup(self.window, digits, state)
+        with self._lock:
+            self._rollups[endpoint] = (rollup_endpoint, rollup)
+
+    def unregister(self, endpoints: list) -> None:
+        with self._lock:
+            for endpoint in endpoints:
+                self._rollups.pop(endpoint, None)
+                self._published.pop(endpoint, None)
+                self._reading_times.pop(endpoint, None)
+
+    def load_state(self) -> dict:
+        if self.state_path is None:
+            return {}
+        try:
+            with open(self.state_path, mode='r', encoding='utf-8') as file:
+                state = yaml.safe_load(file)
+            return state if isinstance(state, dict) else {}
+        except FileNotFoundError:
+            return {}
+        except (OSError, yaml.YAMLError) as e:
+            logger.warning(f'Could not read aggregate state {self.state_path}: {e}')
+            return {}
+
+    def flush(self) -> None:
+        """
+        Writes the progress of every rollup to disk
+        """
+        if self.state_path is None:
+            return
+        with self._lock:
+            self._state.update({endpoint.name: rollup.get_state()
+                                for endpoint, (_, rollup) in self._rollups.items()})
+            state = dict(self._state)
+            self._last_flush = monotonic()
+        try:
+            self.state_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.state_path.with_suffix('.tmp')
+            with open(tmp_path, mode='w', encoding='utf-8') as file:
+                yaml.safe_dump(state, file)
+            os.replace(tmp_path, self.state_path)
+        except OSError as e:
+            logger.warning(f'Could not write aggregate state {self.state_path}: {e}')
+
+    def add_sensors(self, rollup_endpoint, sensors: dict) -> None:
+        """
+        Sets up the sensors a rollup came up with after its endpoint was
+        created, like a touTier that hadn't been seen yet
+        """
+        configs = {}
+        for sensor_name in sensors:
+            if sensor_name in rollup_endpoint.tags:
+                continue
+            details = dict(rollup_endpoint.tags['Today'])
+            rollup_endpoint.tags[sensor_name] = details
+            mqtt_topic, payload = rollup_endpoint.build_config(sensor_name, details)
+            configs[mqtt_topic] = payload
+        if configs:
+            rollup_endpoint.send_configs(configs)
+
+    @staticmethod
+    def get_reading_time(reading: dict) -> datetime:
+        """
+        Time a reading was taken by the meter, readings without a
+        Timestamp, like Instantaneous Demand, are taken as current
+
+        Returns: datetime, local time
+        """
+        start = reading.get('timePeriodstart')
+        if isinstance(start, int):
+            try:
+                return datetime.fromtimestamp(start)
+            except (OverflowError, OSError, ValueError):
+                pass
+
+        return datetime.now()
+
+    def observe(self, endpoint, reading: dict) -> None:
+        """
+        Endpoint hook, called with every decoded reading
+        """
+        value = reading.get('value')
+        if not isinstance(value, (int, float)):
+            return
+        now = self.get_reading_time(reading)
+        with self._lock:
+            entry = self._rollups.get(endpoint)
+            if entry is None:
+                return
+            rollup_endpoint, rollup = entry
+            # A reading stamped before the last one counts towards the current
+            # period, a meter clock stepping back mustn't reopen an old one
+            now = max(now, self._reading_times.get(endpoint, now))
+            self._reading_times[endpoint] = now
+            # Get the final figures of a period out before it starts over
+            closing = rollup.get_sensors() if rollup.rolls_over(now) else None
+            tier = reading.get('touTier')
+            rollup.update(value, now, tier if isinstance(tier, int) else None)
+            publish = closing is not None or \
+                monotonic() - self._published.get(endpoint, float('-inf')) >= self.publish_interval
+            if publish:
+                self._published[endpoint] = monotonic()
+                sensors = rollup.get_sensors()
+            flush = closing is not None or monotonic() - self._last_flush >= self.flush_interval
+        if publish:
+            # Sensors of either set may not have a state topic yet
+            self.add_sensors(rollup_endpoint, {**(closing or {}), **sensors})
+            if closing:
+                rollup_endpoint.process_send_mqtt(closing)
+            rollup_endpoint.process_send_mqtt(sensors)
+        if flush:
+            self.flush()
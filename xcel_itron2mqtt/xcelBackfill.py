@@ -0,0 +1,235 @@
+import os
+import re
+import yaml
+import queue
+import logging
+import requests
+import threading
+import xml.etree.ElementTree as ET
+from time import monotonic, sleep
+from pathlib import Path
+from xcelMetrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+IEEE_PREFIX = '{urn:ieee:std:2030.5:ns}'
+
+# Finds the MeterReading a reading url belongs to
+METER_READING_URL = re.compile(r'^(.*/mr/\d+)(/|$)')
+
+class xcelBackfill():
+    """
+    Fills in the intervals a meter recorded while the bridge wasn't
+    reading it. Gaps are spotted in the timePeriod start of consecutive
+    readings, including across restarts, and the missed readings are
+    paged out of the MeterReading's ReadingSets with 2030.5 list paging
+    (s= start index, l= limit). Requests are spaced out by min_interval
+    on a single background thread, so live polling is never starved.
+    """
+    def __init__(self, session: requests.Session, meter_url: str, state_path: str,
+                    min_gap: float = 900.0, max_age: float = 7 * 86400.0,
+                    page_size: int = 24, min_interval: float = 1.0,
+                    flush_interval: float = 60.0):
+        self.requests_session = session
+        self.meter_url = meter_url
+        self.state_path = Path(state_path)
+        self.min_gap = min_gap
+        self.max_age = max_age
+        self.page_size = page_size
+        self.min_interval = min_interval
+        self.flush_interval = flush_interval
+
+        # {endpoint: ReadingSetList path}
+        self._reading_sets = {}
+        # {endpoint name: last timePeriod start seen}, persisted
+        self._last_start = self.load_state()
+        self._last_flush = monotonic()
+        self._next_request = 0.0
+        self._lock = threading.Lock()
+        self._gaps = queue.Queue()
+        self._thread = threading.Thread(target=self._work, name='xcel_backfill', daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def get_reading_sets(url: str) -> str | None:
+        """
+        ReadingSetList of the MeterReading a reading url belongs to, for
+        endpoints that weren't discovered with a reading_sets link
+
+        Returns: str, path or None
+        """
+        match = METER_READING_URL.match(url)
+
+        return f'{match.group(1)}/rs' if match else None
+
+    def register(self, endpoint, reading_sets: str = None) -> bool:
+        """
+        Starts watching an endpoint's readings for gaps
+
+        Returns: bool, False if the endpoint has no interval data to backfill from
+        """
+        reading_sets = reading_sets or self.get_reading_sets(endpoint.url.removeprefix(self.meter_url))
+        if not reading_sets:
+            return False
+        with self._lock:
+            self._reading_sets[endpoint] = reading_sets
+
+        return True
+
+    def unregister(self, endpoints: list) -> None:
+        with self._lock:
+            for endpoint in endpoints:
+                self._reading_sets.pop(endpoint, None)
+
+    def load_state(self) -> dict:
+        try:
+            with open(self.state_path, mode='r', encoding='utf-8') as file:
+                state = yaml.safe_load(file)
+            return state if isinstance(state, dict) else {}
+        except FileNotFoundError:
+            return {}
+        except (OSError, yaml.YAMLError) as e:
+            logger.warning(f'Could not read backfill state {self.state_path}: {e}')
+            return {}
+
+    def flush(self) -> None:
+        """
+        Writes the last seen reading times to disk
+        """
+        with self._lock:
+            state = dict(self._last_start)
+            self._last_flush = monotonic()
+        try:
+            self.state_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.state_path.with_suffix('.tmp')
+            with open(tmp_path, mode='w', encoding='utf-8') as file:
+                yaml.safe_dump(state, file)
+            os.replace(tmp_path, self.state_path)
+        except OSError as e:
+            logger.warning(f'Could not write backfill state {self.state_path}: {e}')
+
+    def observe(self, endpoint, reading: dict) -> None:
+        """
+        Endpoint hook, called with every decoded reading. Queues a
+        backfill when the reading starts too long after the last one.
+        """
+        start = reading.get('timePeriodstart')
+        if not isinstance(start, int):
+            return
+        with self._lock:
+            if endpoint not in self._reading_sets:
+                return
+            last = self._last_start.get(endpoint.name)
+            if last is not None and start <= last:
+                return
+            self._last_start[endpoint.name] = start
+            flush = monotonic() - self._last_flush >= self.flush_interval
+        if last is not None and start - last > self.min_gap:
+            # Don't go further back than the meter is likely to remember
+            gap_start = max(last, start - self.max_age)
+            logger.info(f'{endpoint.name} has a {start - last}s gap in its readings, backfilling')
+            self._gaps.put((endpoint, gap_start, start))
+            flush = True
+        if flush:
+            self.flush()
+
+    def get(self, path: str, first: int = 0) -> ET.Element:
+        """
+        Fetches one page of a list resource, waiting for the next
+        request slot first
+
+        Returns: ET.Element, root of the list
+        """
+        with self._lock:
+            wait = self._next_request - monotonic()
+            self._next_request = max(monotonic(), self._next_request) + self.min_interval
+        if wait > 0:
+            sleep(wait)
+        x = self.requests_session.get(f'{self.meter_url}{path}', params={'s': first, 'l': self.page_size},
+                                      verify=False, timeout=15.0)
+        x.raise_for_status()
+
+        return ET.fromstring(x.text)
+
+    def pages(self, path: str, item: str):
+        """
+        Pages through a 2030.5 list resource
+
+        Returns: generator of the list's item elements
+        """
+        first = 0
+        while True:
+            root = self.get(path, first)
+            items = root.findall(f'{IEEE_PREFIX}{item}')
+            yield from items
+            first += len(items)
+            if not items or first >= int(root.get('all', 0)):
+                return
+
+    @staticmethod
+    def get_time_period(element: ET.Element) -> tuple[int, int]:
+        """
+        Returns: tuple of (start, duration) of the element's timePeriod
+        """
+        return (int(element.findtext(f'{IEEE_PREFIX}timePeriod/{IEEE_PREFIX}start')),
+                int(element.findtext(f'{IEEE_PREFIX}timePeriod/{IEEE_PREFIX}duration', 0)))
+
+    def fetch_gap(self, reading_sets: str, gap_start: int, gap_end: int) -> list:
+        """
+        Collects every Reading that started strictly inside the gap, from
+        the ReadingSets overlapping it. The meter lists both newest first,
+        so paging stops at the first entry older than the gap, once the
+        order of the list has shown it is newest first.
+
+        Returns: list of (start, duration, value text) sorted by start
+        """
+        readings = {}
+        newest_set = None
+        for reading_set in self.pages(reading_sets, 'ReadingSet'):
+            set_start, set_duration = self.get_time_period(reading_set)
+            if set_duration and set_start + set_duration <= gap_start:
+                if newest_set is not None and newest_set > set_start:
+                    break
+                newest_set = set_start
+                continue
+            newest_set = set_start
+            link = reading_set.find(f'{IEEE_PREFIX}ReadingListLink')
+            if link is None or set_start >= gap_end:
+                continue
+            newest = None
+            for reading in self.pages(link.get('href'), 'Reading'):
+                start, duration = self.get_time_period(reading)
+                if gap_start < start < gap_end:
+                    readings[start] = (start, duration, reading.findtext(f'{IEEE_PREFIX}value'))
+                elif start <= gap_start and newest is not None and newest > start:
+                    break
+                newest = start
+
+        return [readings[start] for start in sorted(readings)]
+
+    def _work(self) -> None:
+        while True:
+            gap = self._gaps.get()
+            if gap is None:
+                return
+            endpoint, gap_start, gap_end = gap
+            with self._lock:
+                reading_sets = self._reading_sets.get(endpoint)
+            if reading_sets is None:
+                continue
+            try:
+                readings = self.fetch_gap(reading_sets, gap_start, gap_end)
+            except (requests.RequestException, ET.ParseError, TypeError, ValueError) as e:
+                logger.warning(f'Could not backfill {endpoint.name}: {e}')
+                continue
+            published = endpoint.publish_backfill(readings)
+            METRICS.inc('xcel_backfilled_readings_total', endpoint._metric_labels, published)
+            logger.info(f'Backfilled {published} readings of {endpoint.name}')
+
+    def close(self) -> None:
+        """
+        Writes out the progress and ends the background thread once the
+        gaps already queued are done
+        """
+        self.flush()
+        self._gaps.put(None)
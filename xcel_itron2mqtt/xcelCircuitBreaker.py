@@ -0,0 +1,150 @@
+import random
+import logging
+import threading
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Values of the xcel_circuit_state gauge
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+class xcelRetryBudget():
+    """
+    Caps how many retries a meter gets, shared by all of its endpoints.
+    Every request earns ratio of a retry and a slow trickle of min_rate
+    retries per second keeps a quiet meter from being locked out, so a
+    meter that starts failing everywhere at once can't be hammered with
+    more than a fraction of its normal traffic.
+    """
+    def __init__(self, ratio: float = 0.2, min_rate: float = 0.1, max_tokens: float = 10.0):
+        self.ratio = ratio
+        self.min_rate = min_rate
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._updated) * self.min_rate)
+        self._updated = now
+
+    def deposit(self) -> None:
+        """
+        Called for every first attempt sent to the meter
+        """
+        with self._lock:
+            self._refill(monotonic())
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """
+        Takes one retry out of the budget
+
+        Returns: bool, False if the budget is spent
+        """
+        with self._lock:
+            self._refill(monotonic())
+            if self._tokens < 1.0:
+                return False
+            self._tokens -= 1.0
+            return True
+
+    @property
+    def tokens(self) -> float:
+        with self._lock:
+            self._refill(monotonic())
+            return self._tokens
+
+
+class xcelCircuitBreaker():
+    """
+    Health of a single endpoint. Closed lets every poll through. After
+    failure_threshold failures in a row the circuit opens and the
+    endpoint isn't queried until reset_timeout has passed, then one
+    half-open probe decides whether it closes again or stays open for
+    twice as long, up to max_reset_timeout.
+    """
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0,
+                    max_reset_timeout: float = 600.0, retry_delay: float = 1.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.base_reset_timeout = reset_timeout
+        self.max_reset_timeout = max(reset_timeout, max_reset_timeout)
+        self.base_retry_delay = retry_delay
+
+        self.state = CLOSED
+        self.failures = 0
+        self.reset_timeout = reset_timeout
+        self._opened_until = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        Whether a request may be sent now. Moves an open circuit whose
+        timeout ran out to half-open and lets exactly one probe through.
+        A probe that never reports back is given up on after another
+        reset_timeout, so the circuit can't get stuck half-open.
+
+        Returns: bool
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = monotonic()
+            if now >= self._opened_until:
+                self.state = HALF_OPEN
+                # Deadline of the probe that is now in flight
+                self._opened_until = now + self.reset_timeout
+                return True
+            return False
+
+    def record_success(self) -> str:
+        """
+        Returns: str, the state before the success
+        """
+        with self._lock:
+            previous = self.state
+            self.state = CLOSED
+            self.failures = 0
+            self.reset_timeout = self.base_reset_timeout
+            return previous
+
+    def record_failure(self) -> str:
+        """
+        Returns: str, the state after the failure
+        """
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                # The probe failed, stay away for longer this time
+                self.reset_timeout = min(self.max_reset_timeout, self.reset_timeout * 2)
+                self._open()
+            elif self.state == CLOSED and self.failures >= self.failure_threshold:
+                self._open()
+            return self.state
+
+    def _open(self) -> None:
+        self.state = OPEN
+        self._opened_until = monotonic() + self.reset_timeout
+
+    def time_until_probe(self) -> float:
+        """
+        Returns: float, seconds until an open circuit lets a probe
+        through, or until a half-open probe in flight is given up on
+        """
+        with self._lock:
+            return max(0.0, self._opened_until - monotonic()) if self.state != CLOSED else 0.0
+
+    def retry_delay(self) -> float:
+        """
+        Exponential backoff with jitter for the next retry of a failed
+        request, so the endpoints of one meter don't retry in lockstep
+
+        Returns: float, seconds
+        """
+        with self._lock:
+            delay = self.base_retry_delay * 2 ** max(0, self.failures - 1)
+        return random.uniform(delay / 2, delay)
@@ -0,0 +1,83 @@
+import logging
+from xcelDataType import UomType
+
+logger = logging.getLogger(__name__)
+
+# Reading fields that are always plain integers on the meter
+INTEGER_READINGS = ('timePeriodduration', 'timePeriodstart', 'touTier', 'qualityFlags')
+
+# Units each meter unit may be converted to, {uom: {unit: power of ten}}
+UNIT_CONVERSIONS = {
+    UomType.W.name: {'W': 0, 'kW': -3},
+    UomType.var.name: {'var': 0, 'kvar': -3},
+    UomType.Wh.name: {'Wh': 0, 'kWh': -3},
+    UomType.VARh.name: {'VARh': 0, 'kVARh': -3},
+}
+
+class xcelDecoder():
+    """
+    Turns the raw text of an endpoint's readings into numbers. The value
+    is scaled by the ReadingType powerOfTenMultiplier and converted to
+    the preferred unit, both folded into a single power of ten when the
+    decoder is built so each reading costs one int() and one division.
+    """
+    def __init__(self, power_of_ten: int = 0, uom: str = None, preferred_units: tuple = ()):
+        self.uom = uom
+        self.unit = uom
+        exponent = power_of_ten
+        conversions = UNIT_CONVERSIONS.get(uom, {})
+        for unit in preferred_units:
+            if unit in conversions:
+                self.unit = unit
+                exponent += conversions[unit]
+                break
+        self.exponent = exponent
+        self._scale = 10 ** abs(exponent)
+
+    @classmethod
+    def from_endpoint(cls, endpoint: dict, preferred_units: tuple = ()) -> 'xcelDecoder':
+        """
+        Builds the decoder of an endpoints.yaml entry from its decode key,
+        falling back to the unit of its value tag for hand written entries
+
+        Returns: xcelDecoder
+        """
+        decode = endpoint.get('decode') or {}
+        uom = decode.get('uom')
+        if uom is None:
+            value_tag = endpoint.get('tags', {}).get('value')
+            uom = value_tag.get('unit_of_measurement') if isinstance(value_tag, dict) else None
+
+        return cls(int(decode.get('powerOfTenMultiplier', 0)), uom, preferred_units)
+
+    def decode_value(self, text: str) -> int | float:
+        """
+        Returns: int, or float if the value had to be scaled down
+        """
+        value = int(text)
+        if self.exponent >= 0:
+            return value * self._scale
+        # Dividing by an exact power of ten keeps e.g. 1234 Wh at 1.234 kWh
+        return round(value / self._scale, -self.exponent)
+
+    def decode(self, readings: dict) -> dict:
+        """
+        Decodes every known reading, anything that can't be parsed is
+        left as the meter sent it
+
+        Returns: dict, {<reading key>: <value>}
+        """
+        decoded = {}
+        for key, text in readings.items():
+            try:
+                if key == 'value':
+                    decoded[key] = self.decode_value(text)
+                elif key in INTEGER_READINGS:
+                    decoded[key] = int(text)
+                else:
+                    decoded[key] = text
+            except (TypeError, ValueError):
+                logger.debug(f'Could not decode {key}={text!r}, leaving it as is')
+                decoded[key] = text
+
+        return decoded
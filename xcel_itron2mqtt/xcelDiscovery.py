@@ -0,0 +1,198 @@
+import json
+import logging
+import threading
+from time import monotonic
+import paho.mqtt.client as mqtt
+from xcelOutbox import xcelOutbox
+
+logger = logging.getLogger(__name__)
+
+DISCOVERY_MODES = ('entity', 'device')
+
+ORIGIN = {'name': 'xcel_itron2mqtt', 'support_url': 'https://github.com/zaknye/xcel_itron2mqtt'}
+
+class xcelDiscovery():
+    """
+    Collects the Home Assistant discovery configs of all of a meter's
+    endpoints and publishes them in one go, either as one retained
+    message per entity or as a single device discovery message holding
+    every component. Before publishing, the configs already retained on
+    the broker are read back and only the ones that differ are sent, so
+    a restart with nothing new doesn't churn the broker or Home
+    Assistant's entity registry.
+    """
+    def __init__(self, mqtt_client: mqtt.Client, outbox: xcelOutbox = None, mode: str = 'entity',
+                    diff: bool = True, diff_timeout: float = 2.0, prefix: str = 'homeassistant/',
+                    quiet_period: float = 0.1):
+        if mode not in DISCOVERY_MODES:
+            raise ValueError(f'Unknown discovery mode {mode}, expected one of {DISCOVERY_MODES}')
+        self.client = mqtt_client
+        self.outbox = outbox
+        self.mode = mode
+        self.diff = diff
+        self.diff_timeout = diff_timeout
+        # The broker sends the retained messages right after the SUBACK, once
+        # it has been silent this long there is nothing more to come
+        self.quiet_period = quiet_period
+        self.prefix = prefix
+        self.device_info = None
+        # {config topic: payload dict} of every entity
+        self.configs = {}
+        # Sensors that show up later are published from the polling threads
+        self._lock = threading.Lock()
+
+    def add(self, device_info: dict, configs: dict) -> None:
+        """
+        Adds an endpoint's {config topic: payload dict} to the next publish
+        """
+        with self._lock:
+            self.device_info = device_info
+            self.configs.update(configs)
+
+    def get_device_topic(self) -> str:
+        identifier = self.device_info['device']['identifiers'][0]
+        return f'{self.prefix}device/{identifier}/config'
+
+    def build_device_config(self) -> dict:
+        """
+        Folds the per entity configs into one device discovery payload,
+        the device is described once and every entity becomes a component
+
+        Returns: dict
+        """
+        components = {}
+        for topic, payload in self.configs.items():
+            component = {k: v for k, v in payload.items() if k != 'device'}
+            # Entity configs live at <prefix><platform>/<node>/<object>/config
+            component['platform'] = topic.removeprefix(self.prefix).split('/')[0]
+            components[payload['unique_id']] = component
+
+        return {'device': self.device_info['device'], 'origin': ORIGIN, 'components': components}
+
+    def build_messages(self) -> dict:
+        """
+        Everything the broker should retain for this meter's discovery.
+        Topics of the other mode map to None so they get cleared when
+        switching between modes, after the new configs are out.
+
+        Returns: dict, {topic: payload dict or None}
+        """
+        device_topic = self.get_device_topic()
+        if self.mode == 'device':
+            messages = {device_topic: self.build_device_config()}
+            messages.update({topic: None for topic in self.configs})
+        else:
+            messages = dict(self.configs)
+            messages[device_topic] = None
+
+        return messages
+
+    def read_retained(self, topics: list) -> dict:
+        """
+        Subscribes to the topics just long enough to receive what the
+        broker retained for them: until it has gone quiet for
+        quiet_period after acknowledging the subscription, or diff_timeout
+        at the most. Topics that aren't retained don't hold it up.
+
+        Returns: dict, {topic: payload bytes}
+        """
+        retained = {}
+        lock = threading.Lock()
+        activity = threading.Event()
+        acked = set()
+        # Monotonic time of the SUBACK or the last retained message after it
+        last_activity = [None]
+
+        def on_message(client, userdata, message):
+            if not message.retain:
+                return
+            with lock:
+                retained[message.topic] = message.payload
+                last_activity[0] = monotonic()
+            activity.set()
+
+        on_subscribe = self.client.on_subscribe
+        def on_suback(client, userdata, mid, *args):
+            if on_subscribe:
+                on_subscribe(client, userdata, mid, *args)
+            with lock:
+                acked.add(mid)
+                last_activity[0] = monotonic()
+            activity.set()
+
+        for topic in topics:
+            self.client.message_callback_add(topic, on_message)
+        self.client.on_subscribe = on_suback
+        try:
+            _, mid = self.client.subscribe([(topic, 0) for topic in topics])
+            deadline = monotonic() + self.diff_timeout
+            while monotonic() < deadline:
+                now = monotonic()
+                with lock:
+                    quiet_until = last_activity[0] + self.quiet_period if mid in acked else deadline
+                if now >= quiet_until:
+                    break
+                activity.clear()
+                activity.wait(min(quiet_until, deadline) - now)
+            self.client.unsubscribe(topics)
+        finally:
+            self.client.on_subscribe = on_subscribe
+            for topic in topics:
+                self.client.message_callback_remove(topic)
+        with lock:
+            return dict(retained)
+
+    @staticmethod
+    def is_current(payload: dict | None, retained: bytes | None) -> bool:
+        if not retained:
+            return payload is None
+        if payload is None:
+            return False
+        try:
+            return json.loads(retained) == payload
+        except ValueError:
+            return False
+
+    def publish(self) -> int:
+        """
+        Publishes the collected configs that the broker doesn't already
+        hold. Without a broker connection everything is sent.
+
+        Returns: int, number of messages published
+        """
+        with self._lock:
+            return self._publish()
+
+    def _publish(self) -> int:
+        if not self.configs:
+            return 0
+        messages = self.build_messages()
+        retained = {}
+        if self.diff and self.client.is_connected():
+            retained = self.read_retained(list(messages))
+        elif not self.diff:
+            # Without reading them back we can't tell whether the other
+            # mode's topics exist, leave them be
+            messages = {topic: payload for topic, payload in messages.items() if payload is not None}
+
+        published = 0
+        for topic, payload in messages.items():
+            if self.diff and self.is_current(payload, retained.get(topic)):
+                continue
+            self.publish_message(topic, '' if payload is None else json.dumps(payload))
+            published += 1
+        logger.info(f'Published {published} of {len(messages)} discovery messages, the rest were unchanged')
+
+        return published
+
+    def publish_message(self, topic: str, message: str) -> None:
+        # Same ordering rules as the endpoints, queue behind the outbox if it has anything
+        if self.outbox is not None and (len(self.outbox) or not self.client.is_connected()):
+            self.outbox.put(topic, message, retain=True)
+            return
+        result = self.client.publish(topic, message, retain=True)
+        if result[0] != mqtt.MQTT_ERR_SUCCESS:
+            if self.outbox is not None:
+                self.outbox.put(topic, message, retain=True)
+            else:
+                logger.warning(f'Failed to publish to {topic}: {mqtt.error_string(result[0])}')
@@ -1,17 +1,31 @@
+import re
 import yaml
 import json
+import hashlib
 import requests
 import logging
+import threading
+from time import perf_counter
 import paho.mqtt.client as mqtt
 import xml.etree.ElementTree as ET
 from copy import deepcopy
-from tenacity import retry, stop_after_attempt, before_sleep_log, wait_exponential
+from xcelPublishFilter import xcelPublishFilter
+from xcelMetrics import METRICS
+from xcelAdaptiveRate import xcelAdaptiveRate
+from xcelOutbox import xcelOutbox
+from xcelHistory import xcelHistory
+from xcelDecoder import xcelDecoder
+from xcelDiscovery import xcelDiscovery
+from xcelCircuitBreaker import xcelCircuitBreaker, xcelRetryBudget, CLOSED, OPEN, STATE_VALUES
 
 logger = logging.getLogger(__name__)
 
 # Prefix that appears on all of the XML elements
 IEEE_PREFIX = '{urn:ieee:std:2030.5:ns}'
 
+# Extraction plans shared between endpoints, keyed by tag layout
+_EXTRACTION_PLANS = {}
+
 class xcelEndpoint():
     """
     Class wrapper for all readings associated with the Xcel meter.
@@ -19,64 +33,200 @@ class xcelEndpoint():
     instances.
     """
     def __init__(self, session: requests.Session, mqtt_client: mqtt.Client, 
-                    url: str, name: str, tags: list, device_info: dict):
+                    url: str, name: str, tags: list, device_info: dict,
+                    polling_rate: float = None,
+                    meter_poll_rate: float = None,
+                    publish_filter: xcelPublishFilter = None,
+                    json_state: bool = False,
+                    node_id: str = None,
+                    adaptive_rate: xcelAdaptiveRate = None,
+                    outbox: xcelOutbox = None,
+                    history: xcelHistory = None,
+                    decoder: xcelDecoder = None,
+                    backfill=None,
+                    discovery: xcelDiscovery = None,
+                    circuit_breaker: xcelCircuitBreaker = None,
+                    retry_budget: xcelRetryBudget = None,
+                    aggregates=None,
+                    recorder=None):
         self.requests_session = session
         self.url = url
         self.name = name
         self.tags = tags
+        # Optional per-endpoint polling period, the meter default is used if None
+        self.polling_rate = polling_rate
+        # Seconds the meter says the reading takes to change, from its pollRate
+        self.meter_poll_rate = meter_poll_rate
+        # Adjusts polling_rate to how often the readings change, if set
+        self.adaptive_rate = adaptive_rate
+        if adaptive_rate is not None:
+            self.polling_rate = adaptive_rate.period
+        # Compile the tags once instead of walking them on every poll
+        self._extraction_plan = self.compile_extraction_plan(tags)
+        # Turns the extracted text into scaled, typed values
+        self.decoder = decoder if decoder else xcelDecoder.from_endpoint({'tags': tags})
+        # Decides which readings actually changed enough to be sent
+        self._publish_filter = publish_filter if publish_filter else xcelPublishFilter(suppress_unchanged=False)
         self.client = mqtt_client
         self.device_info = device_info
+        # Holds messages while the broker is unreachable, if set
+        self.outbox = outbox
+        # Keeps recent readings in memory for export, if set
+        self.history = history
+        # Fills in readings missed while the bridge was down, if set
+        self.backfill = backfill
+        # Rolls the readings up into hourly and daily sensors, if set
+        self.aggregates = aggregates
+        # Captures the raw responses for replaying later, if set
+        self.recorder = recorder
+        # Publish one JSON document per poll instead of one message per sensor
+        self.json_state = json_state
+        self._metric_labels = {'meter': device_info['device']['name'], 'endpoint': self.name}
+        # MQTT node id the endpoint's topics are grouped under
+        self.node_id = node_id if node_id else self.name.replace(" ", "_")
 
         self._mqtt_topic_prefix = 'homeassistant/'
-        self._current_response = None
+        self.current_response = None
+        # Digest of the last polled response body, a poll answered with the
+        # same bytes reuses current_response instead of parsing it again
+        self._response_digest = None
+        # Seconds the last request to the meter took
+        self.last_response_time = None
         self._mqtt_topic = None
         # Record all of the sensor state topics in an easy to lookup dict
         self._sensor_state_topics = {}
+        # Polls and pushed notifications may arrive at the same time
+        self._reading_lock = threading.Lock()
+        # Failed requests are retried by rescheduling the poll instead of
+        # sleeping on it, within the meter's retry budget if there is one
+        self.circuit_breaker = circuit_breaker if circuit_breaker else xcelCircuitBreaker()
+        self.retry_budget = retry_budget
+        # Seconds until the poller should run this endpoint again instead
+        # of waiting for its period, set after a failed poll
+        self.retry_delay = None
+        self._retrying = False
+        self.set_circuit_state(self.circuit_breaker.state)
 
-        # Setup the rest of what we need for this endpoint
-        self.mqtt_send_config()
+        # Setup the rest of what we need for this endpoint, the configs are
+        # left to the meter's discovery publisher if there is one
+        self.discovery = discovery
+        if discovery is not None:
+            discovery.add(self.device_info, self.get_configs())
+        else:
+            self.mqtt_send_config()
 
-    @retry(stop=stop_after_attempt(15),
-           wait=wait_exponential(multiplier=1, min=1, max=15),
-           before_sleep=before_sleep_log(logger, logging.WARNING),
-           reraise=True)
-    def query_endpoint(self) -> str:
+    def query_endpoint(self) -> bytes:
         """
         Sends a request to the given endpoint associated with the 
         object instance
 
-        Returns: str in XML format of the meter's response
+        Returns: bytes in XML format of the meter's response
+        """
+        start = perf_counter()
+        # Failed requests are timed too, timeouts are the slowest of all
+        result = 'error'
+        try:
+            x = self.requests_session.get(self.url, verify=False, timeout=15.0)
+            result = 'success' if x.ok else 'http_error'
+        except requests.Timeout:
+            result = 'timeout'
+            raise
+        finally:
+            duration = perf_counter() - start
+            METRICS.observe('xcel_request_duration_seconds', duration, {**self._metric_labels, 'result': result})
+        self.last_response_time = duration
+        if self.recorder is not None:
+            self.recorder.record_response(self._metric_labels['meter'], self.name, x.status_code, x.text)
+        x.raise_for_status()
+
+        # The XML declares its own encoding, no need to have requests guess it
+        return x.content
+
+    @staticmethod
+    def compile_extraction_plan(tags: dict) -> dict:
+        """
+        Flattens the endpoints.yaml tag structure into a lookup of
+        namespaced XML element tag to the key used in the readings dict.
+        Plans are cached by tag layout so endpoints sharing the same
+        layout also share the same plan.
+
+        Returns: dict, {<namespaced element tag>: <reading key>}
+        """
+        layout = tuple((k, tuple(k2 for val_items in v for k2 in val_items))
+                       if isinstance(v, list) else (k, None)
+                       for k, v in tags.items())
+        plan = _EXTRACTION_PLANS.get(layout)
+        if plan is None:
+            plan = {}
+            for k, children in layout:
+                if children is None:
+                    plan.setdefault(f'{IEEE_PREFIX}{k}', k)
+                else:
+                    for k2 in children:
+                        plan.setdefault(f'{IEEE_PREFIX}{k2}', f'{k}{k2}')
+            _EXTRACTION_PLANS[layout] = plan
+
+        return plan
+
+    @staticmethod
+    def get_poll_rate(element: ET.Element) -> int | None:
+        """
+        Reads the pollRate attribute IEEE 2030.5 resources advertise, the
+        fastest the meter expects them to be polled
+
+        Returns: int, seconds, or None if it is missing or invalid
+        """
+        try:
+            poll_rate = int(element.get('pollRate'))
+        except (TypeError, ValueError):
+            return None
+
+        return poll_rate if poll_rate > 0 else None
+
+    @staticmethod
+    def get_extraction_plan(tags: dict) -> dict:
+        """
+        Accepts either the endpoints.yaml tag structure or a plan that
+        has already been compiled, whose keys are namespaced element tags
+
+        Returns: dict, {<namespaced element tag>: <reading key>}
         """
-        x = self.requests_session.get(self.url, verify=False, timeout=15.0)
-    
-        return x.text
+        if next(iter(tags), IEEE_PREFIX).startswith(IEEE_PREFIX):
+            return tags
+
+        return xcelEndpoint.compile_extraction_plan(tags)
 
     @staticmethod
-    def parse_response(response: str, tags: dict) -> dict:
+    def parse_response(response: str | bytes, tags: dict) -> dict:
         """
-        Drill down the XML response from the meter and extract the
-        readings according to the endpoints.yaml structure.
+        Walk the XML response from the meter once and extract the
+        readings according to the endpoints.yaml tags, or a plan
+        compiled from them. The first element found for each tag wins.
 
         Returns: dict in the nesting structure of found below each tag
         in the endpoints.yaml
         """
+        return xcelEndpoint.parse_element(ET.fromstring(response), tags)
+
+    @staticmethod
+    def parse_element(root: ET.Element, tags: dict) -> dict:
+        """
+        Same as parse_response for an already parsed element, such as
+        the Resource of a notification
+
+        Returns: dict, {<reading key>: <element text>}
+        """
+        plan = xcelEndpoint.get_extraction_plan(tags)
         readings_dict = {}
-        root = ET.fromstring(response)
-        # Kinda gross
-        for k, v in tags.items():
-            if isinstance(v, list):
-                for val_items in v:
-                    for k2, v2 in val_items.items():
-                        search_val = f'{IEEE_PREFIX}{k2}'
-                        if root.find(f'.//{search_val}') is not None:
-                            value = root.find(f'.//{search_val}').text
-                            readings_dict[f'{k}{k2}'] = value
-            else:
-                search_val = f'{IEEE_PREFIX}{k}'
-                if root.find(f'.//{IEEE_PREFIX}{k}') is not None:
-                    value = root.find(f'.//{IEEE_PREFIX}{k}').text
-                    readings_dict[k] = value
-    
+        for element in root.iter():
+            key = plan.get(element.tag)
+            if key is None or element is root or key in readings_dict:
+                continue
+            readings_dict[key] = element.text
+            # Everything we are looking for has been found
+            if len(readings_dict) == len(plan):
+                break
+
         return readings_dict
 
     def get_reading(self) -> dict:
@@ -86,23 +236,119 @@ class xcelEndpoint():
         
         Returns: Dict in the form of {reading: value}
         """
-        response = self.query_endpoint()
-        self.current_response = self.parse_response(response, self.tags)
+        response = self.fetch_response()
+        start = perf_counter()
+        # Not compared to the next poll, make sure that one is parsed
+        self._response_digest = None
+
+        return self.ingest(ET.fromstring(response), start)
+
+    def fetch_response(self) -> bytes:
+        """
+        Queries the endpoint once, counting the request against the
+        retry budget unless it is itself a retry
+
+        Returns: bytes in XML format of the meter's response
+        """
+        if self.retry_budget is not None and not self._retrying:
+            self.retry_budget.deposit()
+
+        return self.query_endpoint()
+
+    def set_circuit_state(self, state: str) -> None:
+        METRICS.set('xcel_circuit_state', STATE_VALUES[state], self._metric_labels)
+
+    def handle_success(self) -> None:
+        self._retrying = False
+        if self.circuit_breaker.record_success() != CLOSED:
+            self.set_circuit_state(CLOSED)
+            logger.info(f'{self.name} is answering again')
+
+    def handle_failure(self, error: Exception) -> None:
+        """
+        Works out when a failed endpoint is queried next: soon if a retry
+        is allowed, once the circuit lets a probe through if it opened,
+        or on its normal schedule if the meter's retry budget is spent
+        """
+        state = self.circuit_breaker.record_failure()
+        self.set_circuit_state(state)
+        self._retrying = False
+        if state == OPEN:
+            self.retry_delay = self.circuit_breaker.time_until_probe()
+            METRICS.inc('xcel_request_giveups_total', self._metric_labels)
+            logger.warning(f'{self.name} failed {self.circuit_breaker.failures} times in a row, '
+                           f'not querying it for {self.retry_delay:.0f}s: {error}')
+        elif self.retry_budget is None or self.retry_budget.withdraw():
+            self.retry_delay = self.circuit_breaker.retry_delay()
+            if self.polling_rate:
+                self.retry_delay = min(self.retry_delay, float(self.polling_rate))
+            self._retrying = True
+            METRICS.inc('xcel_request_retries_total', self._metric_labels)
+            logger.warning(f'Querying {self.name} failed, retrying in {self.retry_delay:.1f}s: {error}')
+        else:
+            METRICS.inc('xcel_request_giveups_total', self._metric_labels)
+            logger.warning(f'Querying {self.name} failed and the retry budget is spent, '
+                           f'waiting for the next poll: {error}')
+
+    def ingest(self, root: ET.Element, start: float = None) -> dict:
+        """
+        Extracts and decodes the readings of a Reading element, whether
+        it was polled or pushed by the meter, and records them
+
+        Returns: Dict in the form of {reading: value}
+        """
+        start = perf_counter() if start is None else start
+        self.current_response = self.decoder.decode(self.parse_element(root, self._extraction_plan))
+        METRICS.observe('xcel_parse_duration_seconds', perf_counter() - start, self._metric_labels)
+        self.record_reading(self.current_response)
 
         return self.current_response
 
-    def create_config(self, sensor_name: str,  details: dict) -> tuple[str, dict]:
+    def record_reading(self, reading: dict) -> None:
+        """
+        Marks the sensors of a reading as fresh and keeps it in the history
+        """
+        sensor_readings = self.get_sensor_readings(reading)
+        for sensor_name in sensor_readings:
+            METRICS.touch('xcel_reading_age_seconds', {**self._metric_labels, 'sensor': sensor_name})
+        if self.history is not None:
+            self.history.record(self._metric_labels['meter'], self.name, sensor_readings)
+
+    def create_config(self, sensor_name: str,  details: dict) -> tuple[str, str]:
         """
         Helper to generate the JSON sonfig payload for setting
         up the new Homeassistant entities
 
+        Returns: Tuple consisting of a string representing the mqtt
+        topic, and the JSON payload.
+        """
+        mqtt_topic, payload = self.build_config(sensor_name, details)
+
+        return mqtt_topic, json.dumps(payload)
+
+    def build_config(self, sensor_name: str, details: dict) -> tuple[str, dict]:
+        """
+        Builds the config payload of one sensor and records its
+        state topic
+
         Returns: Tuple consisting of a string representing the mqtt
         topic, and a dict to be used as the payload.
         """
         payload = deepcopy(details)
-        mqtt_friendly_name = self.name.replace(" ", "_")
+        mqtt_friendly_name = self.node_id
         entity_type = payload.pop('entity_type')
-        payload["state_topic"] = f'{self._mqtt_topic_prefix}{entity_type}/{mqtt_friendly_name}/{sensor_name}/state'
+        if self.json_state:
+            # Every sensor picks its field out of the endpoint's one state document
+            payload["state_topic"] = f'{self._mqtt_topic_prefix}{entity_type}/{mqtt_friendly_name}/state'
+            payload['value_template'] = re.sub(r'\bvalue\b', f'value_json.{sensor_name}',
+                                               payload.get('value_template', '{{ value }}'))
+            if sensor_name == 'value':
+                payload['json_attributes_topic'] = payload['state_topic']
+        else:
+            payload["state_topic"] = f'{self._mqtt_topic_prefix}{entity_type}/{mqtt_friendly_name}/{sensor_name}/state'
+        # The decoder may have converted the value to another unit
+        if sensor_name == 'value' and self.decoder.unit and 'unit_of_measurement' in payload:
+            payload['unit_of_measurement'] = self.decoder.unit
         payload['name'] = f'{self.name} {sensor_name}'.title()
         # Mouthful
         # Unique ID becomes the device name + class name + sensor name, all lower case, all underscores instead of spaces
@@ -112,31 +358,54 @@ class xcelEndpoint():
         mqtt_topic = f'{self._mqtt_topic_prefix}{entity_type}/{mqtt_friendly_name}/{sensor_name}/config'
         # Capture the state topic the sensor is associated with for later use
         self._sensor_state_topics[sensor_name] = payload['state_topic']
-        payload = json.dumps(payload)
 
         return mqtt_topic, payload
 
-    def mqtt_send_config(self) -> None:
+    def get_configs(self) -> dict:
         """
-        Homeassistant requires a config payload to be sent to more
-        easily setup the sensor/device once it appears over mqtt
-        https://www.home-assistant.io/integrations/mqtt/
+        Builds the config of every sensor of this endpoint
+
+        Returns: dict, {<config topic>: <payload dict>}
         """
-        _tags = deepcopy(self.tags)
-        for k, v in _tags.items():
+        configs = {}
+        for k, v in self.tags.items():
             if isinstance(v, list):
                 for val_items in v:
-                    name, details = val_items.popitem()
+                    # build_config copies the details, no need to copy the tags
+                    name, details = next(iter(val_items.items()))
                     sensor_name = f'{k}{name}'
                     if f'{name}' == 'duration': sensor_name = 'Duration'
                     if f'{name}' == 'start': sensor_name = 'Timestamp'
-                    mqtt_topic, payload = self.create_config(sensor_name, details)
-                    # Send MQTT payload
-                    self.mqtt_publish(mqtt_topic, str(payload))
+                    mqtt_topic, payload = self.build_config(sensor_name, details)
+                    configs[mqtt_topic] = payload
             else:
-                name_suffix = f'{k[0].upper()}'
-                mqtt_topic, payload = self.create_config(k, v)
-                self.mqtt_publish(mqtt_topic, str(payload), retain=True)
+                mqtt_topic, payload = self.build_config(k, v)
+                configs[mqtt_topic] = payload
+
+        return configs
+
+    def mqtt_send_config(self) -> None:
+        """
+        Homeassistant requires a config payload to be sent to more
+        easily setup the sensor/device once it appears over mqtt
+        https://www.home-assistant.io/integrations/mqtt/
+        """
+        for mqtt_topic, payload in self.get_configs().items():
+            self.mqtt_publish(mqtt_topic, json.dumps(payload), retain=True)
+
+    def send_configs(self, configs: dict) -> None:
+        """
+        Announces sensors added after the endpoint was set up, through the
+        meter's discovery publisher if there is one
+
+        Returns: None
+        """
+        if self.discovery is not None:
+            self.discovery.add(self.device_info, configs)
+            self.discovery.publish()
+            return
+        for mqtt_topic, payload in configs.items():
+            self.mqtt_publish(mqtt_topic, json.dumps(payload), retain=True)
 
     def process_send_mqtt(self, reading: dict) -> None:
         """
@@ -145,13 +414,21 @@ class xcelEndpoint():
 
         Returns: None
         """
+        if self.json_state:
+            self.process_send_mqtt_json(reading)
+            return
+
+        timestamp = self.get_reading_timestamp(reading)
         mqtt_topic_message = {}
         # Cycle through all the readings for the given sensor
-        for k, v in reading.items():
+        for k, v in self.get_sensor_readings(reading).items():
             # Figure out which topic this reading needs to be sent to
-            if f'{k}' == 'timePeriodduration': k = 'Duration'
-            if f'{k}' == 'timePeriodstart': k = 'Timestamp'
             topic = self._sensor_state_topics[k]
+            # Skip readings that haven't changed since they were last sent
+            if not self._publish_filter.should_publish(k, v):
+                logger.debug(f'{self.name} {k} unchanged, not publishing')
+                METRICS.inc('xcel_publish_suppressed_total', self._metric_labels)
+                continue
             if topic not in mqtt_topic_message.keys():
                 mqtt_topic_message[topic] = {}
             # Create dict of {topic: payload}
@@ -159,29 +436,195 @@ class xcelEndpoint():
 
         # Cycle through and send the payload to the associated keys
         for topic, payload in mqtt_topic_message.items():
-            self.mqtt_publish(topic, payload)
+            self.mqtt_publish(topic, payload, timestamp=timestamp)
+
+    def process_send_mqtt_json(self, reading: dict) -> None:
+        """
+        Sends all of the readings as a single JSON document to the
+        endpoint's state topic, if any of them changed
+
+        Returns: None
+        """
+        sensor_readings = self.get_sensor_readings(reading)
+        if not self._publish_filter.should_publish_all(sensor_readings):
+            logger.debug(f'{self.name} unchanged, not publishing')
+            METRICS.inc('xcel_publish_suppressed_total', self._metric_labels)
+            return
+        # All of the sensors share the same state topic in this mode
+        topic = next(iter(self._sensor_state_topics.values()))
+        self.mqtt_publish(topic, json.dumps(sensor_readings), timestamp=self.get_reading_timestamp(reading))
 
-    def mqtt_publish(self, topic: str, message: str, retain=False) -> int:
+    @staticmethod
+    def get_reading_timestamp(reading: dict) -> float | None:
         """
-        Publish the given message to the topic associated with the class
+        The meter's own time of a reading, readings without one were
+        taken when they were polled
+
+        Returns: float, epoch seconds, or None if the reading has no time
+        """
+        try:
+            return float(reading['timePeriodstart'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def get_sensor_readings(reading: dict) -> dict:
+        """
+        Renames the parsed readings to the sensor names used for
+        their Homeassistant entities
+
+        Returns: dict, {<sensor name>: <value>}
+        """
+        sensor_readings = {}
+        for k, v in reading.items():
+            if f'{k}' == 'timePeriodduration': k = 'Duration'
+            if f'{k}' == 'timePeriodstart': k = 'Timestamp'
+            sensor_readings[k] = v
+
+        return sensor_readings
+
+    def mqtt_publish(self, topic: str, message: str, retain=False, timestamp: float = None) -> int:
+        """
+        Publish the given message to the topic associated with the class.
+        The timestamp of the reading is kept with it if it has to be queued.
        
         Returns: integer
         """
-        result = [0]
-        #print(f"Sending to MQTT TOPIC:\t{topic}")
-        #print(f"Payload:\t\t{message}")
+        # Keep messages in order behind anything still waiting in the outbox
+        if self.outbox is not None and (len(self.outbox) or not self.client.is_connected()):
+            return self.queue_message(topic, message, retain, timestamp)
         result = self.client.publish(topic, str(message), retain=retain)
-        #print('Error in sending MQTT payload')
-        #print(f"MQTT Send Result: \t\t{result}")
+        if result[0] == mqtt.MQTT_ERR_SUCCESS:
+            METRICS.inc('xcel_mqtt_publish_total', {**self._metric_labels, 'result': 'success'})
+        elif self.outbox is not None:
+            return self.queue_message(topic, message, retain, timestamp)
+        else:
+            METRICS.inc('xcel_mqtt_publish_total', {**self._metric_labels, 'result': 'failure'})
+            logger.warning(f'Failed to publish to {topic}: {mqtt.error_string(result[0])}')
         # Return status of the published message
         return result[0]
 
-    def run(self) -> None:
+    def queue_message(self, topic: str, message: str, retain=False, timestamp: float = None) -> int:
+        """
+        Stores the message in the outbox to be sent once the broker
+        is reachable again
+
+        Returns: integer, MQTT_ERR_SUCCESS if the message was queued
+        """
+        if self.outbox.put(topic, message, retain, timestamp):
+            METRICS.inc('xcel_mqtt_publish_total', {**self._metric_labels, 'result': 'queued'})
+            if self.client.is_connected():
+                self.outbox.start_replay(self.client)
+            return mqtt.MQTT_ERR_SUCCESS
+        METRICS.inc('xcel_mqtt_publish_total', {**self._metric_labels, 'result': 'dropped'})
+
+        return mqtt.MQTT_ERR_QUEUE_SIZE
+
+    def run(self) -> bool:
         """
         Main business loop for the endpoint class.
         Read from the meter, process and send over MQTT
 
-        Returns: None
+        Returns: bool, True if the reading changed since the last poll
         """
-        reading = self.get_reading()
-        self.process_send_mqtt(reading)
+        self.retry_delay = None
+        if not self.circuit_breaker.allow():
+            # Open circuit, the poller brings us back when the probe is due
+            self.retry_delay = self.circuit_breaker.time_until_probe()
+            return False
+        try:
+            response = self.fetch_response()
+            start = perf_counter()
+            digest = hashlib.blake2b(response, digest_size=16).digest()
+            # Byte for byte the body we already have the reading of
+            root = None if digest == self._response_digest else ET.fromstring(response)
+        except (requests.RequestException, ET.ParseError) as e:
+            self.handle_failure(e)
+            return False
+        except Exception as e:
+            # Anything else still has to settle the request, a half-open
+            # probe that is never settled keeps the circuit from closing
+            self.handle_failure(e)
+            raise
+        self.handle_success()
+        if root is None:
+            METRICS.inc('xcel_unchanged_responses_total', self._metric_labels)
+        else:
+            # The meter may change how often it expects to be polled at any time
+            self.meter_poll_rate = self.get_poll_rate(root) or self.meter_poll_rate
+        changed = self.handle_reading(root, start, digest)
+        if self.adaptive_rate is not None:
+            self.polling_rate = self.adaptive_rate.update(changed, self.last_response_time)
+
+        return changed
+
+    def handle_reading(self, root: ET.Element | None, start: float = None, digest: bytes = None) -> bool:
+        """
+        Ingests a Reading element and publishes it. Without an element the
+        last reading is handled again, for a poll answered with the same
+        body as the one before: nothing is parsed, and the publish filter
+        only lets it through once it is due a refresh.
+
+        Returns: bool, True if the reading changed since the last one
+        """
+        with self._reading_lock:
+            previous = self.current_response
+            if root is None:
+                reading = previous
+                self.record_reading(reading)
+            else:
+                reading = self.ingest(root, start)
+            # Only a polled body is compared to the next one, a pushed
+            # reading leaves nothing to compare against
+            self._response_digest = digest
+            self.process_send_mqtt(reading)
+        if self.backfill is not None:
+            self.backfill.observe(self, reading)
+        if self.aggregates is not None:
+            self.aggregates.observe(self, reading)
+
+        return reading != previous
+
+    def get_backfill_topic(self) -> str:
+        return f"{self._sensor_state_topics['value'].removesuffix('/state')}/backfill"
+
+    def get_backfill_config(self) -> dict:
+        """
+        Config of the Backfill sensor the recovered readings are published
+        to. Home Assistant records each one as it arrives, with the meter's
+        Timestamp and Duration as attributes. It has no state_class, so the
+        old register values never end up in the long-term statistics.
+
+        Returns: dict, {<config topic>: <payload dict>}
+        """
+        details = {k: v for k, v in self.tags['value'].items() if k != 'state_class'}
+        mqtt_topic, payload = self.build_config('Backfill', details)
+        payload['state_topic'] = self.get_backfill_topic()
+        payload['json_attributes_topic'] = payload['state_topic']
+        payload['value_template'] = '{{ value_json.value }}'
+        # Not one of the readings, nothing publishes to the default state topic
+        self._sensor_state_topics.pop('Backfill', None)
+
+        return {mqtt_topic: payload}
+
+    def publish_backfill(self, readings: list) -> int:
+        """
+        Publishes readings recovered from the meter's interval data, each
+        as a JSON document with its original timestamp. They go to the
+        Backfill sensor's topic next to the state topic, so the live state
+        never jumps back in time.
+
+        Returns: int, number of readings published
+        """
+        topic = self.get_backfill_topic()
+        published = 0
+        for start, duration, value in readings:
+            try:
+                value = self.decoder.decode_value(value)
+            except (TypeError, ValueError):
+                continue
+            message = json.dumps({'Timestamp': start, 'Duration': duration, 'value': value})
+            if self.mqtt_publish(topic, message, timestamp=start) == mqtt.MQTT_ERR_SUCCESS:
+                published += 1
+
+        return published
@@ -0,0 +1,71 @@
+import os
+import yaml
+import logging
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+class xcelEndpointCache():
+    """
+    Keeps the endpoint list generated by generateEndpointYaml on disk,
+    keyed by the meter's lFDI, so a restart against the same meter and
+    firmware doesn't have to crawl the meter again.
+    """
+    # Bump whenever the layout of the generated endpoint list changes
+    CACHE_VERSION = 3
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = Path(cache_dir)
+
+    def get_path(self, lfdi: str) -> Path:
+        """
+        Location of the cache file for the given meter
+
+        Returns: Path
+        """
+        return self.cache_dir / f'endpoints_{lfdi}.yaml'
+
+    def load(self, lfdi: str) -> dict | None:
+        """
+        Loads the cached endpoints for the given meter
+
+        Returns: dict, {'swVer': str, 'endpoints': list} or None if there
+        is no usable cache
+        """
+        path = self.get_path(lfdi)
+        if not path.is_file():
+            return None
+        try:
+            with open(path, mode='r', encoding='utf-8') as file:
+                cached = yaml.safe_load(file)
+        except (OSError, yaml.YAMLError) as e:
+            logger.warning(f'Could not read endpoint cache {path}: {e}')
+            return None
+        if not isinstance(cached, dict) or cached.get('version') != self.CACHE_VERSION \
+                or not cached.get('endpoints'):
+            return None
+
+        return cached
+
+    def store(self, lfdi: str, sw_ver: str, endpoints: list) -> None:
+        """
+        Writes the endpoints for the given meter and firmware version
+        to the cache, replacing any previous entry
+
+        Returns: None
+        """
+        path = self.get_path(lfdi)
+        cached = {
+            'version': self.CACHE_VERSION,
+            'lFDI': lfdi,
+            'swVer': sw_ver,
+            'endpoints': endpoints,
+        }
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix('.tmp')
+            with open(tmp_path, mode='w', encoding='utf-8') as file:
+                yaml.safe_dump(cached, file, sort_keys=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f'Could not write endpoint cache {path}: {e}')
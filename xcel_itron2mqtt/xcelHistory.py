@@ -0,0 +1,242 @@
+import io
+import csv
+import sys
+import json
+import argparse
+import threading
+from time import time
+from array import array
+from bisect import bisect_left, bisect_right
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+# Sensors that are timestamps themselves rather than values worth keeping
+SKIPPED_SENSORS = ('Timestamp',)
+
+EXPORT_FORMATS = ('csv', 'json')
+
+# Range of the signed 64-bit timestamps array
+TIMESTAMP_MIN = -2**63
+TIMESTAMP_MAX = 2**63 - 1
+
+class xcelSensorHistory():
+    """
+    Fixed capacity ring of (meter timestamp, value) samples for one
+    sensor, stored in two preallocated typed arrays. Timestamps are
+    signed 64-bit epoch seconds, so a bogus meter clock cannot overflow
+    the ring, and values doubles, 16 bytes per sample.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._timestamps = array('q', bytes(8 * capacity))
+        self._values = array('d', bytes(8 * capacity))
+        self._start = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, timestamp: int, value: float) -> bool:
+        """
+        Adds a sample, overwriting the oldest one once full. A sample
+        with the same timestamp as the latest one is a repeat of the same
+        meter reading and is not stored again, and one older than the
+        latest is dropped so the ring stays in time order.
+
+        Returns: bool, True if the sample was stored
+        """
+        with self._lock:
+            if self._count:
+                last = (self._start + self._count - 1) % self.capacity
+                if timestamp <= self._timestamps[last]:
+                    return False
+            if self._count == self.capacity:
+                self._start = (self._start + 1) % self.capacity
+                self._count -= 1
+            index = (self._start + self._count) % self.capacity
+            self._timestamps[index] = timestamp
+            self._values[index] = value
+            self._count += 1
+
+        return True
+
+    def _ordered(self) -> tuple[array, array]:
+        end = self._start + self._count
+        if end <= self.capacity:
+            return self._timestamps[self._start:end], self._values[self._start:end]
+        end -= self.capacity
+        return (self._timestamps[self._start:] + self._timestamps[:end],
+                self._values[self._start:] + self._values[:end])
+
+    def query(self, start: int = None, end: int = None) -> tuple[array, array]:
+        """
+        Samples between start and end inclusive, oldest first
+
+        Returns: tuple of (timestamps array, values array)
+        """
+        with self._lock:
+            timestamps, values = self._ordered()
+        # append() only stores samples newer than the last, so the range can be bisected
+        low = bisect_left(timestamps, start) if start is not None else 0
+        high = bisect_right(timestamps, end) if end is not None else len(timestamps)
+
+        return timestamps[low:high], values[low:high]
+
+
+class xcelHistory():
+    """
+    In-process history of every sensor reading, one xcelSensorHistory per
+    (meter, endpoint, sensor). Memory use is bounded by the capacity of
+    each ring, so recent load profiles can be pulled without going
+    through the broker or the Home Assistant database.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        # {(meter, endpoint, sensor): xcelSensorHistory}
+        self._series = {}
+
+    def record(self, meter: str, endpoint: str, readings: dict, timestamp: float = None) -> None:
+        """
+        Stores every numeric reading of an endpoint's poll. The meter's
+        own timestamp is used when the reading has one that fits the
+        ring, the time of the poll otherwise.
+
+        Returns: None
+        """
+        if timestamp is None:
+            timestamp = readings.get('Timestamp')
+        try:
+            timestamp = int(float(timestamp))
+        except (TypeError, ValueError, OverflowError):
+            timestamp = None
+        if timestamp is None or not TIMESTAMP_MIN <= timestamp <= TIMESTAMP_MAX:
+            timestamp = int(time())
+        for sensor, value in readings.items():
+            if sensor in SKIPPED_SENSORS:
+                continue
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+            key = (meter, endpoint, sensor)
+            series = self._series.get(key)
+            if series is None:
+                with self._lock:
+                    series = self._series.setdefault(key, xcelSensorHistory(self.capacity))
+            series.append(timestamp, value)
+
+    def series(self) -> list:
+        """
+        Returns: list of the (meter, endpoint, sensor) keys with history
+        """
+        with self._lock:
+            return list(self._series)
+
+    def query(self, meter: str = None, endpoint: str = None, sensor: str = None,
+                start: int = None, end: int = None) -> list:
+        """
+        Samples of every series matching the given meter, endpoint and
+        sensor names (None matches all) between start and end
+
+        Returns: list of (meter, endpoint, sensor, timestamps, values)
+        """
+        with self._lock:
+            matches = [(key, series) for key, series in self._series.items()
+                       if (meter is None or key[0] == meter)
+                       and (endpoint is None or key[1] == endpoint)
+                       and (sensor is None or key[2] == sensor)]
+        results = []
+        for key, series in sorted(matches, key=lambda item: item[0]):
+            timestamps, values = series.query(start, end)
+            results.append((*key, timestamps, values))
+
+        return results
+
+    @staticmethod
+    def to_csv(results: list) -> str:
+        """
+        One row per sample: meter, endpoint, sensor, timestamp, value
+
+        Returns: str
+        """
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['meter', 'endpoint', 'sensor', 'timestamp', 'value'])
+        for meter, endpoint, sensor, timestamps, values in results:
+            for timestamp, value in zip(timestamps, values):
+                writer.writerow([meter, endpoint, sensor, timestamp, value])
+
+        return output.getvalue()
+
+    @staticmethod
+    def to_columns(results: list) -> str:
+        """
+        Columnar JSON, one object per series holding a timestamp
+        column and a value column
+
+        Returns: str
+        """
+        return json.dumps({'series': [{'meter': meter, 'endpoint': endpoint, 'sensor': sensor,
+                                       'timestamp': timestamps.tolist(), 'value': values.tolist()}
+                                      for meter, endpoint, sensor, timestamps, values in results]})
+
+    def export(self, export_format: str = 'csv', **kwargs) -> tuple[str, str]:
+        """
+        Runs a query and renders it in the given format
+
+        Returns: tuple of (content type, body)
+        """
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f'Unknown history format {export_format}, expected one of {EXPORT_FORMATS}')
+        results = self.query(**kwargs)
+        if export_format == 'json':
+            return 'application/json', self.to_columns(results)
+
+        return 'text/csv', self.to_csv(results)
+
+    def http_handler(self, query: dict) -> tuple[str, str]:
+        """
+        Route handler for the metrics HTTP server, takes the meter,
+        endpoint, sensor, start, end and format query parameters
+
+        Returns: tuple of (content type, body)
+        """
+        params = {k: v[-1] for k, v in query.items()}
+        return self.export(params.get('format', 'csv'),
+                           meter=params.get('meter'),
+                           endpoint=params.get('endpoint'),
+                           sensor=params.get('sensor'),
+                           start=int(params['start']) if 'start' in params else None,
+                           end=int(params['end']) if 'end' in params else None)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Export the reading history of a running bridge')
+    parser.add_argument('--url', default='http://localhost:9100',
+                        help='Address of the bridge metrics server, see METRICS_PORT')
+    parser.add_argument('--meter')
+    parser.add_argument('--endpoint')
+    parser.add_argument('--sensor')
+    parser.add_argument('--since', type=int, help='Only export the last number of seconds')
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    parser.add_argument('--output', '-o', help='File to write to instead of stdout')
+    args = parser.parse_args()
+
+    query = {'format': args.format}
+    for name in ('meter', 'endpoint', 'sensor'):
+        if getattr(args, name):
+            query[name] = getattr(args, name)
+    if args.since:
+        query['start'] = int(time()) - args.since
+    with urlopen(f"{args.url.rstrip('/')}/history?{urlencode(query)}", timeout=30) as response:
+        body = response.read()
+    if args.output:
+        with open(args.output, 'wb') as file:
+            file.write(body)
+    else:
+        sys.stdout.buffer.write(body)
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,13 @@
 import os
+import re
 import ssl
 import yaml
 import json
 import requests
 import logging
+import threading
 import paho.mqtt.client as mqtt
 import xml.etree.ElementTree as ET
-from time import sleep
 from typing import Tuple
 from requests.packages.urllib3.util.ssl_ import create_urllib3_context
 from requests.adapters import HTTPAdapter
@@ -14,18 +15,40 @@ from tenacity import retry, stop_after_attempt, before_sleep_log, wait_exponenti
 
 # Local imports
 from xcelEndpoint import xcelEndpoint
+from xcelPoller import xcelPoller
+from xcelPublishFilter import xcelPublishFilter
+from xcelEndpointCache import xcelEndpointCache
+from xcelMetrics import METRICS
+from xcelAdaptiveRate import xcelAdaptiveRate
+from xcelOutbox import xcelOutbox
+from xcelHistory import xcelHistory
+from xcelDecoder import xcelDecoder
+from xcelBackfill import xcelBackfill
+from xcelSubscriptions import xcelNotificationListener, xcelSubscriptionManager
+from xcelDiscovery import xcelDiscovery
+from xcelCircuitBreaker import xcelCircuitBreaker, xcelRetryBudget
+from xcelAggregates import xcelAggregates
+from xcelReplay import xcelRecorder
 from CCM8Adapter import CCM8Adapter
 from generateEndpointYaml import generateEndpointYaml
 
 IEEE_PREFIX = '{urn:ieee:std:2030.5:ns}'
+# Cache folder next to the code, the same one the Docker volume is mounted on,
+# whatever directory the bridge is started from
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
 
 logger = logging.getLogger(__name__)
 
 class xcelMeter():
 
-    def __init__(self, name: str, ip_address: str, port: int, creds: Tuple[str, str]):
+    def __init__(self, name: str, ip_address: str, port: int, creds: Tuple[str, str],
+                    mqtt_client: mqtt.Client = None, poller: xcelPoller = None,
+                    node_prefix: str = '', outbox: xcelOutbox = None,
+                    history: xcelHistory = None,
+                    recorder: xcelRecorder = None,
+                    notification_listener: xcelNotificationListener = None):
         self.name = name
-        self.POLLING_RATE = 5.0
+        self.POLLING_RATE = float(os.getenv('POLLING_RATE', 5.0))
         self.ip_address = ip_address
         self.port = port
         self.creds = creds
@@ -33,16 +56,96 @@ class xcelMeter():
         # Base URL used to query the meter
         self.url = f'https://{ip_address}:{port}'
 
-        # Setup the MQTT server connection
+        # Setup the MQTT server connection, unless we're sharing one with other meters
         self.mqtt_server_address = os.getenv('MQTT_SERVER')
         self.mqtt_port = self.get_mqtt_port()
-        self.mqtt_client = self.setup_mqtt(self.mqtt_server_address, self.mqtt_port)
-
-        # Create a new requests session based on the passed in ip address and port #
-        self.requests_session = self.setup_session(self.creds, self.ip_address)
+        if mqtt_client:
+            self.mqtt_client = mqtt_client
+            self.outbox = outbox
+        else:
+            self.mqtt_client = self.setup_mqtt(self.mqtt_server_address, self.mqtt_port)
+            self.outbox = self.setup_outbox(self.mqtt_client)
+        # Recent readings kept in memory, can be shared with other meters
+        self.history = history if history else self.setup_history()
+        # Raw meter responses captured for replaying, can be shared with other meters
+        self.recorder = recorder if recorder else self.setup_recorder()
+        # Prepended to the endpoint MQTT node ids to keep meters sharing a broker apart
+        self.node_prefix = re.sub(r'[^A-Za-z0-9_-]', '_', node_prefix)
+
+        # Endpoints are polled concurrently by a bounded pool of workers,
+        # which can also be shared with other meters. Endpoints aren't polled
+        # faster than the pollRate the meter advertises for them.
+        self.poll_workers = int(os.getenv('POLL_WORKERS', 4))
+        self.poller = poller if poller else self.setup_poller()
+
+        # Adaptive polling speeds up endpoints that change often and backs
+        # off the ones that don't, within these bounds
+        self.adaptive_polling = os.getenv('ADAPTIVE_POLLING', 'false').lower() in ('true', '1', 'yes')
+        self.polling_rate_min = float(os.getenv('POLLING_RATE_MIN', 2.0))
+        self.polling_rate_max = float(os.getenv('POLLING_RATE_MAX', 60.0))
+
+        # Failed polls are retried without holding up the other endpoints and
+        # an endpoint that keeps failing is left alone for a while. Retries of
+        # all the meter's endpoints come out of one budget.
+        self.circuit_failure_threshold = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 3))
+        self.circuit_reset_timeout = float(os.getenv('CIRCUIT_RESET_TIMEOUT', 30.0))
+        self.circuit_max_reset_timeout = float(os.getenv('CIRCUIT_MAX_RESET_TIMEOUT', 600.0))
+        self.retry_budget = xcelRetryBudget(float(os.getenv('RETRY_BUDGET_RATIO', 0.2)))
+
+        # One requests session based on the passed in ip address and port # is
+        # shared by discovery and polling, with enough pooled connections
+        # to keep every worker's connection alive
+        pool_size = max(self.poll_workers, int(os.getenv('DISCOVERY_WORKERS', 4)))
+        self.requests_session = self.setup_session(self.creds, self.ip_address, pool_size)
+        METRICS.add_collector(self.collect_transport_metrics)
+
+        # Change detection settings for the readings published over MQTT
+        self.publish_only_changes = os.getenv('PUBLISH_ONLY_CHANGES', 'true').lower() in ('true', '1', 'yes')
+        self.publish_deadband = float(os.getenv('PUBLISH_DEADBAND', 0.0))
+        self.publish_max_age = float(os.getenv('PUBLISH_MAX_AGE', 300.0))
+        self.mqtt_json_state = os.getenv('MQTT_JSON_STATE', 'false').lower() in ('true', '1', 'yes')
+        # Units readings are converted to before they are published
+        self.preferred_units = (os.getenv('ENERGY_UNIT', 'Wh'), os.getenv('POWER_UNIT', 'W'))
+        # Home Assistant discovery, one message per entity or one per device,
+        # only sent where the broker's retained copy is out of date
+        self.discovery_mode = os.getenv('MQTT_DISCOVERY_MODE', 'entity').lower()
+        self.discovery_diff = os.getenv('MQTT_DISCOVERY_DIFF', 'true').lower() in ('true', '1', 'yes')
+        self.discovery_diff_timeout = float(os.getenv('MQTT_DISCOVERY_DIFF_TIMEOUT', 2.0))
+
+        # Readings the meter pushes through subscriptions, polling then only
+        # backs them up. The listener can be shared with other meters.
+        self.subscriptions_enabled = os.getenv('SUBSCRIPTIONS', 'false').lower() in ('true', '1', 'yes')
+        self.subscription_polling_rate = float(os.getenv('SUBSCRIPTION_POLLING_RATE', 300.0))
+        self.notification_listener = notification_listener
+        if self.subscriptions_enabled and notification_listener is None:
+            self.notification_listener = self.setup_notification_listener(creds, (ip_address, port))
+        self.subscriptions = None
+
+        # Intervals missed while the bridge was down are read back from the meter
+        self.backfill_enabled = os.getenv('BACKFILL', 'false').lower() in ('true', '1', 'yes')
+        self.backfill = None
+
+        # Hourly and daily energy and demand statistics, published as their
+        # own slow moving sensors
+        self.aggregates_enabled = os.getenv('AGGREGATES', 'false').lower() in ('true', '1', 'yes')
+        self.aggregates = None
+
+        # Generated endpoint lists are cached on disk per meter
+        self.cache_dir = self.get_cache_dir()
+        self.endpoint_cache = xcelEndpointCache(self.cache_dir)
+        self.refresh_endpoint_cache = os.getenv('REFRESH_ENDPOINT_CACHE', 'false').lower() in ('true', '1', 'yes')
+        self._endpoint_refresh_thread = None
 
         # Set to uninitialized
+        self.endpoints = []
         self.initalized = False
+        # Set once the meter is handed over, it is never started again
+        self.stopped = False
+        # Set while the endpoints are on the poller
+        self.started = False
+        # Guards handing the endpoints to the poller, taking them off it
+        # and swapping them for refreshed ones
+        self._start_lock = threading.Lock()
 
     @retry(stop=stop_after_attempt(15),
            wait=wait_exponential(multiplier=1, min=1, max=15),
@@ -72,19 +175,125 @@ class xcelMeter():
         # Send homeassistant a new device config for the meter
         self.send_mqtt_config()
 
-        # List to store our endpoint objects in
-        self.endpointYaml = generateEndpointYaml(self.name, self.ip_address, self.port, self.creds)
-        self.endpointYaml.setup()
-        self.endpoints_list = self.endpointYaml.get_yaml()
+        # Use the cached endpoints if we've seen this meter before, and only
+        # crawl the meter when there is nothing usable on disk
+        cached = self.endpoint_cache.load(self._lfdi)
+        refresh = False
+        if cached is None:
+            self.endpoints_list = self.generate_endpoints_list()
+        else:
+            self.endpoints_list = cached['endpoints']
+            refresh = cached['swVer'] != self._swVer or self.refresh_endpoint_cache
+            if refresh:
+                logging.info(f"Endpoint cache for {self._lfdi} is out of date, refreshing in the background")
+            else:
+                logging.info(f"Using cached endpoints for {self._lfdi}")
         logging.debug(f"YAML Template:")
         logging.debug(f"{yaml.dump(self.endpoints_list,sort_keys=False)}")
         
+        if self.recorder is not None:
+            self.recorder.record_meter(self.name, self._lfdi, self._swVer, self.endpoints_list)
+        if self.backfill_enabled and self.backfill is None:
+            self.backfill = self.create_backfill()
+        if self.aggregates_enabled and self.aggregates is None:
+            self.aggregates = self.create_aggregates()
         # create endpoints from list
         self.endpoints = self.create_endpoints(self.endpoints_list, self.device_info)
+        if self.subscriptions_enabled:
+            self.subscribe_endpoints(self.endpoints)
+        if refresh:
+            # Stale cache, keep polling with it while a fresh list is generated
+            self._endpoint_refresh_thread = threading.Thread(target=self.refresh_endpoints,
+                                                                name='xcel_endpoint_refresh',
+                                                                daemon=True)
+            self._endpoint_refresh_thread.start()
+
+        logging.debug(f"Meter connection stats: {self.transport_stats()}")
 
         # ready to go
         self.initalized = True
 
+    def generate_endpoints_list(self) -> list:
+        """
+        Crawls the meter to generate the endpoint list and stores
+        the result in the endpoint cache
+
+        Returns: list
+        """
+        self.endpointYaml = generateEndpointYaml(self.name, self.ip_address, self.port, self.creds,
+                                                    session=self.requests_session)
+        self.endpointYaml.setup()
+        endpoints_list = self.endpointYaml.get_yaml()
+        self.endpoint_cache.store(self._lfdi, self._swVer, endpoints_list)
+
+        return endpoints_list
+
+    def refresh_endpoints(self) -> None:
+        """
+        Regenerates the endpoint list and swaps the running endpoints
+        over to it. Meant to be run in the background, the current
+        endpoints are kept if the meter can't be crawled.
+
+        Returns: None
+        """
+        try:
+            endpoints_list = self.generate_endpoints_list()
+        except Exception:
+            logger.exception('Failed to refresh the meter endpoints, keeping the cached ones')
+            return
+        if endpoints_list == self.endpoints_list:
+            return
+        with self._start_lock:
+            # The meter may have been handed over while the meter was crawled
+            if self.stopped:
+                return
+            old_endpoints = self.endpoints
+            self.endpoints_list = endpoints_list
+            if self.recorder is not None:
+                self.recorder.record_meter(self.name, self._lfdi, self._swVer, self.endpoints_list)
+            self.endpoints = self.create_endpoints(self.endpoints_list, self.device_info)
+            if self.backfill is not None:
+                self.backfill.unregister(old_endpoints)
+            if self.aggregates is not None:
+                self.aggregates.unregister(old_endpoints)
+            if self.subscriptions is not None:
+                self.subscriptions.unsubscribe_all()
+                self.subscribe_endpoints(self.endpoints)
+            # Not started yet, start() hands over the new endpoints
+            if self.started:
+                self.poller.remove_endpoints(old_endpoints)
+                self.poller.add_endpoints(self.endpoints)
+        logging.info(f"Switched to {len(self.endpoints)} refreshed endpoints")
+
+    def subscribe_endpoints(self, endpoints: list) -> None:
+        """
+        Subscribes to push notifications for the endpoints that support
+        them. If the meter won't cooperate every endpoint is just polled.
+
+        Returns: None
+        """
+        if self.subscriptions is None:
+            meter_certificate = None
+            if self.notification_listener.require_client_cert:
+                try:
+                    meter_certificate = xcelSubscriptionManager.get_meter_certificate(self.ip_address, self.port,
+                                                                                      self.creds)
+                except OSError as e:
+                    logger.warning(f'Could not read the meter certificate notifications are checked against, '
+                                   f'polling every endpoint: {e}')
+                    return
+            notify_host = os.getenv('NOTIFY_HOST') or \
+                xcelSubscriptionManager.get_notify_host(self.ip_address, self.port)
+            self.subscriptions = xcelSubscriptionManager(self.name, self.requests_session, self.url,
+                                                         self.notification_listener, notify_host,
+                                                         f'/notify/{self._lfdi}',
+                                                         self.subscription_polling_rate, self.poller,
+                                                         meter_certificate)
+        try:
+            self.subscriptions.subscribe(endpoints)
+        except (requests.RequestException, ET.ParseError):
+            logger.exception('Could not set up subscriptions, polling every endpoint')
+
     def get_hardware_details(self, hw_info_url: str, hw_names: list) -> dict:
         """
         Queries the meter hardware endpoint at the ip address passed
@@ -104,7 +313,7 @@ class xcelMeter():
         return hw_info_dict
 
     @staticmethod
-    def setup_session(creds: tuple, ip_address: str) -> requests.Session:
+    def setup_session(creds: tuple, ip_address: str, pool_size: int = 10) -> requests.Session:
         """
         Creates a new requests session with the given credentials pointed
         at the give IP address. Will be shared across each xcelQuery object.
@@ -113,11 +322,37 @@ class xcelMeter():
         """
         session = requests.Session()
         session.cert = creds
-        # Mount our adapter to the domain
-        session.mount('https://{ip_address}', CCM8Adapter())
+        # Mount our adapter to the domain, retrying once so a keep-alive
+        # connection the meter dropped is transparently reopened
+        session.mount(f'https://{ip_address}', CCM8Adapter(pool_connections=1,
+                                                            pool_maxsize=pool_size,
+                                                            max_retries=1))
 
         return session
 
+    def transport_stats(self) -> dict:
+        """
+        Connection counters of the meter session: requests sent, full and
+        resumed TLS handshakes, and requests that reused an open connection
+
+        Returns: dict
+        """
+        return self.requests_session.get_adapter(self.url).get_stats()
+
+    def collect_transport_metrics(self) -> list:
+        """
+        Metrics collector for the meter session's connection counters
+
+        Returns: list of (metric name, labels, value)
+        """
+        stats = self.transport_stats()
+        labels = {'meter': self.name}
+        return [
+            ('xcel_meter_requests_total', labels, stats['requests']),
+            ('xcel_meter_tls_handshakes_total', {**labels, 'kind': 'full'}, stats['full_handshakes']),
+            ('xcel_meter_tls_handshakes_total', {**labels, 'kind': 'resumed'}, stats['resumed_handshakes']),
+        ]
+
     @staticmethod
     def load_endpoints(file_path: str) -> list:
         """
@@ -133,14 +368,130 @@ class xcelMeter():
     def create_endpoints(self, endpoints: dict, device_info: dict) -> None:
         # Build query objects for each endpoint
         query_obj = []
+        discovery = xcelDiscovery(self.mqtt_client, self.outbox, self.discovery_mode,
+                                    self.discovery_diff, self.discovery_diff_timeout)
         for point in endpoints:
             for endpoint_name, v in point.items():
                 request_url = f'{self.url}{v["url"]}'
                 query_obj.append(xcelEndpoint(self.requests_session, self.mqtt_client,
-                                    request_url, endpoint_name, v['tags'], device_info))
+                                    request_url, endpoint_name, v['tags'], device_info,
+                                    polling_rate=v.get('polling_rate'),
+                                    meter_poll_rate=v.get('meter_poll_rate'),
+                                    publish_filter=self.create_publish_filter(),
+                                    json_state=self.mqtt_json_state,
+                                    node_id=f'{self.node_prefix}{endpoint_name}'.replace(" ", "_"),
+                                    adaptive_rate=self.create_adaptive_rate(v.get('polling_rate')),
+                                    outbox=self.outbox,
+                                    history=self.history,
+                                    recorder=self.recorder,
+                                    decoder=xcelDecoder.from_endpoint(v, self.preferred_units),
+                                    backfill=self.backfill,
+                                    discovery=discovery,
+                                    circuit_breaker=self.create_circuit_breaker(),
+                                    retry_budget=self.retry_budget,
+                                    aggregates=self.aggregates))
+            if self.backfill is not None and self.backfill.register(query_obj[-1], v.get('reading_sets')):
+                discovery.add(device_info, query_obj[-1].get_backfill_config())
+            if self.aggregates is not None:
+                self.create_rollup_endpoint(query_obj[-1], v, device_info, discovery)
+        discovery.publish()
 
         return query_obj
 
+    def create_backfill(self) -> xcelBackfill:
+        """
+        Builds the backfill for this meter, its progress is kept next
+        to the endpoint cache
+
+        Returns: xcelBackfill
+        """
+        return xcelBackfill(self.requests_session, self.url,
+                            os.path.join(self.cache_dir, f'backfill_{self._lfdi}.yaml'),
+                            min_gap=float(os.getenv('BACKFILL_MIN_GAP', 900.0)),
+                            max_age=float(os.getenv('BACKFILL_MAX_AGE', 7 * 86400.0)),
+                            page_size=int(os.getenv('BACKFILL_PAGE_SIZE', 24)),
+                            min_interval=float(os.getenv('BACKFILL_REQUEST_INTERVAL', 1.0)))
+
+    def create_aggregates(self) -> xcelAggregates:
+        """
+        Builds the rollups of this meter, their progress is kept next
+        to the endpoint cache
+
+        Returns: xcelAggregates
+        """
+        return xcelAggregates(os.path.join(self.cache_dir, f'aggregates_{self._lfdi}.yaml'),
+                              window=float(os.getenv('AGGREGATE_WINDOW', 900.0)),
+                              publish_interval=float(os.getenv('AGGREGATE_PUBLISH_INTERVAL', 60.0)))
+
+    def create_rollup_endpoint(self, endpoint: xcelEndpoint, v: dict, device_info: dict,
+                                discovery: xcelDiscovery) -> xcelEndpoint | None:
+        """
+        Sets up the sensors an endpoint's rollups are published as. They
+        belong to an endpoint of their own that is never polled, the
+        aggregates feed it instead.
+
+        Returns: xcelEndpoint, or None if the endpoint has nothing to roll up
+        """
+        kind = self.aggregates.get_kind(v)
+        if kind is None:
+            return None
+        rollup_endpoint = xcelEndpoint(self.requests_session, self.mqtt_client, endpoint.url, endpoint.name,
+                                       self.aggregates.get_tags(endpoint.name, kind, endpoint.decoder.unit),
+                                       device_info,
+                                       publish_filter=self.create_publish_filter(),
+                                       json_state=self.mqtt_json_state,
+                                       node_id=f'{endpoint.node_id}_rollup',
+                                       outbox=self.outbox,
+                                       discovery=discovery)
+        self.aggregates.register(endpoint, rollup_endpoint, kind)
+
+        return rollup_endpoint
+
+    def create_publish_filter(self) -> xcelPublishFilter:
+        """
+        Builds a new change detection filter for an endpoint using
+        the meter's publish settings
+
+        Returns: xcelPublishFilter
+        """
+        return xcelPublishFilter(self.publish_only_changes, self.publish_deadband,
+                                    self.publish_max_age)
+
+    def create_circuit_breaker(self) -> xcelCircuitBreaker:
+        """
+        Builds the circuit breaker tracking an endpoint's health
+
+        Returns: xcelCircuitBreaker
+        """
+        return xcelCircuitBreaker(self.circuit_failure_threshold, self.circuit_reset_timeout,
+                                  self.circuit_max_reset_timeout)
+
+    def create_adaptive_rate(self, polling_rate: float = None) -> xcelAdaptiveRate | None:
+        """
+        Builds the adaptive polling rate tracker for an endpoint, starting
+        from its configured polling rate
+
+        Returns: xcelAdaptiveRate, or None if adaptive polling is off
+        """
+        if not self.adaptive_polling:
+            return None
+        return xcelAdaptiveRate(float(polling_rate or self.POLLING_RATE),
+                                self.polling_rate_min, self.polling_rate_max)
+
+    def publish_stats(self) -> dict:
+        """
+        Totals of the published and suppressed readings across all
+        of the meter's endpoints
+
+        Returns: dict, {'published': int, 'suppressed': int}
+        """
+        stats = {'published': 0, 'suppressed': 0}
+        for obj in self.endpoints:
+            stats['published'] += obj._publish_filter.published
+            stats['suppressed'] += obj._publish_filter.suppressed
+
+        return stats
+
     @staticmethod
     def get_mqtt_port() -> int:
         """
@@ -183,6 +534,103 @@ class xcelMeter():
 
         return client
 
+    @staticmethod
+    def setup_outbox(mqtt_client: mqtt.Client) -> xcelOutbox | None:
+        """
+        Creates the disk backed queue that holds messages while the
+        MQTT broker is down and replays them when the client reconnects
+
+        Returns: xcelOutbox, or None if it is disabled
+        """
+        capacity = int(os.getenv('OUTBOX_CAPACITY', 5000))
+        if capacity <= 0:
+            return None
+        outbox = xcelOutbox(xcelMeter.get_outbox_path(), capacity,
+                            int(os.getenv('OUTBOX_SLOT_SIZE', 1024)),
+                            os.getenv('OUTBOX_OVERFLOW', 'drop_oldest'))
+        outbox.attach(mqtt_client)
+        # Anything left over from the last run goes out once we're connected
+        if mqtt_client.is_connected():
+            outbox.start_replay(mqtt_client)
+
+        return outbox
+
+    @staticmethod
+    def get_cache_dir() -> str:
+        """
+        Returns: str, folder endpoint lists and other per-meter state are cached in
+        """
+        return os.getenv('ENDPOINT_CACHE_DIR', DEFAULT_CACHE_DIR)
+
+    @staticmethod
+    def get_outbox_path() -> str:
+        """
+        Returns: str, ring file the outbox is kept in
+        """
+        return os.getenv('OUTBOX_PATH', os.path.join(xcelMeter.get_cache_dir(), 'outbox.ring'))
+
+    @staticmethod
+    def setup_poller() -> xcelPoller:
+        """
+        Creates the poller endpoints are scheduled on, with the default
+        period and number of workers from the environment
+
+        Returns: xcelPoller
+        """
+        honor_poll_rate = os.getenv('HONOR_POLL_RATE', 'true').lower() in ('true', '1', 'yes')
+
+        return xcelPoller(float(os.getenv('POLLING_RATE', 5.0)), int(os.getenv('POLL_WORKERS', 4)),
+                          honor_poll_rate=honor_poll_rate)
+
+    @staticmethod
+    def setup_history() -> xcelHistory | None:
+        """
+        Creates the in-memory reading history, served at /history on
+        the metrics server
+
+        Returns: xcelHistory, or None if it is disabled
+        """
+        capacity = int(os.getenv('HISTORY_CAPACITY', 17280))
+        if capacity <= 0:
+            return None
+        history = xcelHistory(capacity)
+        METRICS.add_route('/history', history.http_handler)
+
+        return history
+
+    @staticmethod
+    def setup_recorder() -> xcelRecorder | None:
+        """
+        Opens the capture log raw meter responses are appended to
+
+        Returns: xcelRecorder, or None if RECORD_PATH isn't set
+        """
+        record_path = os.getenv('RECORD_PATH')
+        if not record_path:
+            return None
+        os.makedirs(os.path.dirname(os.path.abspath(record_path)), exist_ok=True)
+        logger.info(f'Recording meter responses to {record_path}')
+
+        return xcelRecorder(record_path)
+
+    @staticmethod
+    def setup_notification_listener(creds: tuple, meter_address: tuple = None) -> xcelNotificationListener:
+        """
+        Starts the HTTPS server meters post their notifications to. It only
+        listens on the interface facing the meter, if there is one meter.
+
+        Returns: xcelNotificationListener
+        """
+        host = os.getenv('NOTIFY_BIND')
+        if host is None:
+            host = xcelSubscriptionManager.get_notify_host(*meter_address) if meter_address else ''
+        require_client_cert = os.getenv('NOTIFY_CLIENT_CERT', 'true').lower() in ('true', '1', 'yes')
+        listener = xcelNotificationListener((host, int(os.getenv('NOTIFY_PORT', 8082))), creds,
+                                            require_client_cert)
+        listener.start()
+
+        return listener
+
     # Send MQTT config setup to Home assistant
     def send_configs(self):
         """
@@ -217,13 +665,55 @@ class xcelMeter():
 
     def run(self) -> None:
         """
-        Main business loop. Just repeatedly queries the meter endpoints,
+        Main business loop. Repeatedly queries the meter endpoints,
         parses the results, packages these up into MQTT payloads, and sends
-        them off to the MQTT server
+        them off to the MQTT server. Each endpoint is polled on its own
+        schedule, several requests can be in flight at once.
+
+        Returns: None
+        """
+        self.start()
+        self.poller.run()
+
+    def start(self) -> bool:
+        """
+        Hands the meter's endpoints to the poller without blocking,
+        used when the poller is shared between meters
+
+        Returns: bool, False if the meter was stopped in the meantime
+        """
+        with self._start_lock:
+            if self.stopped:
+                return False
+            self.poller.add_endpoints(self.endpoints)
+            self.started = True
+        return True
+
+    def stop(self) -> None:
+        """
+        Takes the meter's endpoints off the poller and lets go of what
+        was set up for it, so another process can take the meter over.
+        Backfill and aggregate progress is written out for whoever does.
+        Safe to call again, e.g. after a setup that was still running.
 
         Returns: None
         """
-        while True:
-            sleep(self.POLLING_RATE)
-            for obj in self.endpoints:
-                obj.run()
+        with self._start_lock:
+            self.stopped = True
+            if self.started:
+                self.poller.remove_endpoints(self.endpoints)
+            self.started = False
+            self.initalized = False
+        if self.subscriptions is not None:
+            self.subscriptions.close()
+            self.subscriptions = None
+        if self.backfill is not None:
+            self.backfill.unregister(self.endpoints)
+            self.backfill.close()
+            self.backfill = None
+        if self.aggregates is not None:
+            self.aggregates.flush()
+            self.aggregates.unregister(self.endpoints)
+            self.aggregates = None
+        METRICS.remove_collector(self.collect_transport_metrics)
+        self.requests_session.close()
@@ -0,0 +1,235 @@
+import time
+import logging
+import threading
+from bisect import bisect_left
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Request and parse times are mostly in the milliseconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0)
+
+class xcelMetrics():
+    """
+    Small in-process metrics registry rendered in the Prometheus text
+    exposition format. Counters, histograms, gauges and "age" gauges
+    (seconds since a timestamp was last touched) are keyed by name and
+    a dict of labels.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {name: (type, help)}
+        self._descriptions = {}
+        # {name: {labels tuple: value}}
+        self._values = {}
+        # {name: buckets}
+        self._buckets = {}
+        # Callables returning [(name, labels, value)] evaluated on every scrape
+        self._collectors = []
+        # Extra read only routes served next to /metrics, {path: handler}
+        self._routes = {}
+        self._server = None
+
+    def describe(self, name: str, metric_type: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS) -> None:
+        """
+        Declares a metric, metric_type is one of counter, gauge,
+        histogram or age
+
+        Returns: None
+        """
+        with self._lock:
+            self._descriptions[name] = (metric_type, help_text)
+            self._values.setdefault(name, {})
+            if metric_type == 'histogram':
+                self._buckets[name] = tuple(buckets)
+
+    @staticmethod
+    def _label_key(labels: dict) -> tuple:
+        return tuple(sorted(labels.items())) if labels else ()
+
+    def inc(self, name: str, labels: dict = None, amount: float = 1) -> None:
+        key = self._label_key(labels)
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name: str, value: float, labels: dict = None) -> None:
+        with self._lock:
+            self._values[name][self._label_key(labels)] = value
+
+    def touch(self, name: str, labels: dict = None) -> None:
+        """
+        Records now as the last time the age metric was updated
+        """
+        self.set(name, time.time(), labels)
+
+    def observe(self, name: str, value: float, labels: dict = None) -> None:
+        key = self._label_key(labels)
+        with self._lock:
+            buckets = self._buckets[name]
+            values = self._values[name]
+            histogram = values.get(key)
+            if histogram is None:
+                # Per bucket counts, then sum and count
+                histogram = values[key] = [[0] * len(buckets), 0.0, 0]
+            index = bisect_left(buckets, value)
+            if index < len(buckets):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def add_collector(self, collector) -> None:
+        """
+        Registers a callable returning a list of (name, labels, value)
+        that is evaluated on every scrape
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def remove_collector(self, collector) -> None:
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def add_route(self, path: str, handler) -> None:
+        """
+        Serves handler at path on the metrics server, whether it is
+        already running or started later. See xcelHttpExporter.add_route
+        """
+        with self._lock:
+            self._routes[path] = handler
+        if self._server is not None:
+            self._server.add_route(path, handler)
+
+    @staticmethod
+    def _format_labels(key: tuple, extra: tuple = ()) -> str:
+        pairs = key + extra
+        if not pairs:
+            return ''
+        escaped = (f'{k}="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                   for k, v in pairs)
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self) -> str:
+        """
+        Renders every metric in the Prometheus text format
+
+        Returns: str
+        """
+        with self._lock:
+            collectors = list(self._collectors)
+        collected = {}
+        for collector in collectors:
+            try:
+                for name, labels, value in collector():
+                    collected.setdefault(name, {})[self._label_key(labels)] = value
+            except Exception:
+                logger.exception('Metrics collector failed')
+
+        now = time.time()
+        lines = []
+        with self._lock:
+            for name, (metric_type, help_text) in self._descriptions.items():
+                values = dict(self._values.get(name, {}))
+                values.update(collected.get(name, {}))
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {"gauge" if metric_type == "age" else metric_type}')
+                for key, value in values.items():
+                    if metric_type == 'histogram':
+                        buckets = self._buckets[name]
+                        cumulative = 0
+                        for bound, count in zip(buckets, value[0]):
+                            cumulative += count
+                            lines.append(f'{name}_bucket{self._format_labels(key, (("le", bound),))} {cumulative}')
+                        lines.append(f'{name}_bucket{self._format_labels(key, (("le", "+Inf"),))} {value[2]}')
+                        lines.append(f'{name}_sum{self._format_labels(key)} {value[1]}')
+                        lines.append(f'{name}_count{self._format_labels(key)} {value[2]}')
+                    elif metric_type == 'age':
+                        lines.append(f'{name}{self._format_labels(key)} {max(0.0, now - value):.3f}')
+                    else:
+                        lines.append(f'{name}{self._format_labels(key)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def start_server(self, port: int, address: str = '') -> None:
+        """
+        Serves the metrics at http://<address>:<port>/metrics from a
+        background thread
+
+        Returns: None
+        """
+        if self._server is not None:
+            return
+        self._server = xcelHttpExporter((address, port), self)
+        with self._lock:
+            for path, handler in self._routes.items():
+                self._server.add_route(path, handler)
+        thread = threading.Thread(target=self._server.serve_forever, name='xcel_metrics', daemon=True)
+        thread.start()
+        logger.info(f'Serving metrics on port {self._server.server_address[1]}')
+
+
+class xcelHttpRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        handler = self.server.routes.get(url.path)
+        if handler is None:
+            self.send_error(404)
+            return
+        try:
+            content_type, body = handler(parse_qs(url.query))
+        except (KeyError, ValueError) as e:
+            self.send_error(400, str(e))
+            return
+        data = body.encode('utf-8') if isinstance(body, str) else body
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class xcelHttpExporter(ThreadingHTTPServer):
+    """
+    Local HTTP server for the metrics, other read only routes can be
+    added with add_route
+    """
+    daemon_threads = True
+
+    def __init__(self, address: tuple, metrics: xcelMetrics):
+        super().__init__(address, xcelHttpRequestHandler)
+        self.routes = {
+            '/metrics': lambda query: ('text/plain; version=0.0.4', metrics.render()),
+        }
+
+    def add_route(self, path: str, handler) -> None:
+        """
+        handler receives the parsed query string and returns a tuple
+        of (content type, body)
+        """
+        self.routes[path] = handler
+
+
+# Registry shared by the whole process
+METRICS = xcelMetrics()
+METRICS.describe('xcel_request_duration_seconds', 'histogram', 'Time taken by a meter endpoint request, by result, failed ones included')
+METRICS.describe('xcel_parse_duration_seconds', 'histogram', 'Time taken to parse a meter endpoint response')
+METRICS.describe('xcel_request_retries_total', 'counter', 'Failed meter endpoint requests that were rescheduled for a retry')
+METRICS.describe('xcel_request_giveups_total', 'counter', 'Failed meter endpoint requests left to the next poll or an open circuit')
+METRICS.describe('xcel_circuit_state', 'gauge', 'Endpoint circuit breaker state, 0 closed, 1 half open, 2 open')
+METRICS.describe('xcel_mqtt_publish_total', 'counter', 'MQTT publishes by result')
+METRICS.describe('xcel_publish_suppressed_total', 'counter', 'Readings not published because they did not change')
+METRICS.describe('xcel_unchanged_responses_total', 'counter', 'Polls answered with the same body as the last one, not parsed again')
+METRICS.describe('xcel_cycle_overruns_total', 'counter', 'Polls skipped because the previous poll was still running')
+METRICS.describe('xcel_reading_age_seconds', 'age', 'Seconds since the last successful reading of a sensor')
+METRICS.describe('xcel_meter_requests_total', 'counter', 'Requests sent over the meter session')
+METRICS.describe('xcel_meter_tls_handshakes_total', 'counter', 'TLS handshakes with the meter by kind')
+METRICS.describe('xcel_backfilled_readings_total', 'counter', 'Missed readings recovered from the meter interval data')
+METRICS.describe('xcel_notifications_total', 'counter', 'Notifications pushed by the meter by result')
+METRICS.describe('xcel_shard_meters', 'gauge', 'Meters whose lease this worker holds')
+METRICS.describe('xcel_shard_handovers_total', 'counter', 'Meter leases acquired and released by this worker')
@@ -0,0 +1,224 @@
+import os
+import json
+import mmap
+import struct
+import logging
+import threading
+from time import time, sleep
+from pathlib import Path
+import paho.mqtt.client as mqtt
+
+logger = logging.getLogger(__name__)
+
+# magic, slot size, capacity, head, count, dropped
+HEADER = struct.Struct('<8sIIIIQ')
+HEADER_SIZE = 64
+MAGIC = b'XCELOBX1'
+# reading timestamp, payload length, topic length, retain
+RECORD = struct.Struct('<dIH?')
+RECORD_SIZE = 16
+
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest')
+
+# Added to the topic of a replayed reading for the document carrying its time
+REPLAYED_SUFFIX = '/replayed'
+
+class xcelOutbox():
+    """
+    Bounded store-and-forward queue for MQTT messages, kept in a
+    memory-mapped ring file so it survives restarts. Messages published
+    while the broker is unreachable are held here and replayed in their
+    original order once the client reconnects. The ring has a fixed
+    number of fixed-size slots, so neither the file nor the process can
+    grow during a long outage; when it is full the overflow policy either
+    drops the oldest message or refuses the newest one. Every reading
+    keeps the time it was taken, which is published alongside it when
+    it is replayed.
+    """
+    def __init__(self, path: str, capacity: int = 5000, slot_size: int = 1024,
+                    overflow: str = 'drop_oldest', replay_batch: int = 100):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown outbox overflow policy {overflow}, expected one of {OVERFLOW_POLICIES}')
+        self.path = Path(path)
+        self.overflow = overflow
+        self.replay_batch = replay_batch
+        self._lock = threading.Lock()
+        self._replay_thread = None
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        size = HEADER_SIZE + capacity * slot_size
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            existing = os.fstat(fd).st_size
+            header = os.pread(fd, HEADER.size, 0) if existing >= HEADER.size else b''
+            if len(header) == HEADER.size and HEADER.unpack(header)[0] == MAGIC and \
+                    HEADER.unpack(header)[1:3] == (slot_size, capacity) and existing == size:
+                reuse = True
+            else:
+                # New file or the layout changed, start over with an empty ring
+                if existing:
+                    logger.warning(f'Outbox {self.path} has a different layout, discarding it')
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                reuse = False
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self.slot_size = slot_size
+        self.capacity = capacity
+        if reuse:
+            _, _, _, self._head, self._count, self.dropped = HEADER.unpack_from(self._map, 0)
+            if self._count:
+                logger.info(f'Outbox {self.path} holds {self._count} messages from a previous run')
+        else:
+            self._head, self._count, self.dropped = 0, 0, 0
+            self._write_header()
+
+    def _write_header(self) -> None:
+        HEADER.pack_into(self._map, 0, MAGIC, self.slot_size, self.capacity,
+                            self._head, self._count, self.dropped)
+
+    def _offset(self, index: int) -> int:
+        return HEADER_SIZE + (index % self.capacity) * self.slot_size
+
+    def __len__(self) -> int:
+        return self._count
+
+    def put(self, topic: str, payload: str, retain: bool = False, timestamp: float = None) -> bool:
+        """
+        Stores a message at the end of the queue, with the epoch time of
+        the reading it carries, the time it was queued if that isn't known
+
+        Returns: bool, False if the message was dropped
+        """
+        topic_bytes = topic.encode('utf-8')
+        payload_bytes = str(payload).encode('utf-8')
+        if RECORD_SIZE + len(topic_bytes) + len(payload_bytes) > self.slot_size:
+            logger.warning(f'Message for {topic} is too large for the outbox, dropping it')
+            return False
+        with self._lock:
+            if self._count == self.capacity:
+                self.dropped += 1
+                if self.overflow == 'drop_newest':
+                    self._write_header()
+                    return False
+                self._head = (self._head + 1) % self.capacity
+                self._count -= 1
+            offset = self._offset(self._head + self._count)
+            RECORD.pack_into(self._map, offset, time() if timestamp is None else timestamp,
+                                len(payload_bytes), len(topic_bytes), retain)
+            start = offset + RECORD_SIZE
+            self._map[start:start + len(topic_bytes)] = topic_bytes
+            start += len(topic_bytes)
+            self._map[start:start + len(payload_bytes)] = payload_bytes
+            self._count += 1
+            self._write_header()
+
+        return True
+
+    def peek(self, count: int) -> list:
+        """
+        Reads up to count messages from the front of the queue
+        without removing them
+
+        Returns: list of (timestamp, topic, payload, retain)
+        """
+        messages = []
+        with self._lock:
+            for i in range(min(count, self._count)):
+                offset = self._offset(self._head + i)
+                timestamp, payload_length, topic_length, retain = RECORD.unpack_from(self._map, offset)
+                start = offset + RECORD_SIZE
+                topic = self._map[start:start + topic_length].decode('utf-8')
+                start += topic_length
+                payload = self._map[start:start + payload_length].decode('utf-8')
+                messages.append((timestamp, topic, payload, retain))
+
+        return messages
+
+    def discard(self, count: int) -> None:
+        """
+        Removes count messages from the front of the queue
+        """
+        with self._lock:
+            count = min(count, self._count)
+            self._head = (self._head + count) % self.capacity
+            self._count -= count
+            if not self._count:
+                self._head = 0
+            self._write_header()
+
+    def replay(self, client: mqtt.Client) -> int:
+        """
+        Publishes the queued messages in order, stopping early if the
+        client loses its connection again. Each reading is followed by a
+        JSON document with its value and the time it was taken, on its
+        topic with /replayed added.
+
+        Returns: int, number of messages replayed
+        """
+        replayed = 0
+        oldest = None
+        while client.is_connected():
+            batch = self.peek(self.replay_batch)
+            if not batch:
+                break
+            oldest = batch[0][0] if oldest is None else oldest
+            sent = 0
+            for timestamp, topic, payload, retain in batch:
+                if client.publish(topic, payload, retain=retain)[0] != mqtt.MQTT_ERR_SUCCESS:
+                    break
+                sent += 1
+                if retain:
+                    continue
+                # MQTT 3.1.1 messages have nowhere to carry the time the reading
+                # was taken, so it goes to a topic of its own next to the state
+                message = json.dumps({'Timestamp': int(timestamp), 'value': payload})
+                if client.publish(f'{topic}{REPLAYED_SUFFIX}', message)[0] != mqtt.MQTT_ERR_SUCCESS:
+                    break
+            self.discard(sent)
+            replayed += sent
+            if sent < len(batch):
+                break
+            # Let paho drain its socket buffer between batches
+            sleep(0)
+        if replayed:
+            logger.info(f'Replayed {replayed} queued MQTT messages, the oldest taken {time() - oldest:.0f}s ago, '
+                        f'{len(self)} still queued')
+        self._map.flush()
+
+        return replayed
+
+    def start_replay(self, client: mqtt.Client) -> None:
+        """
+        Replays the queue from a background thread, paho's callbacks
+        must not block
+        """
+        if not self._count or (self._replay_thread and self._replay_thread.is_alive()):
+            return
+        self._replay_thread = threading.Thread(target=self.replay, args=(client,),
+                                                name='xcel_outbox_replay', daemon=True)
+        self._replay_thread.start()
+
+    @property
+    def replaying(self) -> bool:
+        return self._replay_thread is not None and self._replay_thread.is_alive()
+
+    def attach(self, client: mqtt.Client) -> None:
+        """
+        Hooks the client's on_connect so the queue is replayed every
+        time the connection to the broker comes back
+        """
+        on_connect = client.on_connect
+        def replay_on_connect(client, userdata, flags, rc):
+            if on_connect:
+                on_connect(client, userdata, flags, rc)
+            if rc == 0:
+                self.start_replay(client)
+        client.on_connect = replay_on_connect
+
+    def close(self) -> None:
+        with self._lock:
+            self._map.flush()
+            self._map.close()
@@ -0,0 +1,136 @@
+import logging
+import threading
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+from xcelMetrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+class xcelPoller():
+    """
+    Schedules endpoint polls on monotonic deadlines and runs them on a
+    bounded pool of worker threads. Every endpoint keeps its own period,
+    so a slow endpoint never pushes back the readings of the others.
+    """
+    def __init__(self, default_period: float, max_workers: int = 4, honor_poll_rate: bool = True):
+        self.default_period = default_period
+        self.max_workers = max_workers
+        # Never poll an endpoint faster than the pollRate its meter advertises
+        self.honor_poll_rate = honor_poll_rate
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='xcel_poll')
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        # {endpoint: next monotonic deadline}
+        self._deadlines = {}
+        # Endpoints with a poll still in flight
+        self._in_flight = set()
+        # Number of polls that were skipped because the previous one was still running
+        self.overruns = 0
+
+    def get_period(self, endpoint) -> float:
+        """
+        Polling period of the given endpoint, falls back to the
+        poller default if the endpoint does not define its own. The
+        meter's pollRate for the endpoint is the shortest it can be.
+
+        Returns: float, seconds
+        """
+        period = getattr(endpoint, 'polling_rate', None)
+        period = float(period) if period else self.default_period
+        meter_poll_rate = getattr(endpoint, 'meter_poll_rate', None)
+        if self.honor_poll_rate and meter_poll_rate:
+            period = max(period, float(meter_poll_rate))
+
+        return period
+
+    def add_endpoints(self, endpoints: list) -> None:
+        """
+        Starts scheduling the given endpoints, first poll is due
+        one period from now
+        """
+        now = monotonic()
+        with self._lock:
+            for endpoint in endpoints:
+                self._deadlines[endpoint] = now + self.get_period(endpoint)
+        self._wakeup.set()
+
+    def remove_endpoints(self, endpoints: list) -> None:
+        """
+        Stops scheduling the given endpoints. Polls already in
+        flight are allowed to finish.
+        """
+        with self._lock:
+            for endpoint in endpoints:
+                self._deadlines.pop(endpoint, None)
+        self._wakeup.set()
+
+    def _poll(self, endpoint, scheduled: float, period: float) -> None:
+        try:
+            endpoint.run()
+        except Exception:
+            logger.exception(f'Polling {endpoint.name} failed')
+        finally:
+            with self._lock:
+                self._in_flight.discard(endpoint)
+                retry_delay = getattr(endpoint, 'retry_delay', None)
+                new_period = self.get_period(endpoint)
+                if endpoint in self._deadlines:
+                    if retry_delay is not None:
+                        # A failed poll is retried sooner, or later if its circuit
+                        # opened, without holding up a worker in the meantime
+                        self._deadlines[endpoint] = monotonic() + retry_delay
+                        self._wakeup.set()
+                    elif new_period != period:
+                        # The endpoint changed its own period, move its next poll to match
+                        self._deadlines[endpoint] = scheduled + new_period
+                        self._wakeup.set()
+
+    def _dispatch_due(self, now: float) -> float:
+        """
+        Submits every endpoint whose deadline has passed and advances its
+        deadline by whole periods, so the schedule never drifts.
+
+        Returns: float, monotonic time of the next deadline
+        """
+        next_deadline = now + self.default_period
+        with self._lock:
+            for endpoint, deadline in self._deadlines.items():
+                if deadline <= now:
+                    period = self.get_period(endpoint)
+                    if endpoint in self._in_flight:
+                        self.overruns += 1
+                        METRICS.inc('xcel_cycle_overruns_total', getattr(endpoint, '_metric_labels', {'endpoint': endpoint.name}))
+                        logger.warning(f'{endpoint.name} is still being polled, skipping this cycle')
+                    else:
+                        self._in_flight.add(endpoint)
+                        self._executor.submit(self._poll, endpoint, deadline, period)
+                    # Skip any slots we missed rather than bursting to catch up
+                    missed = int((now - deadline) // period) + 1
+                    deadline += missed * period
+                    self._deadlines[endpoint] = deadline
+                next_deadline = min(next_deadline, deadline)
+
+        return next_deadline
+
+    def run(self) -> None:
+        """
+        Main scheduling loop, blocks until stop() is called
+
+        Returns: None
+        """
+        self._stopped.clear()
+        while not self._stopped.is_set():
+            next_deadline = self._dispatch_due(monotonic())
+            self._wakeup.wait(max(0.0, next_deadline - monotonic()))
+            self._wakeup.clear()
+
+    def stop(self, wait: bool = True) -> None:
+        """
+        Stops the scheduling loop and the worker pool
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        self._executor.shutdown(wait=wait)
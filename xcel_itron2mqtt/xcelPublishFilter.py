@@ -0,0 +1,79 @@
+from time import monotonic
+
+class xcelPublishFilter():
+    """
+    Tracks the last published value of each sensor and decides whether
+    a new reading is worth sending. Unchanged values (or values within
+    the deadband for numeric 'value' sensors) are suppressed until they
+    are older than max_age, at which point they are refreshed anyway.
+    """
+    def __init__(self, suppress_unchanged: bool = True, deadband: float = 0.0,
+                    max_age: float = 300.0):
+        self.suppress_unchanged = suppress_unchanged
+        self.deadband = deadband
+        self.max_age = max_age
+
+        # {sensor name: (last published value, monotonic time published)}
+        self._last = {}
+        self.published = 0
+        self.suppressed = 0
+
+    def _is_unchanged(self, sensor: str, value, last_value) -> bool:
+        if value == last_value:
+            return True
+        # Only the main reading gets a numeric deadband
+        if sensor == 'value' and self.deadband > 0:
+            try:
+                return abs(float(value) - float(last_value)) <= self.deadband
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _is_due(self, sensor: str, value, now: float) -> bool:
+        last = self._last.get(sensor)
+        if self.suppress_unchanged and last is not None:
+            last_value, published_at = last
+            if self._is_unchanged(sensor, value, last_value) and \
+                    now - published_at < self.max_age:
+                return False
+        return True
+
+    def should_publish(self, sensor: str, value, now: float = None) -> bool:
+        """
+        Checks the value against the last one published for the sensor
+        and records it if it is going to be sent
+
+        Returns: bool, True if the value should be published
+        """
+        now = monotonic() if now is None else now
+        if not self._is_due(sensor, value, now):
+            self.suppressed += 1
+            return False
+        self._last[sensor] = (value, now)
+        self.published += 1
+
+        return True
+
+    def should_publish_all(self, readings: dict, now: float = None) -> bool:
+        """
+        Same as should_publish for a document holding every sensor's
+        value, which is sent whole if any one of them is due. All of the
+        values are recorded when it is.
+
+        Returns: bool, True if the document should be published
+        """
+        now = monotonic() if now is None else now
+        if not any(self._is_due(sensor, value, now) for sensor, value in readings.items()):
+            self.suppressed += 1
+            return False
+        for sensor, value in readings.items():
+            self._last[sensor] = (value, now)
+        self.published += 1
+
+        return True
+
+    def reset(self) -> None:
+        """
+        Forgets every published value so the next reading is always sent
+        """
+        self._last.clear()
@@ -0,0 +1,207 @@
+import os
+import sys
+import gzip
+import json
+import atexit
+import logging
+import argparse
+import threading
+import xml.etree.ElementTree as ET
+from time import time, sleep, monotonic, perf_counter
+from xcelEndpoint import xcelEndpoint
+from xcelDecoder import xcelDecoder
+from xcelPublishFilter import xcelPublishFilter
+
+logger = logging.getLogger(__name__)
+
+# Record types of the capture log
+METER_RECORD = 'meter'
+RESPONSE_RECORD = 'response'
+
+class xcelRecorder():
+    """
+    Appends every raw meter response to a gzip compressed log of JSON
+    lines, next to a record of each meter's identity and endpoints, so
+    the traffic can be replayed later without the meter. Several meters
+    and polling threads can share one recorder.
+    """
+    def __init__(self, path: str, flush_interval: float = 5.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        # Appending adds a new gzip member, readers see one stream
+        self._file = gzip.open(path, mode='ab', compresslevel=6)
+        self._lock = threading.Lock()
+        self._last_flush = monotonic()
+        self.records = 0
+        atexit.register(self.close)
+
+    def write(self, record: dict) -> None:
+        line = json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line)
+            self.records += 1
+            if monotonic() - self._last_flush >= self.flush_interval:
+                # Flushing compresses worse, so only every so often
+                self._file.flush()
+                self._last_flush = monotonic()
+
+    def record_meter(self, meter: str, lfdi: str, sw_version: str, endpoints: list) -> None:
+        """
+        Records what the responses that follow need to be parsed with
+        """
+        self.write({'type': METER_RECORD, 't': round(time(), 3), 'meter': meter,
+                    'lfdi': lfdi, 'swVer': sw_version, 'endpoints': endpoints})
+
+    def record_response(self, meter: str, endpoint: str, status: int, body: str) -> None:
+        self.write({'type': RESPONSE_RECORD, 't': round(time(), 3), 'meter': meter,
+                    'endpoint': endpoint, 'status': status, 'body': body})
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_log(path: str):
+    """
+    Reads a capture log, stopping quietly at a record cut off by a crash
+
+    Returns: generator of record dicts
+    """
+    with gzip.open(path, mode='rt', encoding='utf-8') as file:
+        try:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning('Skipping a truncated record')
+        except (EOFError, gzip.BadGzipFile):
+            logger.warning(f'{path} ends early, replaying what was read')
+
+
+class xcelReplay():
+    """
+    Feeds a capture log through the endpoints' parse and publish path
+    with no meter attached, at the recorded pace divided by speed, or
+    as fast as possible with speed 0. Replayed meters get their own
+    device identity so they never take over the live entities.
+    """
+    def __init__(self, mqtt_client, speed: float = 1.0, meter: str = None,
+                    preferred_units: tuple = (), publish_filter_args: tuple = (False,)):
+        self.client = mqtt_client
+        self.speed = speed
+        self.meter = meter
+        self.preferred_units = preferred_units
+        self.publish_filter_args = publish_filter_args
+        # {meter: {endpoint name: xcelEndpoint}}
+        self.endpoints = {}
+        # {(meter, endpoint name): [responses, errors, seconds spent]}
+        self.stats = {}
+        self.versions = {}
+
+    def create_endpoints(self, record: dict) -> dict:
+        meter = record['meter']
+        device_info = {'device': {'identifiers': [f"{record['lfdi']}_replay"],
+                                  'name': f'{meter} Replay',
+                                  'model': 'Gen5 Riva Meter',
+                                  'manufacturer': 'ITRON Inc.',
+                                  'sw_version': record['swVer']}}
+        endpoints = {}
+        for point in record['endpoints']:
+            for endpoint_name, v in point.items():
+                endpoints[endpoint_name] = xcelEndpoint(None, self.client, v['url'], endpoint_name, v['tags'],
+                                                        device_info,
+                                                        publish_filter=xcelPublishFilter(*self.publish_filter_args),
+                                                        node_id=f'replay_{endpoint_name}'.replace(' ', '_'),
+                                                        decoder=xcelDecoder.from_endpoint(v, self.preferred_units))
+
+        return endpoints
+
+    def replay(self, path: str) -> int:
+        """
+        Returns: int, number of responses replayed
+        """
+        first_recorded = None
+        started = monotonic()
+        replayed = 0
+        for record in read_log(path):
+            meter = record.get('meter')
+            if self.meter and meter != self.meter:
+                continue
+            if record.get('type') == METER_RECORD:
+                self.endpoints[meter] = self.create_endpoints(record)
+                self.versions[meter] = record['swVer']
+                continue
+            endpoint = self.endpoints.get(meter, {}).get(record.get('endpoint'))
+            if endpoint is None:
+                continue
+            if first_recorded is None:
+                first_recorded = record['t']
+            if self.speed > 0:
+                wait = (record['t'] - first_recorded) / self.speed - (monotonic() - started)
+                if wait > 0:
+                    sleep(wait)
+            stats = self.stats.setdefault((meter, endpoint.name), [0, 0, 0.0])
+            stats[0] += 1
+            if not 200 <= record.get('status', 200) < 300:
+                stats[1] += 1
+                continue
+            start = perf_counter()
+            try:
+                endpoint.handle_reading(ET.fromstring(record['body']), start)
+            except ET.ParseError:
+                stats[1] += 1
+                continue
+            stats[2] += perf_counter() - start
+            replayed += 1
+
+        return replayed
+
+    def summary(self) -> str:
+        lines = [f"{'meter':<24} {'swVer':<12} {'endpoint':<32} {'responses':>9} {'errors':>6} {'mean ms':>8}"]
+        for (meter, endpoint), (responses, errors, seconds) in self.stats.items():
+            mean = seconds / max(1, responses - errors) * 1000
+            lines.append(f'{meter:<24} {self.versions.get(meter, ""):<12} {endpoint:<32} '
+                         f'{responses:>9} {errors:>6} {mean:>8.3f}')
+
+        return '\n'.join(lines)
+
+
+def main() -> None:
+    # Local import, the meter pulls in everything needed to talk to a real meter
+    from xcelMeter import xcelMeter
+
+    parser = argparse.ArgumentParser(description='Replay a capture log recorded with RECORD_PATH over MQTT')
+    parser.add_argument('log', help='Capture log to replay')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Multiple of the recorded pace, 0 replays as fast as possible')
+    parser.add_argument('--meter', help='Only replay this meter')
+    parser.add_argument('--mqtt-server', default=os.getenv('MQTT_SERVER', 'localhost'))
+    parser.add_argument('--mqtt-port', type=int, default=int(os.getenv('MQTT_PORT', 1883)))
+    parser.add_argument('--only-changes', action='store_true',
+                        help='Suppress unchanged readings like PUBLISH_ONLY_CHANGES does')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=os.environ.get('LOGLEVEL', 'INFO').upper())
+
+    client = xcelMeter.setup_mqtt(args.mqtt_server, args.mqtt_port)
+    deadline = monotonic() + 10.0
+    while not client.is_connected() and monotonic() < deadline:
+        sleep(0.05)
+    replay = xcelReplay(client, args.speed, args.meter,
+                        (os.getenv('ENERGY_UNIT', 'Wh'), os.getenv('POWER_UNIT', 'W')),
+                        (args.only_changes, float(os.getenv('PUBLISH_DEADBAND', 0.0)),
+                         float(os.getenv('PUBLISH_MAX_AGE', 300.0))))
+    start = monotonic()
+    replayed = replay.replay(args.log)
+    elapsed = monotonic() - start
+    # Disconnecting first lets the network loop send what is still queued
+    client.disconnect()
+    client.loop_stop()
+    print(replay.summary())
+    print(f'Replayed {replayed} responses in {elapsed:.1f}s ({replayed / max(elapsed, 1e-9):.0f}/s)', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
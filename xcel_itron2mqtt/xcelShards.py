@@ -0,0 +1,398 @@
+import os
+import re
+import json
+import signal
+import hashlib
+import logging
+import threading
+import multiprocessing
+from time import monotonic
+import paho.mqtt.client as mqtt
+from xcelMetrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+def shard_key(name: str) -> str:
+    """
+    Topic safe key of a meter, the same on every node
+
+    Returns: str
+    """
+    return re.sub(r'[^A-Za-z0-9_-]', '_', name)
+
+def rendezvous_owner(shard: str, workers: list) -> str | None:
+    """
+    Picks the worker a shard belongs to by highest random weight, so
+    a worker joining or leaving only moves its own share of the shards
+
+    Returns: str, worker id, or None without any workers
+    """
+    return max(workers, key=lambda worker: hashlib.sha1(f'{worker}/{shard}'.encode('utf-8')).digest(),
+               default=None)
+
+
+class xcelShardCoordinator():
+    """
+    Splits a set of shards between every worker connected to the same
+    MQTT broker, on this node or any other. Each worker keeps a retained
+    heartbeat under <topic>/workers/<worker id>, cleared by its last will
+    when it dies, and owns a shard while its retained lease under
+    <topic>/leases/<shard> names it. Shards go to their rendezvous owner
+    among the live workers. A lease that isn't renewed within lease_ttl,
+    or whose owner lost its heartbeat, is free to be claimed.
+
+    Leases are timed by when they were last received rather than by any
+    clock in the payload, so the nodes' clocks don't need to agree.
+    """
+    def __init__(self, mqtt_server_address: str, mqtt_port: int, worker_id: str, shards: list,
+                    on_acquire, on_release, lease_ttl: float = 30.0,
+                    topic: str = 'xcel_itron2mqtt/shards', settle: float = 3.0):
+        self.worker_id = worker_id
+        self.shards = list(shards)
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.lease_ttl = lease_ttl
+        self.topic = topic.rstrip('/')
+        # Time for the broker to hand out what it retained, and for
+        # competing claims on a lease to arrive, before acting on them
+        self.settle = settle
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        # {worker id: monotonic time its heartbeat was last received}
+        self._workers = {}
+        # {shard: (owner, monotonic time the lease was last received)}
+        self._leases = {}
+        # {shard: monotonic time we claimed it}
+        self._claims = {}
+        # Shards handed to on_acquire and not released since
+        self.owned = set()
+        self._connected_at = None
+        self._last_renewal = 0.0
+        self._thread = None
+
+        self.mqtt_server_address = mqtt_server_address
+        self.mqtt_port = mqtt_port
+        self.client = self.setup_mqtt()
+
+    def worker_topic(self, worker_id: str) -> str:
+        return f'{self.topic}/workers/{worker_id}'
+
+    def lease_topic(self, shard: str) -> str:
+        return f'{self.topic}/leases/{shard}'
+
+    def setup_mqtt(self) -> mqtt.Client:
+        """
+        Creates the client the leases go over. It is separate from the
+        one readings are published with so its last will only speaks
+        for this worker.
+
+        Returns: mqtt.Client
+        """
+        client = mqtt.Client()
+        mqtt_username = os.getenv('MQTT_USER')
+        mqtt_password = os.getenv('MQTT_PASSWORD')
+        if mqtt_username and mqtt_password:
+            client.username_pw_set(mqtt_username, mqtt_password)
+        # An empty retained message clears the heartbeat
+        client.will_set(self.worker_topic(self.worker_id), payload=None, retain=True)
+        client.on_connect = self.on_connect
+        client.on_disconnect = self.on_disconnect
+        client.on_message = self.on_message
+
+        return client
+
+    def on_connect(self, client, userdata, flags, rc) -> None:
+        if rc != 0:
+            logger.error(f'Shard coordinator failed to connect, return code {rc}')
+            return
+        client.subscribe([(f'{self.topic}/workers/+', 1), (f'{self.topic}/leases/+', 1)])
+        with self._lock:
+            self._connected_at = monotonic()
+        self.publish_heartbeat()
+        self._wakeup.set()
+
+    def on_disconnect(self, client, userdata, rc) -> None:
+        with self._lock:
+            self._connected_at = None
+
+    def on_message(self, client, userdata, message) -> None:
+        now = monotonic()
+        kind, _, name = message.topic.removeprefix(f'{self.topic}/').partition('/')
+        with self._lock:
+            if kind == 'workers':
+                if message.payload:
+                    self._workers[name] = now
+                else:
+                    self._workers.pop(name, None)
+            elif kind == 'leases':
+                owner = None
+                if message.payload:
+                    try:
+                        owner = json.loads(message.payload).get('owner')
+                    except (ValueError, AttributeError):
+                        logger.warning(f'Ignoring a malformed lease on {message.topic}')
+                if owner:
+                    self._leases[name] = (owner, now)
+                else:
+                    self._leases.pop(name, None)
+        self._wakeup.set()
+
+    def publish_heartbeat(self) -> None:
+        self.client.publish(self.worker_topic(self.worker_id), json.dumps({'shards': len(self.owned)}),
+                            qos=1, retain=True)
+
+    def publish_lease(self, shard: str, owned: bool) -> None:
+        payload = json.dumps({'owner': self.worker_id}) if owned else None
+        self.client.publish(self.lease_topic(shard), payload, qos=1, retain=True)
+
+    def live_workers(self, now: float) -> list:
+        """
+        Workers whose heartbeat arrived within the lease ttl, always
+        including this one
+
+        Returns: list of worker ids
+        """
+        workers = {worker for worker, seen in self._workers.items() if now - seen < self.lease_ttl}
+        workers.add(self.worker_id)
+
+        return sorted(workers)
+
+    def plan(self, now: float) -> tuple:
+        """
+        Works out what to do with every shard from the heartbeats and
+        leases received so far
+
+        Returns: tuple of lists, (shards to claim, to acquire, to release
+        and publish the release of, to drop without publishing)
+        """
+        claim, acquire, release, drop = [], [], [], []
+        with self._lock:
+            if self._connected_at is None or now - self._connected_at < self.settle:
+                return claim, acquire, release, drop
+            live = self.live_workers(now)
+            for shard in self.shards:
+                owner, seen = self._leases.get(shard, (None, 0.0))
+                if owner != self.worker_id and (owner not in live or now - seen >= self.lease_ttl):
+                    # Expired, or its owner went away
+                    owner = None
+                wanted = rendezvous_owner(shard, live) == self.worker_id
+                if owner is None:
+                    if shard in self.owned:
+                        # Our own lease vanished, most likely cleared by hand
+                        drop.append(shard)
+                    elif wanted and now - self._claims.get(shard, -self.lease_ttl) >= self.lease_ttl:
+                        # Claims that never came back are made again
+                        claim.append(shard)
+                elif owner != self.worker_id:
+                    self._claims.pop(shard, None)
+                    if shard in self.owned:
+                        # Someone claimed over us while we weren't heard from
+                        drop.append(shard)
+                elif shard not in self.owned:
+                    claimed = self._claims.get(shard)
+                    if not wanted:
+                        release.append(shard)
+                    elif claimed is None or now - claimed >= self.settle:
+                        # Our claim came back and nobody claimed over it since
+                        acquire.append(shard)
+                elif not wanted:
+                    release.append(shard)
+
+        return claim, acquire, release, drop
+
+    def step(self) -> None:
+        """
+        One round of claiming, acquiring, releasing and renewing leases
+        """
+        now = monotonic()
+        if self.owned and not self.client.is_connected() and now - self._last_renewal >= self.lease_ttl:
+            # Other workers stopped hearing from us and may own these by now
+            logger.warning(f'Lost the broker for {self.lease_ttl}s, letting go of {len(self.owned)} meters')
+            for shard in sorted(self.owned):
+                self.release(shard, publish=False)
+            return
+        claim, acquire, release, drop = self.plan(now)
+        for shard in claim:
+            logger.info(f'Claiming {shard}')
+            with self._lock:
+                self._claims[shard] = now
+            self.publish_lease(shard, True)
+        for shard in drop:
+            logger.warning(f'Lost the lease on {shard}')
+            self.release(shard, publish=False)
+        for shard in release:
+            logger.info(f'Handing {shard} over to its new owner')
+            self.release(shard, publish=True)
+        for shard in acquire:
+            logger.info(f'Acquired {shard}')
+            with self._lock:
+                self._claims.pop(shard, None)
+                self.owned.add(shard)
+            METRICS.inc('xcel_shard_handovers_total', {'direction': 'acquired'})
+            try:
+                self.on_acquire(shard)
+            except Exception:
+                logger.exception(f'Could not start {shard}')
+        if self.client.is_connected() and now - self._last_renewal >= self.lease_ttl / 3:
+            self.publish_heartbeat()
+            for shard in sorted(self.owned):
+                self.publish_lease(shard, True)
+            self._last_renewal = now
+        METRICS.set('xcel_shard_meters', len(self.owned))
+
+    def release(self, shard: str, publish: bool) -> None:
+        with self._lock:
+            self.owned.discard(shard)
+            self._claims.pop(shard, None)
+            if publish:
+                # Don't act on our own lease again before the release comes back
+                self._leases.pop(shard, None)
+        METRICS.inc('xcel_shard_handovers_total', {'direction': 'released'})
+        try:
+            self.on_release(shard)
+        except Exception:
+            logger.exception(f'Could not stop {shard}')
+        if publish:
+            # Only once polling stopped, so the meter is never polled twice
+            self.publish_lease(shard, False)
+
+    def run(self) -> None:
+        """
+        Coordination loop, blocks until stop() is called
+
+        Returns: None
+        """
+        while not self._stopped.is_set():
+            self.step()
+            self._wakeup.wait(min(self.settle, self.lease_ttl / 6))
+            self._wakeup.clear()
+
+    def start(self) -> None:
+        """
+        Connects to the broker and runs the coordination loop in the
+        background
+
+        Returns: None
+        """
+        if self._thread is not None:
+            return
+        # The broker fires the will once it misses a few keepalives
+        self.client.connect_async(self.mqtt_server_address, self.mqtt_port,
+                                  keepalive=max(5, int(self.lease_ttl / 2)))
+        self.client.loop_start()
+        self._thread = threading.Thread(target=self.run, name='xcel_shards', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Releases every owned shard and clears the heartbeat, so the other
+        workers take over right away instead of waiting out the leases
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        for shard in sorted(self.owned):
+            self.release(shard, publish=True)
+        with self._lock:
+            claims = list(self._claims)
+        for shard in claims:
+            # Claims still settling would hold the shard up until they expired
+            self.publish_lease(shard, False)
+        info = self.client.publish(self.worker_topic(self.worker_id), None, qos=1, retain=True)
+        # Disconnecting straight away can drop the releases still in flight
+        try:
+            info.wait_for_publish(timeout=self.settle)
+        except (ValueError, RuntimeError):
+            # Not connected, the will clears the heartbeat and the leases expire
+            pass
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+class xcelSupervisor():
+    """
+    Runs target(index, *args) in the given number of worker processes
+    and starts a worker again when it exits, waiting longer each time
+    it keeps dying. Stopping the supervisor terminates the workers.
+    """
+    def __init__(self, target, workers: int, args: tuple = (), restart_delay: float = 5.0,
+                    max_restart_delay: float = 300.0):
+        self.target = target
+        self.workers = workers
+        self.args = args
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        # Fresh interpreters, so no threads or sockets are inherited
+        self._context = multiprocessing.get_context('spawn')
+        # {index: process}
+        self.processes = {}
+        # {index: (monotonic time it may start again, current delay)}
+        self._backoff = {}
+        self._stopped = threading.Event()
+
+    def start_worker(self, index: int) -> None:
+        process = self._context.Process(target=self.target, args=(index, *self.args),
+                                        name=f'xcel_worker_{index}', daemon=True)
+        process.start()
+        self.processes[index] = process
+        logger.info(f'Started worker {index} as pid {process.pid}')
+
+    def check_workers(self) -> None:
+        """
+        Starts any worker that isn't running and is past its backoff
+        """
+        now = monotonic()
+        for index in range(self.workers):
+            process = self.processes.get(index)
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                process.join()
+                ready, delay = self._backoff.get(index, (0.0, 0.0))
+                # A worker that ran for a while starts over with the short delay
+                delay = self.restart_delay if now - ready > self.max_restart_delay \
+                    else min(self.max_restart_delay, max(self.restart_delay, delay * 2))
+                logger.warning(f'Worker {index} exited with code {process.exitcode}, restarting in {delay:.0f}s')
+                self._backoff[index] = (now + delay, delay)
+                self.processes[index] = None
+                continue
+            ready, _ = self._backoff.get(index, (0.0, 0.0))
+            if now >= ready:
+                self.start_worker(index)
+
+    def run(self, interval: float = 1.0) -> None:
+        """
+        Supervision loop, blocks until stop() is called or SIGTERM arrives
+
+        Returns: None
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self._stopped.set())
+        try:
+            while not self._stopped.is_set():
+                self.check_workers()
+                self._stopped.wait(interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """
+        Asks the workers to hand their meters over and exit, and kills
+        the ones that don't within the timeout
+        """
+        self._stopped.set()
+        processes = [process for process in self.processes.values() if process is not None]
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = monotonic() + timeout
+        for process in processes:
+            process.join(max(0.0, deadline - monotonic()))
+            if process.is_alive():
+                process.kill()
+                process.join()
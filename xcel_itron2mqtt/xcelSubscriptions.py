@@ -0,0 +1,336 @@
+import ssl
+import socket
+import logging
+import threading
+import requests
+import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.packages.urllib3.util.ssl_ import create_urllib3_context
+from xcelDataType import SubscribableType
+from xcelMetrics import METRICS
+from CCM8Adapter import CIPHERS
+
+logger = logging.getLogger(__name__)
+
+IEEE_PREFIX = '{urn:ieee:std:2030.5:ns}'
+NS = 'urn:ieee:std:2030.5:ns'
+
+# Resource holding the meter's SubscriptionListLink
+SELF_DEVICE_URL = '/sdev'
+
+# We never set conditions, so the resource has to accept plain subscriptions
+NON_CONDITIONAL = (
+    SubscribableType.ResourceSupportsNonConditionalSubscriptions.value,
+    SubscribableType.ResourceSupportsBothConditionalAndNonConditionalSubscriptions.value,
+)
+
+# Notification status of a notification carrying the resource itself,
+# anything else means the subscription is gone
+STATUS_DEFAULT = '0'
+
+class xcelNotificationHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        callback = self.server.routes.get(urlsplit(self.path).path)
+        if callback is None:
+            status = 404
+        else:
+            try:
+                certificate = self.connection.getpeercert(binary_form=True)
+                status = 204 if callback(self.client_address[0], body, certificate) else 403
+            except ET.ParseError:
+                status = 400
+            except Exception:
+                logger.exception('Failed to handle a notification')
+                status = 500
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class xcelNotificationListener(ThreadingHTTPServer):
+    """
+    HTTPS server the meter posts its 2030.5 Notifications to. Each meter
+    registers a callback under its own path. TLS handshakes run in the
+    request threads so a slow one doesn't hold up the others. Unless
+    require_client_cert is off, a client has to present the certificate
+    of one of the meters passed to trust().
+    """
+    daemon_threads = True
+
+    def __init__(self, address: tuple, creds: tuple, require_client_cert: bool = True):
+        super().__init__(address, xcelNotificationHandler)
+        self.routes = {}
+        self.require_client_cert = require_client_cert
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ssl_context.load_cert_chain(*creds)
+        if require_client_cert:
+            self.ssl_context.verify_mode = ssl.CERT_REQUIRED
+            # The meter's own certificate is trusted, not whoever issued it
+            self.ssl_context.verify_flags |= ssl.VERIFY_X509_PARTIAL_CHAIN
+        else:
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.ssl_context.set_ciphers('ECDHE')
+        self._thread = None
+
+    def trust(self, certificate: bytes) -> None:
+        """
+        Accepts connections from clients presenting the given DER
+        encoded certificate
+        """
+        self.ssl_context.load_verify_locations(cadata=certificate)
+
+    def add_route(self, path: str, callback) -> None:
+        """
+        callback receives the client address, the raw notification and
+        the client's DER certificate, if it sent one, and returns False
+        to reject it
+        """
+        self.routes[path] = callback
+
+    def remove_route(self, path: str) -> None:
+        self.routes.pop(path, None)
+
+    def get_request(self):
+        sock, address = self.socket.accept()
+        return self.ssl_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False), address
+
+    def finish_request(self, request, client_address):
+        try:
+            request.do_handshake()
+        except (ssl.SSLError, OSError):
+            return
+        super().finish_request(request, client_address)
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self.serve_forever, name='xcel_notifications', daemon=True)
+        self._thread.start()
+        logger.info(f'Listening for meter notifications on port {self.port}')
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class xcelSubscriptionManager():
+    """
+    Subscribes a meter's endpoints to push notifications where the meter
+    allows it, and feeds the notifications into the endpoints' normal
+    parse and publish path. Subscribed endpoints are still polled, but
+    only every fallback_rate seconds to catch anything that was missed.
+    """
+    def __init__(self, name: str, session: requests.Session, meter_url: str,
+                    listener: xcelNotificationListener, notify_host: str, path: str,
+                    fallback_rate: float, poller=None, meter_certificate: bytes = None):
+        self.name = name
+        self.requests_session = session
+        self.meter_url = meter_url
+        self.meter_host = urlsplit(meter_url).hostname
+        self.listener = listener
+        self.notify_path = path
+        # Notifications have to come with this certificate, if set
+        self.meter_certificate = meter_certificate
+        if meter_certificate is not None:
+            listener.trust(meter_certificate)
+        self.notification_uri = f'https://{notify_host}:{listener.port}{path}'
+        self.fallback_rate = fallback_rate
+        # Endpoints that go back to polling are rescheduled on it right away
+        self.poller = poller
+        # {subscribed resource path: (endpoint, subscription url)}
+        self._subscriptions = {}
+        # Polling settings of subscribed endpoints, restored if the subscription ends
+        self._polling = {}
+        self._lock = threading.Lock()
+        self._subscription_list = None
+
+        listener.add_route(path, self.handle_notification)
+
+    @staticmethod
+    def get_notify_host(meter_ip: str, meter_port: int) -> str:
+        """
+        Works out which of our addresses the meter can reach us on
+
+        Returns: str, ip address
+        """
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            # Nothing is sent, this only picks the outgoing interface
+            sock.connect((meter_ip, int(meter_port)))
+            return sock.getsockname()[0]
+
+    @staticmethod
+    def get_meter_certificate(meter_ip: str, meter_port: int, creds: tuple) -> bytes:
+        """
+        Reads the certificate the meter identifies itself with, it signs
+        its notifications with the same one
+
+        Returns: bytes, DER encoded certificate
+        """
+        context = create_urllib3_context(ciphers=CIPHERS)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        context.load_cert_chain(*creds)
+        with socket.create_connection((meter_ip, int(meter_port)), timeout=10.0) as sock:
+            with context.wrap_socket(sock) as tls_sock:
+                return tls_sock.getpeercert(binary_form=True)
+
+    def get(self, path: str) -> ET.Element:
+        x = self.requests_session.get(f'{self.meter_url}{path}', verify=False, timeout=4.0)
+        x.raise_for_status()
+
+        return ET.fromstring(x.text)
+
+    def find_subscription_list(self) -> str | None:
+        """
+        Looks up where the meter takes new subscriptions
+
+        Returns: str, path of the SubscriptionList or None if the meter
+        has none
+        """
+        link = self.get(SELF_DEVICE_URL).find(f'.//{IEEE_PREFIX}SubscriptionListLink')
+
+        return link.get('href') if link is not None else None
+
+    def clear_stale(self) -> None:
+        """
+        Removes subscriptions a previous run left pointing at us
+        """
+        for subscription in self.get(self._subscription_list).findall(f'{IEEE_PREFIX}Subscription'):
+            if subscription.findtext(f'{IEEE_PREFIX}notificationURI') == self.notification_uri:
+                self.requests_session.delete(f"{self.meter_url}{subscription.get('href')}",
+                                             verify=False, timeout=4.0)
+
+    def subscription_xml(self, resource: str) -> str:
+        return (f'<Subscription xmlns="{NS}">'
+                f'<subscribedResource>{resource}</subscribedResource>'
+                f'<encoding>0</encoding><level>+S1</level><limit>1</limit>'
+                f'<notificationURI>{self.notification_uri}</notificationURI></Subscription>')
+
+    def subscribe(self, endpoints: list) -> list:
+        """
+        Subscribes to every endpoint whose resource accepts plain
+        subscriptions. The others are left to be polled as usual.
+
+        Returns: list of the subscribed endpoints
+        """
+        if self._subscription_list is None:
+            self._subscription_list = self.find_subscription_list()
+            if self._subscription_list is None:
+                logger.info('Meter does not take subscriptions, polling every endpoint')
+                return []
+            self.clear_stale()
+
+        subscribed = []
+        for endpoint in endpoints:
+            resource = urlsplit(endpoint.url).path
+            try:
+                subscribable = int(self.get(resource).get('subscribable', 0))
+                if subscribable not in NON_CONDITIONAL:
+                    continue
+                x = self.requests_session.post(f'{self.meter_url}{self._subscription_list}',
+                                               data=self.subscription_xml(resource),
+                                               headers={'Content-Type': 'application/sep+xml'},
+                                               verify=False, timeout=4.0)
+                x.raise_for_status()
+            except (requests.RequestException, ET.ParseError, ValueError):
+                logger.warning(f'Could not subscribe to {endpoint.name}, polling it instead')
+                continue
+            location = x.headers.get('Location', '')
+            with self._lock:
+                self._subscriptions[resource] = (endpoint, urlsplit(location).path)
+                self._polling[endpoint] = (endpoint.polling_rate, endpoint.adaptive_rate)
+            # Notifications take over, polling only backs them up
+            endpoint.adaptive_rate = None
+            endpoint.polling_rate = self.fallback_rate
+            subscribed.append(endpoint)
+        logger.info(f'Subscribed to {len(subscribed)} of {len(endpoints)} endpoints')
+
+        return subscribed
+
+    def _release(self, resource: str, reschedule: bool = True) -> tuple | None:
+        """
+        Forgets a subscription and puts its endpoint back on its own
+        polling schedule
+
+        Returns: tuple of (endpoint, subscription url), or None
+        """
+        with self._lock:
+            subscription = self._subscriptions.pop(resource, None)
+            if subscription is None:
+                return None
+            endpoint = subscription[0]
+            endpoint.polling_rate, endpoint.adaptive_rate = self._polling.pop(endpoint)
+            if endpoint.adaptive_rate is not None:
+                endpoint.polling_rate = endpoint.adaptive_rate.period
+        if reschedule and self.poller is not None:
+            self.poller.add_endpoints([endpoint])
+
+        return subscription
+
+    def unsubscribe_all(self) -> None:
+        """
+        Deletes every subscription from the meter, the endpoints are
+        not handed back to the poller
+        """
+        for resource in list(self._subscriptions):
+            subscription = self._release(resource, reschedule=False)
+            if subscription and subscription[1]:
+                try:
+                    self.requests_session.delete(f'{self.meter_url}{subscription[1]}', verify=False, timeout=4.0)
+                except requests.RequestException:
+                    logger.warning(f'Could not delete the subscription {subscription[1]}')
+
+    def close(self) -> None:
+        self.unsubscribe_all()
+        self.listener.remove_route(self.notify_path)
+
+    def handle_notification(self, client_address: str, body: bytes, certificate: bytes = None) -> bool:
+        """
+        Listener callback, publishes the Reading carried by a notification
+        through the endpoint it belongs to
+
+        Returns: bool, False if the notification was rejected
+        """
+        # Only the meter itself gets to push readings, the listener trusts
+        # every subscribed meter so check it is this one
+        if client_address != self.meter_host or \
+                (self.meter_certificate is not None and certificate != self.meter_certificate):
+            METRICS.inc('xcel_notifications_total', {'meter': self.name, 'endpoint': '', 'result': 'rejected'})
+            logger.warning(f'Ignoring a notification from {client_address}')
+            return False
+        root = ET.fromstring(body)
+        resource = root.findtext(f'{IEEE_PREFIX}subscribedResource')
+        with self._lock:
+            subscription = self._subscriptions.get(resource)
+        if subscription is None:
+            METRICS.inc('xcel_notifications_total', {'meter': self.name, 'endpoint': '', 'result': 'unknown'})
+            logger.debug(f'Notification for {resource} we are not subscribed to')
+            return True
+        endpoint = subscription[0]
+        status = root.findtext(f'{IEEE_PREFIX}status', STATUS_DEFAULT)
+        if status != STATUS_DEFAULT:
+            # The meter ended the subscription, go back to polling
+            self._release(resource)
+            METRICS.inc('xcel_notifications_total', {**endpoint._metric_labels, 'result': 'cancelled'})
+            logger.warning(f'Meter ended the subscription to {endpoint.name} (status {status}), polling it again')
+            return True
+        reading = root.find(f'{IEEE_PREFIX}Resource')
+        if reading is None:
+            METRICS.inc('xcel_notifications_total', {**endpoint._metric_labels, 'result': 'empty'})
+            return True
+        endpoint.handle_reading(reading)
+        METRICS.inc('xcel_notifications_total', {**endpoint._metric_labels, 'result': 'success'})
+
+        return True